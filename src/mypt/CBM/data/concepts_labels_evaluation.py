@@ -2,7 +2,7 @@
 This script contains functionalities used to evaluate the encoding of the concepts
 """
 
-import os, torch, random
+import torch, random
 
 import numpy as np
 import pandas as pd
@@ -14,42 +14,36 @@ from typing import Union
 from torch.nn.functional import kl_div
 from sklearn.metrics import jaccard_score
 
-from ...code_utilities import directories_and_files as dirf
 from ...code_utilities import pytorch_utilities as pu
 from .Clip_label_generation import ClipLabelGenerator
+from .datasets.abstractConceptDataset import read_class_concept_labels
 
-def avg_max_pairwise_kl_distance(concepts_labels_dir: Union[str, Path], 
+def _sample_rows(concepts_labels: torch.Tensor, num_samples: int = None, seed: int = 0) -> torch.Tensor:
+    # avoid using all the labels of the class if the number of samples was specified 
+    if num_samples is None:
+        return concepts_labels
+
+    pu.seed_everything(seed=seed)
+    rows = sorted(random.sample(range(len(concepts_labels)), min(num_samples, len(concepts_labels))))
+    return concepts_labels[rows]
+
+
+def avg_max_pairwise_kl_distance(concepts_labels: torch.Tensor, 
                                num_samples:int = None,
                                seed:int = 0,
                                verbose=False) -> np.ndarray:
     """ 
-    This function computes the average distance and the maximum distance for each sample in the given concepts label directory    
+    This function computes the average distance and the maximum distance for each sample among the given concepts labels (of a single class)
     """
-
-    concepts_labels_dir = dirf.process_path(concepts_labels_dir, 
-                                          file_ok=False, 
-                                          condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                          error_message='The directory is expected to have only the concept labels saved as tensors'
-                                          )
-        
-    cl = sorted(os.listdir(concepts_labels_dir))
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl = random.sample(cl, min(num_samples,len(cl)))
-    
-
-    if verbose:
-        all_data = torch.stack([torch.load(os.path.join(concepts_labels_dir, c)) for c in tqdm(cl, desc='loading all data in the concept label directory')])
-    else:
-        all_data = torch.stack([torch.load(os.path.join(concepts_labels_dir, c)) for c in cl])
+    all_data = _sample_rows(concepts_labels, num_samples=num_samples, seed=seed)
 
     assert all_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {all_data.shape}"
     num_samples, dim = all_data.shape 
 
     avg_distances, max_distances = [], []
-    for i in range(num_samples):
+
+    loop = tqdm(range(num_samples), desc='iterating through the class samples') if verbose else range(num_samples)
+    for i in loop:
         sample_as_batch = torch.stack([all_data[i] for _ in range(num_samples)])
         assert sample_as_batch.shape == all_data.shape, f"the sample as batch does not have the correct dimensions {sample_as_batch.shape}"
         
@@ -77,59 +71,29 @@ def avg_max_pairwise_kl_distance(concepts_labels_dir: Union[str, Path],
 
     return res
 
-def avg_max_pairwise_binary_distance(concepts_labels_dir: Union[str, Path], 
+def avg_max_pairwise_binary_distance(concepts_labels: torch.Tensor, 
                                num_samples:int = None,
                                seed:int = 0,
                                verbose=False) -> np.ndarray:
     """ 
-    This function computes the average distance and the maximum distance for each sample in the given concepts label directory    
+    This function computes the average distance and the maximum distance for each sample among the given concepts labels (of a single class)
     """
-
-    concepts_labels_dir = dirf.process_path(concepts_labels_dir, 
-                                          file_ok=False, 
-                                          condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                          error_message='The directory is expected to have only the concept labels saved as tensors'
-                                          )
-        
-    cl = os.listdir(concepts_labels_dir)
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl = random.sample(cl, min(num_samples,len(cl)))
-    
-    # assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir)]), "This directory contains files other than saved tensors"
-    if verbose:
-        all_data = torch.stack([torch.load(os.path.join(concepts_labels_dir, c)) for c in tqdm(cl, desc='loading all data in the concept label directory')])
-    else:
-        all_data = torch.stack([torch.load(os.path.join(concepts_labels_dir, c)) for c in sorted(os.listdir(concepts_labels_dir))])
-
-    assert all_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {all_data.shape}"
-
-
-    # assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir)]), "This directory contains files other than saved tensors"
-    all_data = torch.stack([torch.load(os.path.join(concepts_labels_dir, c)) for c in cl])
+    all_data = _sample_rows(concepts_labels, num_samples=num_samples, seed=seed)
 
     assert all_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {all_data.shape}"
     num_samples, dim = all_data.shape 
 
-
     l1_distance = torch.nn.PairwiseDistance(p=1)
     avg_distances, max_distances = [], []
     
     loop = tqdm(range(num_samples), desc='iterating through the class samples') if verbose else range(num_samples)
 
-
-    all_data_metric = all_data.T.numpy()
-
     for i in loop:
         sample_as_batch = torch.stack([all_data[i] for _ in range(num_samples)])
         assert sample_as_batch.shape == all_data.shape, f"the sample as batch does not have the correct dimensions {sample_as_batch.shape}"
 
         sample_distance_to_all = l1_distance.forward(sample_as_batch, all_data)
-        # sample_distance_to_all = jaccard_score(sample_as_batch.T.numpy(), all_data_metric, average=None, zero_division=0)
 
-        # sample_avg_distance, sample_max_distance = np.mean(sample_distance_to_all).item(), np.max(sample_distance_to_all).item()
         sample_avg_distance, sample_max_distance = torch.mean(sample_distance_to_all).item(), torch.max(sample_distance_to_all).item()
 
         avg_distances.append(sample_avg_distance)
@@ -145,39 +109,13 @@ def avg_max_pairwise_binary_distance(concepts_labels_dir: Union[str, Path],
 
     return res
 
-def pairwise_inter_class_binary_distance(concepts_labels_dir1: Union[str, Path],
-                           concepts_labels_dir2: Union[str, Path],
+def pairwise_inter_class_binary_distance(concepts_labels1: torch.Tensor,
+                           concepts_labels2: torch.Tensor,
                            num_samples:int=None,
                            seed:int=0,
                            verbose=False) -> np.ndarray:
-    # first of all, read the data from both directories
-    concepts_labels_dir1 = dirf.process_path(concepts_labels_dir1, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-
-    concepts_labels_dir2 = dirf.process_path(concepts_labels_dir1, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-    
-    cl1 = sorted(os.listdir(concepts_labels_dir1))
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl1 = random.sample(cl1, min(num_samples,len(cl1)))
-
-    cl2 = sorted(os.listdir(concepts_labels_dir2))
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl2 = random.sample(cl2, min(num_samples,len(cl2)))
-
-    
-    c1_data = torch.stack([torch.load(os.path.join(concepts_labels_dir1, c)) for c in cl1])
-    c2_data = torch.stack([torch.load(os.path.join(concepts_labels_dir2, c)) for c in cl2])
+    c1_data = _sample_rows(concepts_labels1, num_samples=num_samples, seed=seed)
+    c2_data = _sample_rows(concepts_labels2, num_samples=num_samples, seed=seed)
  
     assert c1_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c1_data.shape}"
     assert c2_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c2_data.shape}"
@@ -188,8 +126,8 @@ def pairwise_inter_class_binary_distance(concepts_labels_dir1: Union[str, Path],
     assert d1 == d2, "The dimensions of concept labels must be the same"
 
     # make sure the data is binary
-    assert sorted(torch.unique(c1_data).tolist()) == [0, 1], "The data of the first directory is not binary"
-    assert sorted(torch.unique(c2_data).tolist()) == [0, 1], "The data of the second directory is not binary"
+    assert sorted(torch.unique(c1_data).tolist()) == [0, 1], "The labels of the first class are not binary"
+    assert sorted(torch.unique(c2_data).tolist()) == [0, 1], "The labels of the second class are not binary"
 
     min_cluster, max_cluster = (c1_data, c2_data) if n1 <= n2 else (c2_data, c1_data)
     min_n, max_n = len(min_cluster), len(max_cluster)
@@ -200,14 +138,11 @@ def pairwise_inter_class_binary_distance(concepts_labels_dir1: Union[str, Path],
 
     loop = tqdm(range(min_n), desc='computing the inter class distance') if verbose else range(min_n)
     
-    max_cluster_metric = max_cluster.T.numpy()
     for i in loop:
         sample_as_batch = torch.stack([min_cluster[i] for _ in range(max_n)])
         assert sample_as_batch.shape == max_cluster.shape, "the batch and the max cluster must be of the same shape"
         # calculate the distance between this one sample and all the samples in the other cluster
         sample_cluster_distance = l1_distance.forward(sample_as_batch, max_cluster).T.numpy()        
-        # sample_cluster_distance = jaccard_score(sample_as_batch.T.numpy(), max_cluster_metric, average=None, zero_division=1).reshape((1, -1))
-        # assert sample_cluster_distance.shape == (1, max_n), f"make sure the inter cluster distance is computed correctly. Expected: {(1, max_n)}. Found: {sample_cluster_distance.shape}"
         distance_matrix.append(sample_cluster_distance)
 
 
@@ -215,40 +150,13 @@ def pairwise_inter_class_binary_distance(concepts_labels_dir1: Union[str, Path],
     assert distance_matrix.shape == (min_n, max_n), f"Make sure the distance matrix is computed correctly. Expected: {(min_n, max_n)}. Found: {distance_matrix.shape}"
     return distance_matrix
 
-def pairwise_inter_class_kl_distance(concepts_labels_dir1: Union[str, Path],
-                           concepts_labels_dir2: Union[str, Path],
+def pairwise_inter_class_kl_distance(concepts_labels1: torch.Tensor,
+                           concepts_labels2: torch.Tensor,
                            num_samples:int=None,
                            seed:int=0,
                            verbose=False) -> np.ndarray:
-
-    # first of all, read the data from both directories
-    concepts_labels_dir1 = dirf.process_path(concepts_labels_dir1, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-
-    concepts_labels_dir2 = dirf.process_path(concepts_labels_dir1, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-    
-    cl1 = sorted(os.listdir(concepts_labels_dir1))
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl1 = random.sample(cl1, min(num_samples,len(cl1)))
-
-    cl2 = sorted(os.listdir(concepts_labels_dir2))
-    # avoid using the entire directory if the number of samples was specified 
-    if num_samples is not None: 
-        pu.seed_everything(seed=seed)
-        # sample from the concept labels
-        cl2 = random.sample(cl2, min(num_samples,len(cl2)))
-
-    
-    c1_data = torch.stack([torch.load(os.path.join(concepts_labels_dir1, c)) for c in cl1])
-    c2_data = torch.stack([torch.load(os.path.join(concepts_labels_dir2, c)) for c in cl2])
+    c1_data = _sample_rows(concepts_labels1, num_samples=num_samples, seed=seed)
+    c2_data = _sample_rows(concepts_labels2, num_samples=num_samples, seed=seed)
  
     assert c1_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c1_data.shape}"
     assert c2_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c2_data.shape}"
@@ -284,87 +192,6 @@ def pairwise_inter_class_kl_distance(concepts_labels_dir1: Union[str, Path],
     return distance_matrix
 
 
-# def evaluate_concepts_labels(directory: Union[str, Path],
-#                              distance: str = 'KL',
-#                              verbose: bool = False, 
-#                              num_samples:int = 2 * 10 ** 3,
-#                              seed: int = 0): 
-
-#     if distance not in ['KL', 'binary']:
-#         raise NotImplementedError(f"The function expects distance as {'KL' or 'binary'}. Found: {distance}")
-    
-#     # first extract the classes
-#     cls = [c for c in os.listdir(directory) if c.endswith('_label')]
-#     classes = [c[:c.find('_concept_label')] for c in cls]
-
-#     intra_distance_function = (partial(avg_max_pairwise_kl_distance,verbose=verbose, num_samples=num_samples, seed=seed) 
-#                                if distance == 'KL' else partial(avg_max_pairwise_binary_distance, verbose=verbose, num_samples=num_samples, seed=seed))
-    
-#     inter_distance_function = (partial(pairwise_inter_class_kl_distance, verbose=verbose, num_samples=num_samples, seed=seed) 
-#                                if distance == 'KL' else partial(pairwise_inter_class_binary_distance, verbose=verbose, seed=seed, num_samples=num_samples))
-
-
-#     intra_distances = {c[:c.find('_concept_label')]: intra_distance_function(os.path.join(directory, c)) 
-#                        for c in tqdm(cls, desc='estimating intra class distances')}
-
-#     # calculate the inter distances
-#     inter_cluster_metrics = {}
-
-
-#     for i in tqdm(range(len(classes)), desc='estimating the inter-class distances'):
-#         loop2 = tqdm(range(len(classes)), desc=f'estimating the inter-class distances for the class: {classes[i]}') if verbose else range(len(classes))        
-        
-#         avg_dis_by_sample = intra_distances[classes[i]][:, [0]]
-#         max_dis_by_sample = intra_distances[classes[i]][:, [1]]
-
-#         # avg_dis_between_samples = np.mean(avg_dis_by_sample).item()
-#         # max_dis_between_samples = np.mean(max_dis_by_sample).item()
-
-#         for j in loop2:    
-#             if j == i:
-#                 continue
-
-#             inter_cluster_distances = inter_distance_function(concepts_labels_dir1=os.path.join(directory, cls[i]),
-#                                                               concepts_labels_dir2=os.path.join(directory, cls[j]))
-
-#             avg_dis_by_sample_br = np.broadcast_to(avg_dis_by_sample, inter_cluster_distances.shape)
-#             max_dis_by_sample_br = np.broadcast_to(max_dis_by_sample, inter_cluster_distances.shape)
-
-#             _avg = np.mean(avg_dis_by_sample_br <= inter_cluster_distances, axis=1)
-#             _max = np.mean(max_dis_by_sample_br <= inter_cluster_distances, axis=1)
-            
-#             # # sort the values values along each axis
-#             # _avg = np.sort(_avg, axis=-1)
-#             # # the idea is to consider the bottom and top k classes 
-#             # avg_classes = _avg[:, :k]
-#             # max_classes = _avg[:, -k:]
-
-#             inter_cluster_metrics[(i, j)] = (np.mean(_avg).item(), np.mean(_max).item()) 
-            
-#     avg_metrics = np.zeros(shape=(len(classes), len(classes)))
-#     max_metrics = np.zeros(shape=(len(classes), len(classes)))
-
-#     for i in range(len(classes)):
-#         for j in range(len(classes)):
-#             if j == i:
-#                 continue
-
-#             res = inter_cluster_metrics[(i, j)]
-#             a, m = res
-#             avg_metrics[i, j] = m
-#             avg_metrics[j, i] = m
-
-#             max_metrics[i, j] = a
-#             max_metrics[j, i] = a
-
-#         max_metrics[i, i] = 0
-#         avg_metrics[i, i] = 0
-
-#     avg_metrics_df = pd.DataFrame(data=avg_metrics, index=classes, columns=classes)
-#     max_metrics_df = pd.DataFrame(data=max_metrics, index=classes, columns=classes)
-
-#     return avg_metrics_df, max_metrics_df
-
 def evaluate_concepts_labels(directory: Union[str, Path],
                              distance: str = 'KL',
                              verbose: bool = False, 
@@ -372,12 +199,16 @@ def evaluate_concepts_labels(directory: Union[str, Path],
                              seed: int = 0,
                              k: int = 5): 
 
+    """
+    Args:
+        directory: the root of a concept dataset whose concept labels were generated (see 'read_class_concept_labels')
+    """
     if distance not in ['KL', 'binary']:
         raise NotImplementedError(f"The function expects distance as {'KL' or 'binary'}. Found: {distance}")
     
-    # first extract the classes
-    cls = [c for c in os.listdir(directory) if c.endswith('_label')]
-    classes = [c[:c.find('_concept_label')] for c in cls]
+    # the concept labels of each class: the rows of the label store of the dataset
+    labels_per_cls = read_class_concept_labels(directory)
+    classes = list(labels_per_cls.keys())
 
     intra_distance_function = (partial(avg_max_pairwise_kl_distance,verbose=verbose, num_samples=num_samples, seed=seed) 
                                if distance == 'KL' else partial(avg_max_pairwise_binary_distance, verbose=verbose, num_samples=num_samples, seed=seed))
@@ -386,8 +217,7 @@ def evaluate_concepts_labels(directory: Union[str, Path],
                                if distance == 'KL' else partial(pairwise_inter_class_binary_distance, verbose=verbose, seed=seed, num_samples=num_samples))
 
 
-    intra_distances = {c[:c.find('_concept_label')]: intra_distance_function(os.path.join(directory, c)) 
-                       for c in tqdm(cls, desc='estimating intra class distances')}
+    intra_distances = {c: intra_distance_function(labels_per_cls[c]) for c in tqdm(classes, desc='estimating intra class distances')}
 
     # calculate the inter distances
     inter_cluster_metrics = {}
@@ -420,16 +250,16 @@ def evaluate_concepts_labels(directory: Union[str, Path],
         avg_dis_by_sample = intra_distances[classes[i]][:, [0]]
 
         for index, cci in enumerate(close_classes_i):
-            inter_cluster_distances = inter_distance_function(concepts_labels_dir1=os.path.join(directory, cls[i]),
-                                                              concepts_labels_dir2=os.path.join(directory, cls[cci]))
+            inter_cluster_distances = inter_distance_function(concepts_labels1=labels_per_cls[classes[i]],
+                                                              concepts_labels2=labels_per_cls[classes[cci]])
 
             avg_dis_by_sample_br = np.broadcast_to(avg_dis_by_sample, inter_cluster_distances.shape)
             _avg = np.mean(avg_dis_by_sample_br <= inter_cluster_distances, axis=1)    
             metrics_close[i][index] = np.mean(_avg).item()
 
         for index, fci in enumerate(far_classes_i):
-            inter_cluster_distances = inter_distance_function(concepts_labels_dir1=os.path.join(directory, cls[i]),
-                                                              concepts_labels_dir2=os.path.join(directory, cls[fci]))
+            inter_cluster_distances = inter_distance_function(concepts_labels1=labels_per_cls[classes[i]],
+                                                              concepts_labels2=labels_per_cls[classes[fci]])
 
             avg_dis_by_sample_br = np.broadcast_to(avg_dis_by_sample, inter_cluster_distances.shape)
             _avg = np.mean(avg_dis_by_sample_br <= inter_cluster_distances, axis=1)
@@ -88,8 +88,6 @@ class BinaryConceptDataset(AbstractConceptDataset):
 
         self._find_close_classes()
 
-        # save the number of initial folders in 'root'
-        initial_num_folders = len(os.listdir(self.root))
 
         self.top_k = top_k 
 
@@ -117,9 +115,8 @@ class BinaryConceptDataset(AbstractConceptDataset):
                 pu.cleanup()
                 batch_size = int(batch_size / 1.2)
             
-        # at this point the number of directories should have doubled
-        assert not remove_existing or len(os.listdir(root)) == 2 * initial_num_folders, \
-            "The number of directories is not doubled !!!"
+        # at this point every sample should have a concept label
+        assert self._labels_ready(), "Some samples are not associated with a concept label !!!"
 
 
     def _find_close_classes(self):
@@ -315,57 +312,22 @@ class BinaryConceptDataset(AbstractConceptDataset):
 
     def _prepare_labels(self, batch_size: int) -> None:
         """
-        It is important to keep in mind that
-        This function iterates through the 'self.root' directory
-
+        This function generates the concepts labels of the samples (class by class, in batches) and writes them
+        into the label store in 'self.root'. Such process is conducted to avoid repeated inference during training.
         """
-        # start by freeing up any previously occupied GPU memory
+        # start by freeing up any available GPU memory
         pu.cleanup()
 
-        # extract the class names
+        def generate_labels(cls_name: str, batch_file_paths: List[str]) -> torch.Tensor:
+            batch_labels = self._generate_concept_labels(cls=cls_name, images=batch_file_paths)
 
-        class_names = [f for f in sorted(os.listdir(self.root)) if f in self.classes]
+            if batch_labels.shape != (len(batch_file_paths), len(self.concepts)):
+                raise ValueError(f"The labels are expected to be of the shape: {(len(batch_file_paths), len(self.concepts))}. Found: {batch_labels.shape}")
+            return batch_labels
 
-        for folder_name in tqdm(class_names, desc='concept labels for each class: representation 3'):
-            # at this point we know the current folder is a class folder
-            cls_path = os.path.join(self.root, folder_name)
-            # extract the paths to all the images
-            image_paths = [os.path.join(self.root, folder_name, file) for file in sorted(os.listdir(cls_path))]
-            
-            # create the label folder for the current class if needed
-            cls_label_folder_path = os.path.join(self.root, f'{folder_name}_{self.concept_label_ending}')
-            os.makedirs(cls_label_folder_path, exist_ok=True)
-
-            # create the concept labels in batches
-            for i in range(0, len(image_paths), batch_size):
-                # extract the paths in the current batch
-                batch_file_paths = image_paths[i:i + batch_size]
-                # extract the paths to the corresponding concept labels
-                batch_concept_labels_path = [self._sample_to_concept_label(sample_path) for sample_path in batch_file_paths]
-
-                # at this point, either all of them should be present or none of them
-                concept_labels_present = [os.path.exists(bclp) for bclp in batch_concept_labels_path]
-
-                # we should make sure that either all files in the batch are associated with a concept label or none of them:
-                # this ensures reproducibility
-                if any(concept_labels_present) and not all(concept_labels_present):
-                    raise ValueError(f"Some files in the batch have concept labels and some do not. Please make sure the code is reproducible!!!")
-                
-                if all(concept_labels_present):
-                    # this means that these samples have been encountered before: no need to generate concept labels
-                    continue 
-
-                batch_labels = self._generate_concept_labels(cls=folder_name, images=batch_file_paths)
-
-                # make sure the labels are indeed binary
-                if not torch.all(torch.logical_or(input=(batch_labels == 1), other=(batch_labels == 0))):
-                    raise ValueError(f"the concept label should contain the values 1 or 0.")
-
-                if batch_labels.shape != (len(batch_file_paths), len(self.concepts)):
-                    raise ValueError(f"The labels are expected to be of the shape: {(len(batch_file_paths), len(self.concepts))}. Found: {batch_labels.shape}")
-
-                for label_tensor, label_file_path in zip(batch_labels, batch_concept_labels_path):
-                    # save the concept label
-                    torch.save(label_tensor, label_file_path)
+        self._prepare_labels_by_class(batch_size=batch_size, 
+                                      generate_labels=generate_labels, 
+                                      binary=True, 
+                                      desc='concept labels for each class: representation 3')
 
         
\ No newline at end of file
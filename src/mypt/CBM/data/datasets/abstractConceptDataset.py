@@ -5,26 +5,34 @@ This script contains the parent class of different Dataset objects to efficientl
 import os
 import torch
 import shutil
+import hashlib
 
+import numpy as np
 import torchvision.transforms as tr
 
 from torch.utils.data import Dataset
-from typing import Union, List, Dict, Tuple
+from typing import Union, List, Dict, Tuple, Optional, Callable
 from pathlib import Path
 from PIL import Image
 from abc import ABC, abstractclassmethod
+from tqdm import tqdm
 
+from .conceptLabelStore import ConceptLabelStore
 from ....code_utilities import directories_and_files as dirf
+from ....code_utilities.string_arrays import pack_strings, string_offsets, unpack_string_range
 
 class AbstractConceptDataset(ABC, Dataset):
     """This class implements the shared functionality between all concrete dataset objects
     1. loading samples: given a path to an image, return a PIL object 
     2. find classes: creating a consistent (across systems) mapping between the class names and numerical indices 
-    3. _sample_to_concept_label: Concepts labels are precalculated and saved in the directory with the samples: for efficient training, knowing the path
-    to the sample should allow us to find the path to its concept label in O(1) time
+    3. concept labels: Concepts labels are precalculated and saved in a single memory-mapped (N, num_concepts) array (ConceptLabelStore)
+    in the directory with the samples: the label of a sample is the row with the same index
     4. idx2path: map an index to a sample path in O(1) time: the function __get__item(self, index) must be fast for efficient 
+    training. The sample paths and class indices are saved in flat arrays built once at construction
     """
     concept_label_ending = 'concept_label'
+    # the directory of the label store: its name ends with 'concept_label_ending' so it is not considered a class
+    label_store_dir = f'labels_{concept_label_ending}'
 
     @classmethod
     def load_sample(cls, sample_path: Union[str, Path]):
@@ -59,41 +67,131 @@ class AbstractConceptDataset(ABC, Dataset):
                 classes.append(cls)
         return classes, cls_index_map
 
-    def _sample_to_concept_label(self, sample_path: str, cls_label: str = None) -> str:
+    @abstractclassmethod
+    def _prepare_labels(self,
+                        batch_size: int, 
+                        debug: bool = False) -> None:
+        pass
+
+    def _class_dirs_mtimes(self) -> np.ndarray:
+        return np.asarray([os.stat(os.path.join(self.root, cls)).st_mtime_ns for cls in self.classes], dtype=np.int64)
+
+    def _load_sample_index(self, sample_index_file: Union[str, Path]) -> bool:
+        # the persisted index is valid only for the same classes and as long as no class directory was modified
+        if not os.path.exists(sample_index_file):
+            return False
+
+        with np.load(sample_index_file) as data:
+            if data['root'].item() != str(self.root) or data['classes'].tolist() != list(self.classes):
+                return False
+
+            if not np.array_equal(data['class_dirs_mtimes'], self._class_dirs_mtimes()):
+                return False
+
+            # an index saved before the paths were packed
+            if data['sample_paths'].dtype != np.uint8:
+                return False
+
+            self._sample_paths_blob = data['sample_paths']
+            self.sample_classes = data['sample_classes']
+
+        self._sample_paths_offsets = string_offsets(self._sample_paths_blob)
+
+        return True
+
+    def _build_sample_index(self, sample_index_file: Optional[Union[str, Path]] = None) -> None:
         """
-        Each sample is associated with an embedding representing the distance between the picture
-        and the given concepts. Such embedding is saved in the disk to avoid going through the inference process
-        each time during training.
+        Lists each class directory once and saves the sample paths and their class indices in flat arrays: 
+        mapping an index to a sample does not require any filesystem call.
+        """
+        if sample_index_file is not None:
+            # np.savez appends the '.npz' suffix to the file name when missing: the index is loaded from the same path
+            sample_index_file = str(sample_index_file)
+            if not sample_index_file.endswith('.npz'):
+                sample_index_file = f'{sample_index_file}.npz'
+
+            if self._load_sample_index(sample_index_file):
+                return
+
+        sample_paths, sample_classes = [], []
+        for cls_index, cls in enumerate(self.classes):
+            cls_dir = os.path.join(self.root, cls)
+            files = sorted(os.listdir(cls_dir))
+            sample_paths.extend(os.path.join(cls_dir, f) for f in files)
+            sample_classes.extend([cls_index] * len(files))
+
+        # the paths are packed in a single byte buffer (indexed by their offsets): a fixed-width array of strings would pad each path
+        # to the longest one
+        self._sample_paths_blob = pack_strings(sample_paths)
+        self._sample_paths_offsets = string_offsets(self._sample_paths_blob)
+        self.sample_classes = np.asarray(sample_classes, dtype=np.int64)
+
+        if sample_index_file is not None:
+            # arrays of strings and bytes (and not objects): no pickling involved
+            np.savez(sample_index_file, 
+                     root=np.asarray(str(self.root)),
+                     classes=np.asarray(self.classes, dtype=str),
+                     class_dirs_mtimes=self._class_dirs_mtimes(),
+                     sample_paths=self._sample_paths_blob,
+                     sample_classes=self.sample_classes)
+
+    def _sample_paths(self, start: int, end: int) -> List[str]:
+        return unpack_string_range(self._sample_paths_blob, self._sample_paths_offsets, start, end)
+
+    def _listing_hash(self) -> str:
+        # the packed buffer is the utf-8 encoding of the paths joined by new lines
+        return hashlib.sha1(self._sample_paths_blob.tobytes()).hexdigest()
+
+    def _prepare_labels_by_class(self, 
+                                 batch_size: int, 
+                                 generate_labels: Callable[[str, List[str]], torch.Tensor], 
+                                 binary: bool,
+                                 desc: str) -> None:
+        """
+        Generates the concept labels of the samples class by class (in batches) and writes them into the label store.
+        The store is created at the first batch (the number of concepts is known at this point).
 
         Args:
-            sample_path: the path to the sample
-            cls_label: the label of the given sample. passed for debugging purposes
+            generate_labels: maps the class name and the paths of a batch of its samples to the (batch_size, num_concepts) labels
+            binary: whether the labels are binary (saved as packed bits)
+        """
+        batch_size = int(batch_size)
 
-        Returns: a path where the corresponding label tensor should be saved
+        for cls in tqdm(self.classes, desc=desc):
+            cls_start, cls_end = self.index_to_class[cls]
 
-        """
+            for start in range(cls_start, cls_end + 1, batch_size):
+                end = min(start + batch_size, cls_end + 1)
 
-        # make sure the path to the sample is absolute
-        if not os.path.isabs(sample_path):
-            raise ValueError(f"The path is expected to be absolute. Found: {sample_path}")
+                if self.label_store is not None:
+                    labels_present = self.label_store.filled(start, end)
 
-        extracted_label = os.path.basename(Path(sample_path).parent)
+                    # we should make sure that either all files in the batch are associated with a concept label or none of them:
+                    # this ensures reproducibility
+                    if labels_present.any() and not labels_present.all():
+                        raise ValueError(f"Some files in the batch have concept labels and some do not. Please make sure the code is reproducible!!!")
 
-        # this is used mainly for debugging purposes
-        if cls_label is not None and extracted_label != cls_label:
-            raise ValueError(f"expected the class labels to match. Given: {cls_label}, Retrieved: {extracted_label}")
+                    if labels_present.all():
+                        # this means that these samples have been encountered before: no need to generate concept labels
+                        continue
 
-        # extract the name of the file
-        sample_name, _ = os.path.splitext(os.path.basename(sample_path))
-        # build the path to the tensor label
-        tensor_path = os.path.join(self.root, f'{extracted_label}_{self.concept_label_ending}', f'{sample_name}.pt')
-        return tensor_path
+                batch_labels = generate_labels(cls, self._sample_paths(start, end))
 
-    @abstractclassmethod
-    def _prepare_labels(self,
-                        batch_size: int, 
-                        debug: bool = False) -> None:
-        pass
+                # make sure the labels are indeed binary
+                if binary and not torch.all(torch.logical_or(input=(batch_labels == 1), other=(batch_labels == 0))):
+                    raise ValueError(f"the concept label should contain the values 1 or 0.")
+
+                if self.label_store is None:
+                    self.label_store = ConceptLabelStore.create(os.path.join(self.root, self.label_store_dir), 
+                                                                num_samples=self.data_count, 
+                                                                num_concepts=batch_labels.shape[1], 
+                                                                binary=binary, 
+                                                                listing_hash=self._listing_hash())
+
+                self.label_store.write(start, batch_labels)
+
+    def _labels_ready(self) -> bool:
+        return self.label_store is not None and self.label_store.is_complete()
 
     def _cls_to_range(self) -> Dict[str, Tuple[int, int]]:
         """
@@ -102,43 +200,36 @@ class AbstractConceptDataset(ABC, Dataset):
         # build a mapping from classes to range of indices
         range_min = 0
         cls_range_map = {}
-        
+
+        # the number of samples per class (computed from the sample index: no need to list the directories again)
+        counts = np.bincount(self.sample_classes, minlength=len(self.classes))
+
         # the main idea is to map the class name to a range [a, a + number of samples of that class - 1], where 'a' is the
         # total number of samples encountered so far.
-        for cls in self.classes:
-            folder_files = len(os.listdir(os.path.join(self.root, cls)))
+        for cls, folder_files in zip(self.classes, counts.tolist()):
             cls_range_map[cls] = (range_min, range_min + folder_files - 1)
             range_min += folder_files
 
         return cls_range_map
 
     def idx2path(self, index: int) -> Tuple[Union[str, Path], str]:
-        # first step is to locate the path to the corresponding sample
-        sample_path, sample_cls = None, None
-        for cls, indices_range in self.index_to_class.items():
-            if indices_range[0] <= index <= indices_range[1]:
-                sample_cls = cls
-                cls_dir = os.path.join(self.root, cls)
-                sample_path = os.path.join(cls_dir, sorted(os.listdir(cls_dir))[index - indices_range[0]])
-                break
-        
-        if sample_path is None or sample_cls is None:
-            raise ValueError(f"Make sure each index maps to a sample")
-        
-        return sample_path, sample_cls
+        if not (0 <= index < self.data_count):
+            raise ValueError(f"Make sure each index maps to a sample. The index must be in the range [0, {self.data_count}). Found: {index}")
+
+        return self._sample_paths(index, index + 1)[0], self.classes[self.sample_classes[index]]
 
     def __getitem__(self, index: int):
         # extract the path to the sample or the class
-        sample_path, sample_cls = self.idx2path(index)
+        sample_path, _ = self.idx2path(index)
 
         sample_image = self.load_sample(sample_path)
         # apply the transformation
         sample_image = self.image_transform(sample_image) if self.image_transform is not None else sample_image
-        # convert the class as 'str' to an index
-        cls_label = self.class_to_idx[sample_cls]
+        # the class index is precomputed
+        cls_label = int(self.sample_classes[index])
 
-        # retrieve the concept label
-        concept_label = torch.load(self._sample_to_concept_label(sample_path))
+        # retrieve the concept label: a row of the memory-mapped label store
+        concept_label = self.label_store.read(index)
 
         return sample_image, concept_label, cls_label
 
@@ -151,6 +242,7 @@ class AbstractConceptDataset(ABC, Dataset):
                  root: Union[str, Path],
                  image_transform: None,
                  remove_existing: bool = False,
+                 sample_index_file: Optional[Union[str, Path]] = None,
                  ) -> None:
         
         if image_transform is None:
@@ -178,9 +270,35 @@ class AbstractConceptDataset(ABC, Dataset):
         # build the class to index map following Pytorch API
         self.classes, self.class_to_idx = self.find_classes()
 
+        # the flat arrays mapping an index to its sample (optionally loaded from / saved to the 'sample_index_file')
+        self._build_sample_index(sample_index_file)
+
         # build a mapping between classes and the associated range of indices
         self.index_to_class = self._cls_to_range()
 
         # let's count the number of items in the dataset
-        self.data_count = sum([len(os.listdir(os.path.join(self.root, c))) for c in self.classes])
+        self.data_count = len(self.sample_classes)
+
+        # the concept labels of a previous run are reused as long as the samples did not change
+        self.label_store = ConceptLabelStore.open(os.path.join(self.root, self.label_store_dir), 
+                                                  num_samples=self.data_count, 
+                                                  listing_hash=self._listing_hash())
+
+
+class _ConceptLabelsReader(AbstractConceptDataset):
+    # lists the samples and opens their label store: no label is generated
+    def _prepare_labels(self, batch_size: int, debug: bool = False) -> None:
+        pass
+
+
+def read_class_concept_labels(root: Union[str, Path]) -> Dict[str, torch.Tensor]:
+    """
+    Returns the concept labels of each class of the dataset in 'root' (generated by any concept dataset): 
+    the rows of its label store sliced by the range of indices of the class
+    """
+    ds = _ConceptLabelsReader(root, image_transform=None)
+
+    if not ds._labels_ready():
+        raise ValueError(f"The concept labels of the dataset in {root} were not (completely) generated")
 
+    return {cls: ds.label_store.read_rows(start, end + 1) for cls, (start, end) in ds.index_to_class.items()}
@@ -6,7 +6,7 @@ import os, torch, itertools, json
 
 import torchvision.transforms as tr
 
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional
 from pathlib import Path
 from tqdm import tqdm
 from time import sleep
@@ -23,17 +23,20 @@ class BinaryConceptDataset(AbstractConceptDataset):
                  top_k: int = 1,
                  label_generation_batch_size: int = 512,
                  image_transform: tr = None,
-                 remove_existing: bool = True):
+                 remove_existing: bool = True,
+                 sample_index_file: Optional[Union[str, Path]] = None):
         """
         Args:
             root: the root directory
             concepts: a list / dictionary of concepts used for all classes
             image_transform: transformation applied on a given image
             remove_existing: whether to remove already-existing concept directories
+            sample_index_file: an optional file where the index of the samples (paths, classes) is persisted
         """
         super().__init__(root, 
                          image_transform=image_transform, 
-                         remove_existing=remove_existing)
+                         remove_existing=remove_existing,
+                         sample_index_file=sample_index_file)
         
         # handle the case where the 'concepts' are passed as json file
         if isinstance(concepts, (str, Path)):
@@ -54,8 +57,6 @@ class BinaryConceptDataset(AbstractConceptDataset):
         self.clip_generator = ClipLabelGenerator(similarity_as_cosine=self.sim == 'cosine')
         self.concepts_features = self.clip_generator.encode_concepts(concepts=self.concepts)
 
-        # save the number of initial folders in 'root'
-        initial_num_folders = len(os.listdir(self.root))
 
         self.top_k = top_k 
 
@@ -89,9 +90,8 @@ class BinaryConceptDataset(AbstractConceptDataset):
                 # make sure the batch_size is at least 32
                 batch_size = max(batch_size, 32)
             
-        # at this point the number of directories should have doubled
-        assert not remove_existing or len(os.listdir(root)) == 2 * initial_num_folders, \
-            "The number of directories is not doubled !!!"
+        # at this point every sample should have a concept label
+        assert self._labels_ready(), "Some samples are not associated with a concept label !!!"
 
 
     def _class_concept_similarities(self, cls_name: str,
@@ -187,57 +187,22 @@ class BinaryConceptDataset(AbstractConceptDataset):
 
     def _prepare_labels(self, batch_size: int) -> None:
         """
-        It is important to keep in mind that
-        This function iterates through the 'self.root' directory
-
+        This function generates the concepts labels of the samples (class by class, in batches) and writes them
+        into the label store in 'self.root'. Such process is conducted to avoid repeated inference during training.
         """
-        # start by freeing up any previously occupied GPU memory
+        # start by freeing up any available GPU memory
         pu.cleanup()
 
-        # extract
-
-        class_names = [f for f in sorted(os.listdir(self.root)) if f in self.classes]
-
-        for folder_name in tqdm(class_names, desc='concept labels for each class: representation 3'):
-            # at this point we know the current folder is a class folder
-            cls_path = os.path.join(self.root, folder_name)
-            # extract the paths to all the images
-            image_paths = [os.path.join(self.root, folder_name, file) for file in sorted(os.listdir(cls_path))]
-            
-            # create the label folder for the current class if needed
-            cls_label_folder_path = os.path.join(self.root, f'{folder_name}_{self.concept_label_ending}')
-            os.makedirs(cls_label_folder_path, exist_ok=True)
-
-            # create the concept labels in batches
-            for i in range(0, len(image_paths), batch_size):
-                # extract the paths in the current batch
-                batch_file_paths = image_paths[i:i + batch_size]
-                # extract the paths to the corresponding concept labels
-                batch_concept_labels_path = [self._sample_to_concept_label(sample_path) for sample_path in batch_file_paths]
-
-                # at this point, either all of them should be present or none of them
-                concept_labels_present = [os.path.exists(bclp) for bclp in batch_concept_labels_path]
-
-                # we should make sure that either all files in the batch are associated with a concept label or none of them:
-                # this ensures reproducibility
-                if any(concept_labels_present) and not all(concept_labels_present):
-                    raise ValueError(f"Some files in the batch have concept labels and some do not. Please make sure the code is reproducible!!!")
-                
-                if all(concept_labels_present):
-                    # this means that these samples have been encountered before: no need to generate concept labels
-                    continue 
-
-                batch_labels = self._generate_concept_labels(batch_file_paths)
-
-                # make sure the labels are indeed binary
-                if not torch.all(torch.logical_or(input=(batch_labels == 1), other=(batch_labels == 0))):
-                    raise ValueError(f"the concept label should contain the values 1 or 0.")
+        def generate_labels(cls_name: str, batch_file_paths: List[str]) -> torch.Tensor:
+            batch_labels = self._generate_concept_labels(batch_file_paths)
 
-                if batch_labels.shape != (len(batch_file_paths), len(self.concepts)):
-                    raise ValueError(f"The labels are expected to be of the shape: {(len(batch_file_paths), len(self.concepts))}. Found: {batch_labels.shape}")
+            if batch_labels.shape != (len(batch_file_paths), len(self.concepts)):
+                raise ValueError(f"The labels are expected to be of the shape: {(len(batch_file_paths), len(self.concepts))}. Found: {batch_labels.shape}")
+            return batch_labels
 
-                for label_tensor, label_file_path in zip(batch_labels, batch_concept_labels_path):
-                    # save the concept label
-                    torch.save(label_tensor, label_file_path)
+        self._prepare_labels_by_class(batch_size=batch_size, 
+                                      generate_labels=generate_labels, 
+                                      binary=True, 
+                                      desc='concept labels for each class: representation 3')
 
         
\ No newline at end of file
@@ -2,12 +2,11 @@
 This script contains functionalities designed to efficiently load data for Concept Bottleneck Models
 """
 
-import os, itertools, torch, json
+import itertools, torch, json
 import torchvision.transforms as tr
 
-from typing import Union, List, Dict 
+from typing import Union, List, Dict, Optional
 from pathlib import Path
-from tqdm import tqdm
 
 from .abstractConceptDataset import AbstractConceptDataset
 from ..Clip_label_generation import ClipLabelGenerator
@@ -18,52 +17,19 @@ class ConceptDataset(AbstractConceptDataset):
                         batch_size: int, 
                         debug: bool = False) -> None:
         """
-        This function iterates through the 'self.root' directory creating the concepts labels for each sample
-        and saving them in separate directories within 'self.root'. Such process is conducted to avoid
-        repeated inference during training.
-
-        Returns:
+        This function generates the concepts labels of the samples (class by class, in batches) and writes them
+        into the label store in 'self.root'. Such process is conducted to avoid repeated inference during training.
         """
         # start by freeing up any available GPU memory
         cleanup()
-        
-        class_names = [f for f in sorted(os.listdir(self.root)) if f in self.classes]
-
-        for folder_name in tqdm(class_names, desc='concept labels for each class: representation 1'):
-            # at this point we know the current folder is a class folder
-            cls_path = os.path.join(self.root, folder_name)
-            # extract the paths to all the images
-            image_paths = [os.path.join(self.root, folder_name, file) for file in sorted(os.listdir(cls_path))]
-            
-            # create the label folder for the current class if needed
-            cls_label_folder_path = os.path.join(self.root, f'{folder_name}_{self.concept_label_ending}')
-            os.makedirs(cls_label_folder_path, exist_ok=True)
-
-            # create the concept labels in batches
-            for i in range(0, len(image_paths), batch_size):
-                # extract the paths in the current batch
-                batch_file_paths = image_paths[i:i + batch_size]
-                # extract the paths to the corresponding concept labels
-                batch_concept_labels_path = [self._sample_to_concept_label(sample_path) for sample_path in batch_file_paths]
-
-                # at this point, either all of them should be present or none of them
-                concept_labels_present = [os.path.exists(bclp) for bclp in batch_concept_labels_path]
-
-                # we should make sure that either all files in the batch are associated with a concept label or none of them:
-                # this ensures reproducibility
-                if any(concept_labels_present) and not all(concept_labels_present):
-                    raise ValueError(f"Some files in the batch have concept labels and some do not. Please make sure the code is reproducible!!!")
-                
-                if all(concept_labels_present):
-                    # this means that these samples have been encountered before: no need to generate concept labels
-                    continue 
 
-                # generate the concept labels
-                batch_labels = self.label_generator.generate_image_label(batch_file_paths, self.concepts_features, debug_memory=debug)
+        def generate_labels(cls_name: str, batch_file_paths: List[str]) -> torch.Tensor:
+            return self.label_generator.generate_image_label(batch_file_paths, self.concepts_features, debug_memory=debug)
 
-                for label_tensor, label_file_path in zip(batch_labels, batch_concept_labels_path):
-                    # save the concept label
-                    torch.save(label_tensor, label_file_path)
+        self._prepare_labels_by_class(batch_size=batch_size, 
+                                      generate_labels=generate_labels, 
+                                      binary=False, 
+                                      desc='concept labels for each class: representation 1')
 
     def __init__(self,
                  root: Union[str, Path],
@@ -71,7 +37,8 @@ class ConceptDataset(AbstractConceptDataset):
                  label_generation_batch_size: int = 512,
                  image_transform: tr = None,
                  label_generator=None,
-                 remove_existing: bool = True, 
+                 remove_existing: bool = True,
+                 sample_index_file: Optional[Union[str, Path]] = None, 
                  debug: bool = False):
         """
         Args:
@@ -79,10 +46,12 @@ class ConceptDataset(AbstractConceptDataset):
             concepts: a list / dictionary of concepts used for all classes
             image_transform: transformation applied on a given image
             remove_existing: whether to remove already-existing concept directories
+            sample_index_file: an optional file where the index of the samples (paths, classes) is persisted
         """
         super().__init__(root,
                           image_transform=image_transform, 
-                          remove_existing=remove_existing)
+                          remove_existing=remove_existing,
+                          sample_index_file=sample_index_file)
         
         if isinstance(concepts, (Path, str)):
             with open(concepts, 'r') as f:
@@ -93,8 +62,6 @@ class ConceptDataset(AbstractConceptDataset):
         # filter duplicate concepts
         self.concepts = list(set(concepts))
 
-        # save the number of initial folders in 'root'
-        initial_num_folders = len(os.listdir(self.root))
         
         # create the label generator
         self.label_generator = label_generator if label_generator is not None else ClipLabelGenerator()
@@ -110,6 +77,5 @@ class ConceptDataset(AbstractConceptDataset):
             except (MemoryError, torch.cuda.OutOfMemoryError):
                 label_generation_batch_size /= 2 
 
-        # at this point the number of directories should have doubled
-        assert not remove_existing or len(os.listdir(root)) == 2 * initial_num_folders, \
-            "The number of directories is not doubled !!!"
+        # at this point every sample should have a concept label
+        assert self._labels_ready(), "Some samples are not associated with a concept label !!!"
@@ -0,0 +1,129 @@
+"""
+This script contains a consolidated store for the concept labels of a dataset: a single preallocated, memory-mapped (N, num_concepts) array
+(bit-packed for binary labels) instead of one '.pt' file per sample.
+"""
+
+import os, json
+import torch
+import numpy as np
+
+from typing import Union, Optional
+from pathlib import Path
+
+
+class ConceptLabelStore:
+    """
+    The directory of the store contains:
+        1. the labels: a (N, num_concepts) float32 array, or a (N, ceil(num_concepts / 8)) uint8 array of packed bits for binary labels
+        2. a (N,) flag array marking the rows already written
+        3. a meta file identifying the samples (their number and a hash of their listing)
+    The arrays are mapped lazily in each process (DataLoader worker): read-only, unless labels are written (the store can be read
+    from a read-only directory).
+    """
+    _labels_file = 'labels.npy'
+    _filled_file = 'filled.npy'
+    _meta_file = 'meta.json'
+
+    def __init__(self,
+                 directory: Union[str, Path],
+                 num_samples: int,
+                 num_concepts: int,
+                 binary: bool) -> None:
+        self.directory = directory
+        self.num_samples = num_samples
+        self.num_concepts = num_concepts
+        self.binary = binary
+
+        self._labels, self._filled = None, None
+        self._writable = False
+
+    @classmethod
+    def create(cls,
+               directory: Union[str, Path],
+               num_samples: int,
+               num_concepts: int,
+               binary: bool,
+               listing_hash: str) -> 'ConceptLabelStore':
+        os.makedirs(directory, exist_ok=True)
+
+        shape = (num_samples, (num_concepts + 7) // 8) if binary else (num_samples, num_concepts)
+        dtype = np.uint8 if binary else np.float32
+
+        np.lib.format.open_memmap(os.path.join(directory, cls._labels_file), mode='w+', dtype=dtype, shape=shape).flush()
+        np.lib.format.open_memmap(os.path.join(directory, cls._filled_file), mode='w+', dtype=np.bool_, shape=(num_samples,)).flush()
+
+        with open(os.path.join(directory, cls._meta_file), 'w') as f:
+            json.dump({"num_samples": num_samples, "num_concepts": num_concepts, "binary": binary, "listing": listing_hash}, f)
+
+        return cls(directory, num_samples=num_samples, num_concepts=num_concepts, binary=binary)
+
+    @classmethod
+    def open(cls, directory: Union[str, Path], num_samples: int, listing_hash: str) -> Optional['ConceptLabelStore']:
+        # the store is reused only for the exact same samples
+        meta_path = os.path.join(directory, cls._meta_file)
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        if meta['num_samples'] != num_samples or meta['listing'] != listing_hash:
+            return None
+
+        return cls(directory, num_samples=num_samples, num_concepts=meta['num_concepts'], binary=meta['binary'])
+
+    def __getstate__(self):
+        # the memory maps are not sent to the workers
+        state = self.__dict__.copy()
+        state['_labels'], state['_filled'], state['_writable'] = None, None, False
+        return state
+
+    def _arrays(self, writable: bool = False):
+        # a read-only map is mapped again (in 'r+' mode) before the first write
+        if self._labels is None or (writable and not self._writable):
+            self.close()
+            mode = 'r+' if writable else 'r'
+            self._labels = np.load(os.path.join(self.directory, self._labels_file), mmap_mode=mode)
+            self._filled = np.load(os.path.join(self.directory, self._filled_file), mmap_mode=mode)
+            self._writable = writable
+        return self._labels, self._filled
+
+    def close(self) -> None:
+        # flush the written rows and release the memory maps (mapped again at the next access)
+        if self._labels is not None and self._writable:
+            self._labels.flush()
+            self._filled.flush()
+        self._labels, self._filled = None, None
+        self._writable = False
+
+    def filled(self, start: int, end: int) -> np.ndarray:
+        return np.asarray(self._arrays()[1][start: end])
+
+    def is_complete(self) -> bool:
+        return bool(self._arrays()[1].all())
+
+    def write(self, start: int, labels: torch.Tensor) -> None:
+        if labels.ndim != 2 or labels.shape[1] != self.num_concepts:
+            raise ValueError(f"The labels are expected to be of the shape: (batch_size, {self.num_concepts}). Found: {tuple(labels.shape)}")
+
+        labels_arr, filled = self._arrays(writable=True)
+        labels = labels.detach().cpu().numpy()
+
+        labels_arr[start: start + len(labels)] = np.packbits(labels.astype(bool), axis=1) if self.binary else labels.astype(np.float32)
+        # the rows are flagged only after being written
+        filled[start: start + len(labels)] = True
+
+    def read_rows(self, start: int, end: int) -> torch.Tensor:
+        """
+        Returns the (end - start, num_concepts) labels of the samples in [start, end)
+        """
+        rows = self._arrays()[0][start: end]
+        if self.binary:
+            rows = np.unpackbits(rows, axis=1, count=self.num_concepts)
+        return torch.from_numpy(rows.astype(np.float32))
+
+    def read(self, index: int) -> torch.Tensor:
+        row = self._arrays()[0][index]
+        if self.binary:
+            row = np.unpackbits(row, count=self.num_concepts)
+        return torch.from_numpy(row.astype(np.float32))
@@ -0,0 +1,74 @@
+"""
+This script tests the round trip of the concept labels through the ConceptLabelStore
+"""
+
+import os, pickle, tempfile, torch
+
+from .conceptLabelStore import ConceptLabelStore
+
+
+def test_label_store_round_trip():
+    torch.manual_seed(0)
+    # 13 concepts: the packed binary rows do not fill their last byte
+    num_samples, num_concepts = 20, 13
+
+    for binary in [True, False]:
+        labels = torch.randint(0, 2, (num_samples, num_concepts)).float() if binary else torch.randn(num_samples, num_concepts)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = os.path.join(tmp, 'labels_concept_label')
+            store = ConceptLabelStore.create(directory, num_samples=num_samples, num_concepts=num_concepts, binary=binary, listing_hash='a')
+            assert not store.filled(0, num_samples).any() and not store.is_complete()
+
+            store.write(0, labels[:8])
+            assert store.filled(0, 8).all() and not store.filled(8, num_samples).any()
+            # the rows written through the map are visible through a new read-only map
+            store.close()
+            assert store.filled(0, 8).all() and not store._writable
+            store.write(8, labels[8:])
+            assert store.is_complete()
+
+            for i in range(num_samples):
+                assert torch.equal(store.read(i), labels[i])
+
+            # a batch of the wrong number of concepts is rejected
+            try:
+                store.write(0, labels[:2, :-1])
+                assert False, "the store should reject labels of the wrong shape"
+            except ValueError:
+                pass
+
+            store.close()
+
+            # a closed store maps its arrays again at the next access
+            assert torch.equal(store.read(3), labels[3])
+            store.close()
+
+            # reopening: only for the same samples
+            assert ConceptLabelStore.open(directory, num_samples=num_samples, listing_hash='b') is None
+            assert ConceptLabelStore.open(directory, num_samples=num_samples + 1, listing_hash='a') is None
+
+            reopened = ConceptLabelStore.open(directory, num_samples=num_samples, listing_hash='a')
+            assert reopened.binary == binary and reopened.num_concepts == num_concepts and reopened.is_complete()
+            assert all(torch.equal(reopened.read(i), labels[i]) for i in range(num_samples))
+
+            # the memory maps are not pickled (sent to the DataLoader workers)
+            copy = pickle.loads(pickle.dumps(reopened))
+            assert copy._labels is None and torch.equal(copy.read(0), labels[0])
+            reopened.close()
+            copy.close()
+
+            # a store in a read-only directory can still be read
+            for name in os.listdir(directory):
+                os.chmod(os.path.join(directory, name), 0o444)
+            os.chmod(directory, 0o555)
+
+            read_only = ConceptLabelStore.open(directory, num_samples=num_samples, listing_hash='a')
+            assert torch.equal(read_only.read_rows(0, num_samples), labels) and read_only.is_complete()
+            assert not read_only._writable
+            read_only.close()
+            os.chmod(directory, 0o755)
+
+
+if __name__ == '__main__':
+    test_label_store_round_trip()
@@ -0,0 +1,113 @@
+"""
+This script tests the flat sample index of the concept datasets against the per-class listing it replaced
+"""
+
+import os, tempfile, torch
+
+import numpy as np
+
+from .abstractConceptDataset import AbstractConceptDataset, read_class_concept_labels
+from .conceptLabelStore import ConceptLabelStore
+
+
+class _ListingDataset(AbstractConceptDataset):
+    def _prepare_labels(self, batch_size: int, debug: bool = False) -> None:
+        pass
+
+
+def _per_class_idx2path(root: str, classes, index: int):
+    # the previous implementation: a scan of the class ranges and a listing of the class directory for each index
+    start = 0
+    for cls in classes:
+        files = sorted(os.listdir(os.path.join(root, cls)))
+        if start <= index < start + len(files):
+            return os.path.join(root, cls, files[index - start]), cls
+        start += len(files)
+    raise ValueError(f"Make sure each index maps to a sample")
+
+
+def test_flat_sample_index():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'data')
+        # classes of different sizes (including an empty one) and file names whose order is not the creation order
+        for cls, n in [('dog', 7), ('cat', 3), ('bird', 0), ('ant', 12)]:
+            os.makedirs(os.path.join(root, cls))
+            for i in range(n):
+                open(os.path.join(root, cls, f'{(i * 7) % 13}_{i}.png'), 'w').close()
+
+        index_file = os.path.join(tmp, 'sample_index.npz')
+
+        for _ in range(2):
+            # the second construction loads the arrays from the index file
+            ds = _ListingDataset(root, image_transform=None, sample_index_file=index_file)
+            assert ds.classes == ['ant', 'bird', 'cat', 'dog'] and len(ds) == 22
+
+            for i in range(len(ds)):
+                path, cls = ds.idx2path(i)
+                assert (path, cls) == _per_class_idx2path(ds.root, ds.classes, i)
+                assert ds.class_to_idx[cls] == int(ds.sample_classes[i])
+
+            assert ds.index_to_class['ant'] == (0, 11) and ds.index_to_class['cat'] == (12, 14) and ds.index_to_class['dog'] == (15, 21)
+
+            # the paths are packed in a byte buffer: ranges of paths are decoded directly from it
+            assert ds._sample_paths_blob.dtype == np.uint8
+            assert ds._sample_paths(12, 15) == [ds.idx2path(i)[0] for i in range(12, 15)] and ds._sample_paths(3, 3) == []
+
+        # a new file in a class directory invalidates the index file
+        open(os.path.join(root, 'bird', '0.png'), 'w').close()
+        ds = _ListingDataset(root, image_transform=None, sample_index_file=index_file)
+        assert len(ds) == 23 and ds.idx2path(12) == _per_class_idx2path(ds.root, ds.classes, 12)
+
+
+def test_sample_index_file_without_suffix():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'data')
+        for cls, n in [('dog', 2), ('cat', 3)]:
+            os.makedirs(os.path.join(root, cls))
+            for i in range(n):
+                # non-ascii names: the offsets of the packed paths are byte offsets
+                open(os.path.join(root, cls, f'{i}_é.png'), 'w').close()
+
+        index_file = os.path.join(tmp, 'sample_index')
+        ds = _ListingDataset(root, image_transform=None, sample_index_file=index_file)
+        assert sorted(os.listdir(tmp)) == ['data', 'sample_index.npz']
+
+        # the second construction loads the saved index: the file is not written again
+        mtime = os.stat(index_file + '.npz').st_mtime_ns
+        ds2 = _ListingDataset(root, image_transform=None, sample_index_file=index_file)
+        assert ds2._load_sample_index(index_file + '.npz') and os.stat(index_file + '.npz').st_mtime_ns == mtime
+        assert [ds2.idx2path(i) for i in range(len(ds2))] == [ds.idx2path(i) for i in range(len(ds))]
+
+
+def test_read_class_concept_labels():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'data')
+        for cls, n in [('dog', 4), ('cat', 3), ('bird', 0)]:
+            os.makedirs(os.path.join(root, cls))
+            for i in range(n):
+                open(os.path.join(root, cls, f'{i}.png'), 'w').close()
+
+        ds = _ListingDataset(root, image_transform=None)
+
+        # the labels were not generated yet
+        try:
+            read_class_concept_labels(root)
+            assert False, "the labels of the dataset were not generated"
+        except ValueError:
+            pass
+
+        labels = torch.randint(0, 2, (len(ds), 5)).float()
+        store = ConceptLabelStore.create(os.path.join(ds.root, ds.label_store_dir), num_samples=len(ds), num_concepts=5, binary=True, listing_hash=ds._listing_hash())
+        store.write(0, labels)
+        store.close()
+
+        labels_per_cls = read_class_concept_labels(root)
+        assert list(labels_per_cls) == ['bird', 'cat', 'dog']
+        assert labels_per_cls['bird'].shape == (0, 5)
+        assert torch.equal(labels_per_cls['cat'], labels[:3]) and torch.equal(labels_per_cls['dog'], labels[3:])
+
+
+if __name__ == '__main__':
+    test_flat_sample_index()
+    test_sample_index_file_without_suffix()
+    test_read_class_concept_labels()
@@ -18,8 +18,8 @@ from sklearn.manifold import TSNE
 
 
 
-from ...code_utilities import directories_and_files as dirf
 from ...code_utilities import pytorch_utilities as pu
+from .datasets.abstractConceptDataset import read_class_concept_labels
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 current=SCRIPT_DIR
@@ -31,21 +31,14 @@ CODEBASE = os.path.join(current, 'codebase')
 
 
 # the two functions below mainly compute the 
-def KL_intra_cluster_distance(concept_label_dir: Union[str, Path], verbose=False) -> float:
-    """This function calculates the KL divergence distance between the concepts labels of a given class (saved in a directory)
+def KL_intra_cluster_distance(concepts_labels: torch.Tensor, verbose=False) -> float:
+    """This function calculates the KL divergence distance between the concepts labels of a given class
     Args:
-        concept_label_dir (Union[str, Path]): a path to a directory of concept labels
+        concepts_labels (torch.Tensor): the (num_samples, num_concepts) concept labels of the class
     Returns:
         float: the average intra cluster distance
     """
-    concept_label_dir = dirf.process_path(concept_label_dir, 
-                                          file_ok=False, 
-                                          condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                          error_message='The directory is expected to have only the concept labels saved as tensors'
-                                          )
-
-    # assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir)]), "This directory contains files other than saved tensors"
-    all_data = torch.stack([torch.load(os.path.join(concept_label_dir, c)) for c in os.listdir(concept_label_dir)])
+    all_data = concepts_labels
 
     assert all_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {all_data.shape}"
     num_samples, dim = all_data.shape 
@@ -66,25 +59,15 @@ def KL_intra_cluster_distance(concept_label_dir: Union[str, Path], verbose=False
     return difference
 
 
-def binary_intra_cluster_distance(concept_label_dir: Union[str, Path], verbose=False) -> float:
+def binary_intra_cluster_distance(concepts_labels: torch.Tensor, verbose=False) -> float:
     """
-    This function calculates the Jaccard similarity between the concept labels of a given class (saved in a directory)
+    This function calculates the Jaccard similarity between the concept labels of a given class
     Args:
-        concept_label_dir (Union[str, Path]): a path to a directory of concept labels
+        concepts_labels (torch.Tensor): the (num_samples, num_concepts) concept labels of the class
     Returns:
         float: the average intra-class distance
     """
-    concept_label_dir = dirf.process_path(concept_label_dir, 
-                                          file_ok=False, 
-                                          condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                          error_message='The directory is expected to have only the concept labels saved as tensors'
-                                          )
-
-    # assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir)]), "This directory contains files other than saved tensors"
-    if verbose:
-        all_data = torch.stack([torch.load(os.path.join(concept_label_dir, c)) for c in tqdm(sorted(os.listdir(concept_label_dir)), desc='loading all data in the concept label directory')])
-    else:
-        all_data = torch.stack([torch.load(os.path.join(concept_label_dir, c)) for c in sorted(os.listdir(concept_label_dir))])
+    all_data = concepts_labels
 
     assert all_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {all_data.shape}"
 
@@ -109,22 +92,10 @@ def binary_intra_cluster_distance(concept_label_dir: Union[str, Path], verbose=F
     return difference
 
 
-def binary_inter_cluster_distance(concept_label_dir1: Union[str, Path],
-                           concept_label_dir2: Union[str, Path], 
+def binary_inter_cluster_distance(concepts_labels1: torch.Tensor,
+                           concepts_labels2: torch.Tensor, 
                            verbose=False) -> Tuple[float, float]:
-    # first of all, read the data from both directories
-    concept_label_dir1 = dirf.process_path(concept_label_dir1, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-
-    concept_label_dir2 = dirf.process_path(concept_label_dir2, dir_ok=True,
-                                           file_ok=False, 
-                                           condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                           error_message="This directory contains files other than saved tensors")
-    
-    c1_data = torch.stack([torch.load(os.path.join(concept_label_dir1, c)) for c in os.listdir(concept_label_dir1)])
-    c2_data = torch.stack([torch.load(os.path.join(concept_label_dir2, c)) for c in os.listdir(concept_label_dir2)])
+    c1_data, c2_data = concepts_labels1, concepts_labels2
  
     assert c1_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c1_data.shape}"
     assert c2_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c2_data.shape}"
@@ -135,8 +106,8 @@ def binary_inter_cluster_distance(concept_label_dir1: Union[str, Path],
     assert d1 == d2, "The dimensions of concept labels must be the same"
 
     # make sure the data is binary
-    assert sorted(torch.unique(c1_data).tolist()) == [0, 1], "The data of the first directory is not binary"
-    assert sorted(torch.unique(c2_data).tolist()) == [0, 1], "The data of the second directory is not binary"
+    assert sorted(torch.unique(c1_data).tolist()) == [0, 1], "The labels of the first class are not binary"
+    assert sorted(torch.unique(c2_data).tolist()) == [0, 1], "The labels of the second class are not binary"
 
     min_cluster, max_cluster = (c1_data, c2_data) if n1 <= n2 else (c2_data, c1_data)
     min_n, max_n = len(min_cluster), len(max_cluster)
@@ -159,33 +130,21 @@ def binary_inter_cluster_distance(concept_label_dir1: Union[str, Path],
     return max_distance, average_distance
 
 
-def KL_inter_cluster_distance(concept_label_dir1: Union[str, Path], 
-                           concept_label_dir2: Union[str, Path], 
+def KL_inter_cluster_distance(concepts_labels1: torch.Tensor, 
+                           concepts_labels2: torch.Tensor, 
                            verbose:bool = False) -> Tuple[float, float]:
     """
     This function will compute the distance between two cluster of concept labels in 2 different ways, using the maximum distance between
     2 elements of the clusters and the average distance between 2 elements of the clusters
 
     Args:
-        concept_label_dir1 (Union[str, Path]): a directory containing concept labels for the 1st class 
-        concept_label_dir2 (Union[str, Path]): a directory containing concept labels for the 2nd class
+        concepts_labels1 (torch.Tensor): the concept labels of the 1st class 
+        concepts_labels2 (torch.Tensor): the concept labels of the 2nd class
 
     Returns:
         Tuple[float, float]: maximum distance, average distance
     """
-
-
-    # first of all, read the data from both directories
-    assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir1)]), "This directory contains files other than saved tensors"
-    assert all([c.endswith('.pt') for c in os.listdir(concept_label_dir2)]), "This directory contains files other than saved tensors"
-    
-    if verbose:
-        c1_data = torch.stack([torch.load(os.path.join(concept_label_dir1, c)) for c in tqdm(sorted(os.listdir(concept_label_dir1)), desc='loading all samples from the first directory')])
-        c2_data = torch.stack([torch.load(os.path.join(concept_label_dir2, c)) for c in tqdm(sorted(os.listdir(concept_label_dir2)), desc='loading all samples from the second directory')])
-    else:
-        c1_data = torch.stack([torch.load(os.path.join(concept_label_dir1, c)) for c in sorted(os.listdir(concept_label_dir1))])
-        c2_data = torch.stack([torch.load(os.path.join(concept_label_dir2, c)) for c in sorted(os.listdir(concept_label_dir2))])
-
+    c1_data, c2_data = concepts_labels1, concepts_labels2
 
     assert c1_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c1_data.shape}"
     assert c2_data.ndim == 2, f"the concepts labels are 1-dimensional !!. Found: {c2_data.shape}"
@@ -201,7 +160,7 @@ def KL_inter_cluster_distance(concept_label_dir1: Union[str, Path],
 
     max_distance, average_distance = float('-inf'), 0 
 
-    loop = tqdm(range(min_n), desc='iterating through the smaller directory') if verbose else range(min_n)
+    loop = tqdm(range(min_n), desc='iterating through the smaller class') if verbose else range(min_n)
     for i in loop:
         sample_as_batch = torch.stack([min_cluster[i] for _ in range(max_n)])
         assert sample_as_batch.shape == max_cluster.shape, "the batch and the max cluster must be of the same shape"
@@ -228,13 +187,14 @@ def evaluate_encoding(directory: Union[str, Path],
     if distance not in ['KL', 'binary']:
         raise NotImplementedError(f"The function expects distance as {'KL' or 'binary'}. Found: {distance}")
     
-    # first extract the classes
-    classes = [c for c in os.listdir(directory) if c.endswith('_label')]
+    # the concept labels of each class: the rows of the label store of the dataset
+    labels_per_cls = read_class_concept_labels(directory)
+    classes = list(labels_per_cls.keys())
     
     intra_distance_function = partial(KL_intra_cluster_distance,verbose=verbose) if distance == 'KL' else partial(binary_intra_cluster_distance, verbose=verbose)
     inter_distance_function = partial(KL_inter_cluster_distance, verbose=verbose) if distance == 'KL' else partial(binary_inter_cluster_distance, verbose=verbose)
 
-    intra_distances = {c: intra_distance_function(os.path.join(directory, c)) for c in tqdm(classes, desc='estimating intra class distances')}
+    intra_distances = {c: intra_distance_function(labels_per_cls[c]) for c in tqdm(classes, desc='estimating intra class distances')}
 
     # calculate the inter distances
     inter_distances = {}
@@ -243,8 +203,8 @@ def evaluate_encoding(directory: Union[str, Path],
     for i in loop1:
         loop2 = tqdm(range(i + 1, len(classes)), desc=f'estimating the inter-class distances for the class: {classes[i]}') if verbose else range(i + 1, len(classes))
         for j in loop2:
-            inter_distances[(classes[i], classes[j])] = inter_distance_function(concept_label_dir1=os.path.join(directory, classes[i]),
-                                                                            concept_label_dir2=os.path.join(directory, classes[j]))
+            inter_distances[(classes[i], classes[j])] = inter_distance_function(concepts_labels1=labels_per_cls[classes[i]],
+                                                                            concepts_labels2=labels_per_cls[classes[j]])
 
     max_kl_distances = np.zeros(shape=(len(classes), len(classes)))
     avg_kl_distances = np.zeros(shape=(len(classes), len(classes)))
@@ -277,18 +237,16 @@ def visualize_concepts_labels(directory: Union[str, Path],
     pu.seed_everything(seed=seed)
 
     # first extract the classes
-    classes = [c for c in os.listdir(directory) if c.endswith('_label')]
+    labels_per_cls = read_class_concept_labels(directory)
+    classes = list(labels_per_cls.keys())
     num_classes = len(classes)
     avg_per_cls = num_total_samples // num_classes
 
-    all_samples = torch.cat([torch.stack([torch.load(os.path.join(directory, c, f)) for f in os.listdir(os.path.join(directory, c))[:avg_per_cls]], 
-                                         dim=0)
-                            for c in classes], 
-                        dim=0)
+    all_samples = torch.cat([labels_per_cls[c][:avg_per_cls] for c in classes], dim=0)
 
     samples_per_cls = {}
     for i, c in enumerate(classes):
-        samples_per_cls[i] = min(len(os.listdir(os.path.join(directory, c))), avg_per_cls)
+        samples_per_cls[i] = min(len(labels_per_cls[c]), avg_per_cls)
 
     # create the TSNE class
     samples_embedded = TSNE(n_components=2,
@@ -317,23 +275,17 @@ def visualize_concepts_labels(directory: Union[str, Path],
     plt.savefig(os.path.join(vis_dir, f'{vis_title}.png'))
     plt.show()
 
-def _binary_vector_distribution(concept_label_dir: Union[str, Path]) -> np.ndarray:
-    concept_label_dir = dirf.process_path(concept_label_dir, 
-                                        file_ok=False, 
-                                        condition=lambda p: all([c.endswith('.pt') for c in os.listdir(p)]),
-                                        error_message='The directory is expected to have only the concept labels saved as tensors'
-                                        )
-    # TODO: rewrite the function to account for having a very large number of files in a given directory...
-    all_data = torch.stack([torch.load(os.path.join(concept_label_dir, c)) for c in os.listdir(concept_label_dir)])
-    res = all_data.mean(dim=0).numpy()
+def _binary_vector_distribution(concepts_labels: torch.Tensor) -> np.ndarray:
+    res = concepts_labels.mean(dim=0).numpy()
     return res
 
 def evaluate_binary_vector_distribution(directory: Union[str, Path]) -> pd.DataFrame:
     # first extract the classes
-    classes = [c for c in os.listdir(directory) if c.endswith('_label')]
+    labels_per_cls = read_class_concept_labels(directory)
+    classes = list(labels_per_cls.keys())
     
     # compute the distributions
-    distributions = torch.from_numpy(np.stack([_binary_vector_distribution(os.path.join(directory, c)) for c in classes]))
+    distributions = torch.from_numpy(np.stack([_binary_vector_distribution(labels_per_cls[c]) for c in classes]))
 
     n = len(classes)
 
@@ -365,8 +317,8 @@ def evaluate_concepts_labels(directory: Union[str, Path],
         raise NotImplementedError(f"The function expects distance as {'KL' or 'binary'}. Found: {distance}")
 
     # first extract the classes
-    cl_dirs = [c for c in os.listdir(directory) if c.endswith('_label')]
-    classes = [c for c in os.listdir(directory) if not c.endswith('_label')]
+    labels_per_cls = read_class_concept_labels(directory)
+    classes = list(labels_per_cls.keys())
 
 
     # determine the function used to compute 
@@ -377,7 +329,7 @@ def evaluate_concepts_labels(directory: Union[str, Path],
                                if distance == 'KL' else partial(binary_inter_cluster_distance, verbose=verbose, num_samples=num_samples))
 
     # compute the intra-class distances
-    intra_distances = {c[:c.find("_concept_label")]: intra_distance_function(os.path.join(directory, c)) for c in tqdm(cl_dirs, desc='estimating intra class distances')}
+    intra_distances = {c: intra_distance_function(labels_per_cls[c]) for c in tqdm(classes, desc='estimating intra class distances')}
 
     # instead of just computing the inter distances
 
@@ -387,5 +339,5 @@ def evaluate_concepts_labels(directory: Union[str, Path],
     for i in loop1:
         loop2 = tqdm(range(i + 1, len(classes)), desc=f'estimating the inter-class distances for the class: {classes[i]}') if verbose else range(i + 1, len(classes))
         for j in loop2:
-            inter_distances[(classes[i], classes[j])] = inter_distance_function(concept_label_dir1=os.path.join(directory, classes[i]),
-                                                                            concept_label_dir2=os.path.join(directory, classes[j]))
+            inter_distances[(classes[i], classes[j])] = inter_distance_function(concepts_labels1=labels_per_cls[classes[i]],
+                                                                            concepts_labels2=labels_per_cls[classes[j]])
@@ -1,7 +1,8 @@
 """
 This script contains some utility functions to better work with annotations of different tasks (currently on Object Detection annotation functions)
 """
-import itertools
+import itertools, torch
+import numpy as np
 
 from typing import Optional, Tuple, List, Union
 
@@ -10,6 +11,9 @@ IMG_SHAPE_TYPE = Tuple[int, int]
 
 OBJ_DETECT_ANN_TYPE = List[Union[float, int]]
 
+# a (N, 4) array of bounding boxes
+BBOX_ARRAY_TYPE = Union[np.ndarray, torch.Tensor]
+
 # the supported formats can be found in the following page of the albumentations documentation:
 # https://albumentations.ai/docs/getting_started/bounding_boxes_augmentation/
 
@@ -20,6 +24,9 @@ ALBUMENTATIONS = 'albumentations'
 
 OBJ_DETECT_ANN_FORMATS = [COCO, PASCAL_VOC, YOLO, ALBUMENTATIONS]
 
+# the formats expressed in pixels (the other ones are normalized by the image shape)
+_PIXEL_FORMATS = [COCO, PASCAL_VOC]
+
 
 DEFAULT_BBOX_BY_FORMAT = {COCO: [0, 0, 1, 1], YOLO: [0, 0, 0.1, 0.1], PASCAL_VOC: [0, 0, 1, 1], ALBUMENTATIONS: [0.0, 0.0, 0.1, 0.1]}
 
@@ -272,6 +279,12 @@ def _pascal_voc_2_albumentations(annotation: OBJ_DETECT_ANN_TYPE,
     return res 
 
 
+__conversion_dict = {(COCO, YOLO): _coco_2_yolo, (COCO, PASCAL_VOC): _coco_2_pascal_voc, (COCO, ALBUMENTATIONS): _coco_2_albumentations,
+                     (YOLO, COCO): _yolo_2_coco, (YOLO, PASCAL_VOC): _yolo_2_pascal_voc, (YOLO, ALBUMENTATIONS): _yolo_2_albumentations,
+                     (PASCAL_VOC, COCO): _pascal_voc_2_coco, (PASCAL_VOC, YOLO): _pascal_voc_2_yolo, (PASCAL_VOC, ALBUMENTATIONS): _pascal_voc_2_albumentations,
+                     (ALBUMENTATIONS, COCO): _albumentations_2_coco, (ALBUMENTATIONS, YOLO): _albumentations_2_yolo, (ALBUMENTATIONS, PASCAL_VOC): _albumentations_2_pascal_voc}
+
+
 def convert_bbox_annotation(annotation: OBJ_DETECT_ANN_TYPE, current_format: str, target_format: str, img_shape: IMG_SHAPE_TYPE) -> OBJ_DETECT_ANN_TYPE:
     if current_format not in OBJ_DETECT_ANN_FORMATS or target_format not in OBJ_DETECT_ANN_FORMATS:
         raise NotImplementedError(f"currently supporting only the following formats: {OBJ_DETECT_ANN_FORMATS}")
@@ -282,9 +295,310 @@ def convert_bbox_annotation(annotation: OBJ_DETECT_ANN_TYPE, current_format: str
         verify_object_detection_ann_format(annotation=annotation, current_format=current_format, img_shape=img_shape, normalize=False)
         return annotation
 
-    # definitely a bad practice...
-    return eval(f'_{current_format}_2_{target_format}')(annotation=annotation, img_shape=img_shape)
+    return __conversion_dict[(current_format, target_format)](annotation=annotation, img_shape=img_shape)
+
+
+
+######################################################## OBJECT DETECTION ARRAY API ########################################################
+# the functions below process a (N, 4) array (numpy or torch) of bounding boxes at once. 
+# They follow the exact same formulas (and rounding) as the single-box functions above
+
+def verify_object_detection_bboxes(annotations) -> np.ndarray:
+    """
+    The vectorized version of 'verify_object_detection_bbox': returns the annotations as a (N, 4) numpy array
+    """
+    if len(annotations) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    try:
+        arr = np.asarray(annotations)
+    except ValueError:
+        raise ValueError(f"Each bounding box annotation is expected to contain exactly 4 values (or 2 iterables of 2 values)")
+
+    if arr.dtype.kind not in 'iuf':
+        raise ValueError(f"the bounding boxes annotations are expected to be numerical values (4 per box). Found an array of type: {arr.dtype}")
+
+    if arr.shape[1:] not in [(4,), (2, 2)]:
+        raise ValueError(f"Each bounding box annotation is expected to contain exactly 4 values (or 2 iterables of 2 values). Found the shape: {arr.shape[1:]}")
+
+    return arr.reshape(len(arr), 4)
+
+
+def _round(x: BBOX_ARRAY_TYPE, decimals: int = 0) -> BBOX_ARRAY_TYPE:
+    # both numpy and torch round half to even (as python's built-in 'round')
+    if isinstance(x, torch.Tensor):
+        return torch.round(x, decimals=decimals)
+    return np.round(x, decimals)
+
+
+def _stack(columns: List[BBOX_ARRAY_TYPE]) -> BBOX_ARRAY_TYPE:
+    if isinstance(columns[0], torch.Tensor):
+        return torch.stack(columns, dim=1)
+    return np.stack(columns, axis=1)
+
+
+def _img_shape_columns(boxes: BBOX_ARRAY_TYPE, img_shapes) -> Tuple:
+    """
+    Returns the heights and widths as (N,) arrays (or scalars when a single shape is shared by all the boxes)
+    """
+    if isinstance(boxes, torch.Tensor):
+        shapes = torch.as_tensor(img_shapes, device=boxes.device)
+    else:
+        shapes = np.asarray(img_shapes)
+
+    if shapes.ndim == 1:
+        return shapes[0], shapes[1]
+
+    if shapes.ndim != 2 or len(shapes) != len(boxes):
+        raise ValueError(f"The image shapes are expected to be a single shape or one shape per box. Found {tuple(shapes.shape)} shapes for {len(boxes)} boxes")
+
+    return shapes[:, 0], shapes[:, 1]
+
+
+def _yolo_2_coco_columns(x_cn, y_cn, w_n, h_n, H, W):
+    w, h = _round(w_n * W), _round(h_n * H)
+    return _round((x_cn - w_n / 2) * W), _round((y_cn - h_n / 2) * H), w, h
+
+
+def _yolo_2_pascal_voc_columns(x_cn, y_cn, w_n, h_n, H, W):
+    x_min, y_min, w, h = _yolo_2_coco_columns(x_cn, y_cn, w_n, h_n, H, W)
+    return x_min, y_min, x_min + w, y_min + h
+
+
+def _albumentations_2_pascal_voc_columns(x_min_n, y_min_n, x_max_n, y_max_n, H, W):
+    return _round(x_min_n * W), _round(y_min_n * H), _round(x_max_n * W), _round(y_max_n * H)
+
+
+def _albumentations_2_coco_columns(x_min_n, y_min_n, x_max_n, y_max_n, H, W):
+    x_min, y_min, x_max, y_max = _albumentations_2_pascal_voc_columns(x_min_n, y_min_n, x_max_n, y_max_n, H, W)
+    return x_min, y_min, x_max - x_min, y_max - y_min
+
+
+__array_conversion_dict = {
+    (PASCAL_VOC, COCO): lambda x0, y0, x1, y1, H, W: (x0, y0, x1 - x0, y1 - y0),
+    (YOLO, COCO): _yolo_2_coco_columns,
+    (ALBUMENTATIONS, COCO): _albumentations_2_coco_columns,
+
+    (PASCAL_VOC, YOLO): lambda x0, y0, x1, y1, H, W: ((x0 + x1) / 2 / W, (y1 + y0) / 2 / H, (x1 - x0) / W, (y1 - y0) / H),
+    (COCO, YOLO): lambda x0, y0, w, h, H, W: ((x0 + w / 2) / W, (y0 + h / 2) / H, w / W, h / H),
+    (ALBUMENTATIONS, YOLO): lambda x0, y0, x1, y1, H, W: ((x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0),
+
+    (YOLO, PASCAL_VOC): _yolo_2_pascal_voc_columns,
+    (ALBUMENTATIONS, PASCAL_VOC): _albumentations_2_pascal_voc_columns,
+    (COCO, PASCAL_VOC): lambda x0, y0, w, h, H, W: (x0, y0, x0 + w, y0 + h),
+
+    (YOLO, ALBUMENTATIONS): lambda xc, yc, w, h, H, W: (_round(xc - w / 2, 4), _round(yc - h / 2, 4), _round(xc + w / 2, 4), _round(yc + h / 2, 4)),
+    (COCO, ALBUMENTATIONS): lambda x0, y0, w, h, H, W: (_round(x0 / W, 4), _round(y0 / H, 4), _round((x0 + w) / W, 4), _round((y0 + h) / H, 4)),
+    (PASCAL_VOC, ALBUMENTATIONS): lambda x0, y0, x1, y1, H, W: (_round(x0 / W, 4), _round(y0 / H, 4), _round(x1 / W, 4), _round(y1 / H, 4)),
+}
+
+
+def bbox_array_validity(boxes: BBOX_ARRAY_TYPE, current_format: str, img_shapes) -> BBOX_ARRAY_TYPE:
+    """
+    The vectorized version of 'verify_object_detection_ann_format': returns a (N,) boolean mask of the valid boxes
+    """
+    if current_format not in OBJ_DETECT_ANN_FORMATS:
+        raise NotImplementedError(f"The current format: {current_format} is not supported")
+
+    a, b, c, d = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+
+    if current_format in _PIXEL_FORMATS:
+        H, W = _img_shape_columns(boxes, img_shapes)
+        # the pixel formats expect integer coordinates
+        is_float = boxes.is_floating_point() if isinstance(boxes, torch.Tensor) else boxes.dtype.kind == 'f'
+        valid = (boxes == _round(boxes)).all(1) if is_float else (a == a)
+
+        if current_format == PASCAL_VOC:
+            return valid & (a < c) & (a >= 0) & (c <= W) & (c >= 1) & (b < d) & (b >= 0) & (d <= H) & (d >= 1)
+
+        return valid & (a >= 0) & (a <= W) & (b >= 0) & (b <= H) & (c > 0) & (c <= W) & (d > 0) & (d <= H)
+
+    # the normalized formats
+    valid = ((boxes >= 0) & (boxes <= 1)).all(1)
+
+    if current_format == ALBUMENTATIONS:
+        return valid & (a < c) & (b < d)
+
+    return valid & (a >= c / 2) & (a + c / 2 <= 1) & (b >= d / 2) & (b + d / 2 <= 1)
+
+
+def verify_bbox_array(boxes: BBOX_ARRAY_TYPE, current_format: str, img_shapes) -> BBOX_ARRAY_TYPE:
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError(f"The bounding boxes are expected to be a (N, 4) array. Found the shape: {tuple(boxes.shape)}")
+
+    valid = bbox_array_validity(boxes, current_format=current_format, img_shapes=img_shapes)
+
+    if not bool(valid.all()):
+        invalid = np.nonzero(np.asarray(valid.cpu() if isinstance(valid, torch.Tensor) else valid) == 0)[0]
+        raise ValueError(f"Found {len(invalid)} bounding boxes not satisfying the {current_format} format. The first one: index {invalid[0]}: {boxes[invalid[0]].tolist()}")
+
+    return boxes
+
+
+def convert_bbox_array(boxes: BBOX_ARRAY_TYPE, 
+                       current_format: str, 
+                       target_format: str, 
+                       img_shapes, 
+                       verify: bool = False) -> BBOX_ARRAY_TYPE:
+    """
+    Converts a (N, 4) array (numpy or torch) of bounding boxes from 'current_format' to 'target_format' in one vectorized call.
+
+    Args:
+        img_shapes: either a single image shape (height, width, ...) shared by all the boxes or a (N, 2) array: the shape of the image of each box
+        verify: whether to verify that the boxes satisfy the current format (always done when the two formats are the same)
+
+    Returns: a (N, 4) array of the same type as 'boxes'. The conversions from a normalized format to a pixel format return integers
+    """
+    if current_format not in OBJ_DETECT_ANN_FORMATS or target_format not in OBJ_DETECT_ANN_FORMATS:
+        raise NotImplementedError(f"currently supporting only the following formats: {OBJ_DETECT_ANN_FORMATS}")
+
+    if verify or current_format == target_format:
+        verify_bbox_array(boxes, current_format=current_format, img_shapes=img_shapes)
+
+    if current_format == target_format:
+        return boxes
+
+    H, W = _img_shape_columns(boxes, img_shapes) if len(boxes) > 0 else (1, 1)
+    res = _stack(list(__array_conversion_dict[(current_format, target_format)](boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], H, W)))
+
+    if target_format in _PIXEL_FORMATS and current_format not in _PIXEL_FORMATS:
+        res = res.long() if isinstance(res, torch.Tensor) else res.astype(np.int64)
+
+    return res
+
+
+######################################################## OBJECT DETECTION PAIRWISE KERNELS ########################################################
+# (N, M) pairwise properties between two sets of boxes computed as broadcast tensor operations. The boxes are converted to 
+# the pascal_voc format and the coordinates are treated as continuous: the area of a box is (x_max - x_min) * (y_max - y_min)
+# (as in 'bounding_boxes_intersect': two boxes sharing only an edge do not intersect)
+
+def _pascal_voc_tensor(boxes: BBOX_ARRAY_TYPE, current_format: str, img_shape: Optional[Tuple[int, int]]) -> torch.Tensor:
+    boxes = torch.as_tensor(boxes)
+
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError(f"The bounding boxes are expected to be a (N, 4) array. Found the shape: {tuple(boxes.shape)}")
+
+    if current_format != PASCAL_VOC:
+        if img_shape is None:
+            raise TypeError(f"processing bounding boxes in a format different from {PASCAL_VOC} requires passing the `img_shape` argument.")
+        boxes = convert_bbox_array(boxes, current_format=current_format, target_format=PASCAL_VOC, img_shapes=img_shape)
+
+    return boxes if boxes.is_floating_point() else boxes.float()
+
+
+def _area(boxes: torch.Tensor) -> torch.Tensor:
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+# the intersection and iou kernels accept leading batch dimensions: (..., N, 4) x (..., M, 4) -> (..., N, M)
+def _intersection_kernel(b1: torch.Tensor, b2: torch.Tensor) -> torch.Tensor:
+    top_left = torch.maximum(b1[..., :, None, :2], b2[..., None, :, :2])
+    bottom_right = torch.minimum(b1[..., :, None, 2:], b2[..., None, :, 2:])
+    wh = (bottom_right - top_left).clamp_(min=0)
+    return wh[..., 0] * wh[..., 1]
+
+
+def _iou_kernel(b1: torch.Tensor, b2: torch.Tensor) -> torch.Tensor:
+    inter = _intersection_kernel(b1, b2)
+    return inter / (_area(b1)[..., :, None] + _area(b2)[..., None, :] - inter)
+
+
+def _giou_kernel(b1: torch.Tensor, b2: torch.Tensor) -> torch.Tensor:
+    inter = _intersection_kernel(b1, b2)
+    union = _area(b1)[:, None] + _area(b2)[None, :] - inter
+
+    # the smallest box enclosing both boxes
+    wh = torch.maximum(b1[:, None, 2:], b2[None, :, 2:]) - torch.minimum(b1[:, None, :2], b2[None, :, :2])
+    enclosing = wh[..., 0] * wh[..., 1]
+
+    return inter / union - (enclosing - union) / enclosing
+
+
+def _containment_kernel(b1: torch.Tensor, b2: torch.Tensor) -> torch.Tensor:
+    return ((b1[:, None, 0] >= b2[None, :, 0]) & (b1[:, None, 1] >= b2[None, :, 1]) & 
+            (b1[:, None, 2] <= b2[None, :, 2]) & (b1[:, None, 3] <= b2[None, :, 3]))
+
+
+def _pairwise(kernel: callable, 
+              boxes1: BBOX_ARRAY_TYPE, 
+              boxes2: BBOX_ARRAY_TYPE, 
+              format1: str, 
+              format2: Optional[str], 
+              img_shape: Optional[Tuple[int, int]], 
+              chunk_size: Optional[int]) -> torch.Tensor:
+
+    b1 = _pascal_voc_tensor(boxes1, format1, img_shape)
+    b2 = _pascal_voc_tensor(boxes2, format2 if format2 is not None else format1, img_shape).to(b1.device)
+
+    if chunk_size is None or chunk_size >= len(b1):
+        return kernel(b1, b2)
+
+    if chunk_size <= 0:
+        raise ValueError(f"The chunk size must be positive. Found: {chunk_size}")
+
+    # only the output is (N, M): the intermediate tensors are (chunk_size, M)
+    out = None
+    for start in range(0, len(b1), chunk_size):
+        res = kernel(b1[start: start + chunk_size], b2)
+        if out is None:
+            out = torch.empty((len(b1), len(b2)), dtype=res.dtype, device=res.device)
+        out[start: start + len(res)] = res
+
+    return out
+
+
+def pairwise_intersection_area(boxes1: BBOX_ARRAY_TYPE, 
+                               boxes2: BBOX_ARRAY_TYPE, 
+                               format1: str = PASCAL_VOC, 
+                               format2: Optional[str] = None, 
+                               img_shape: Optional[Tuple[int, int]] = None, 
+                               chunk_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Returns a (N, M) tensor: the area of the intersection between boxes1[i] and boxes2[j]
+
+    Args:
+        format1, format2: the formats of the two sets of boxes ('format2' defaults to 'format1')
+        img_shape: the shape of the image, required for the formats other than pascal_voc
+        chunk_size: if passed, the rows of 'boxes1' are processed 'chunk_size' at a time (to bound the memory of the intermediate tensors)
+    """
+    return _pairwise(_intersection_kernel, boxes1, boxes2, format1, format2, img_shape, chunk_size)
+
+
+def pairwise_iou(boxes1: BBOX_ARRAY_TYPE, 
+                 boxes2: BBOX_ARRAY_TYPE, 
+                 format1: str = PASCAL_VOC, 
+                 format2: Optional[str] = None, 
+                 img_shape: Optional[Tuple[int, int]] = None, 
+                 chunk_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Returns a (N, M) tensor: the intersection over union between boxes1[i] and boxes2[j] (same arguments as 'pairwise_intersection_area')
+    """
+    return _pairwise(_iou_kernel, boxes1, boxes2, format1, format2, img_shape, chunk_size)
+
+
+def pairwise_giou(boxes1: BBOX_ARRAY_TYPE, 
+                  boxes2: BBOX_ARRAY_TYPE, 
+                  format1: str = PASCAL_VOC, 
+                  format2: Optional[str] = None, 
+                  img_shape: Optional[Tuple[int, int]] = None, 
+                  chunk_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Returns a (N, M) tensor: the generalized intersection over union (https://giou.stanford.edu/) between boxes1[i] and boxes2[j]
+    """
+    return _pairwise(_giou_kernel, boxes1, boxes2, format1, format2, img_shape, chunk_size)
+
 
+def pairwise_containment(boxes1: BBOX_ARRAY_TYPE, 
+                         boxes2: BBOX_ARRAY_TYPE, 
+                         format1: str = PASCAL_VOC, 
+                         format2: Optional[str] = None, 
+                         img_shape: Optional[Tuple[int, int]] = None, 
+                         chunk_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Returns a (N, M) boolean tensor: whether boxes1[i] lies within boxes2[j]. 
+    The pairs where one box lies within the other ('box_within_box'): mask | pairwise_containment(boxes2, boxes1).T
+    """
+    return _pairwise(_containment_kernel, boxes1, boxes2, format1, format2, img_shape, chunk_size)
 
 
 ######################################################## OBJECT DETECTION BOX GEOMETRIC PROPERTIES ########################################################
@@ -316,11 +630,11 @@ def box_within_box(bbox1: OBJ_DETECT_ANN_TYPE, bbox2: OBJ_DETECT_ANN_TYPE,
     x2_min, y2_min, x2_max, y2_max = b2
 
     # first case b1 in b2
-    if x1_min >= x2_min and x1_max <= x2_max and y1_min >= y2_min and y1_min <= y2_max:
+    if x1_min >= x2_min and x1_max <= x2_max and y1_min >= y2_min and y1_max <= y2_max:
         return True 
     
     # second case b2 in b1
-    if x2_min >= x1_min and x2_max <= x1_max and y2_min >= y1_min and y2_min <= y1_max:
+    if x2_min >= x1_min and x2_max <= x1_max and y2_min >= y1_min and y2_max <= y1_max:
         return True
     
     return False
@@ -0,0 +1,171 @@
+"""
+This script contains content hashes identifying the inputs of cached computations across runs: files, tensors, model weights,
+callables (with the values they capture) and datasets (through their listing).
+"""
+
+import types, hashlib, inspect, functools
+import torch
+import numpy as np
+
+from typing import Optional, Dict, Union
+from pathlib import Path
+from torch.utils.data import Dataset, ConcatDataset, Subset
+
+
+def hash_file(path: Union[str, Path], chunk_size: int = 2 ** 20) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_tensor(t: torch.Tensor) -> bytes:
+    # view the tensor as raw bytes: works for any dtype (including the ones numpy does not support such as bfloat16)
+    return t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+
+
+def hash_model(model: torch.nn.Module) -> str:
+    h = hashlib.sha1()
+    for name, t in model.state_dict().items():
+        h.update(name.encode())
+        h.update(hash_tensor(t))
+    return h.hexdigest()
+
+
+def _hash_code(code: types.CodeType) -> str:
+    # the nested functions (lambdas, comprehensions) are code objects whose repr contains their memory address: hash them recursively
+    consts = [_hash_code(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts]
+    return hashlib.sha1(code.co_code + repr(consts).encode() + repr(code.co_names).encode()).hexdigest()
+
+
+def hash_value(v, _depth: int = 0) -> str:
+    """
+    A content hash of a value captured by a callable: closure cells, default arguments, the arguments of a partial or the state of a bound instance
+    """
+    if _depth > 8:
+        # cyclic (or very deep) references
+        return f"{type(v).__module__}.{type(v).__qualname__}"
+
+    if v is None or isinstance(v, (bool, int, float, complex, str, bytes)):
+        return repr(v)
+
+    if isinstance(v, type):
+        return f"{v.__module__}.{v.__qualname__}"
+
+    if isinstance(v, types.ModuleType):
+        return v.__name__
+
+    if isinstance(v, torch.nn.Module):
+        return hash_model(v)
+
+    if isinstance(v, torch.Tensor):
+        return hashlib.sha1(f"{v.dtype}{tuple(v.shape)}".encode() + hash_tensor(v)).hexdigest()
+
+    if isinstance(v, np.ndarray):
+        return hashlib.sha1(f"{v.dtype}{v.shape}".encode() + np.ascontiguousarray(v).tobytes()).hexdigest()
+
+    if isinstance(v, (list, tuple)):
+        return "[" + ",".join(hash_value(x, _depth + 1) for x in v) + "]"
+
+    if isinstance(v, (set, frozenset)):
+        return "{" + ",".join(sorted(hash_value(x, _depth + 1) for x in v)) + "}"
+
+    if isinstance(v, dict):
+        return "{" + ",".join(sorted(f"{hash_value(k, _depth + 1)}:{hash_value(x, _depth + 1)}" for k, x in v.items())) + "}"
+
+    if callable(v):
+        return hash_callable(v, _depth=_depth + 1)
+
+    if hasattr(v, '__dict__'):
+        return f"{type(v).__module__}.{type(v).__qualname__}" + hash_value(vars(v), _depth + 1)
+
+    return repr(v)
+
+
+def hash_callable(c: Optional[callable], _depth: int = 0) -> str:
+    """
+    Identifies a callable by its code and the values it captures: two callables with the same code and different captured parameters 
+    (closures, default arguments, partial arguments, the state of a bound instance) have different hashes.
+    """
+    if c is None:
+        return ''
+
+    if isinstance(c, functools.partial):
+        parts = [hash_callable(c.func, _depth + 1), hash_value(c.args, _depth + 1), hash_value(c.keywords, _depth + 1)]
+
+    elif inspect.ismethod(c):
+        parts = [hash_callable(c.__func__, _depth + 1), hash_value(c.__self__, _depth + 1)]
+
+    elif getattr(c, '__code__', None) is not None:
+        # the bytecode (+ constants and names) of a function identifies it across runs better than its name (all lambdas are called '<lambda>')
+        closure = []
+        for cell in (c.__closure__ or []):
+            try:
+                closure.append(cell.cell_contents)
+            except ValueError:
+                # an empty cell
+                closure.append(None)
+
+        parts = [_hash_code(c.__code__), hash_value(closure, _depth + 1), hash_value(c.__defaults__, _depth + 1), hash_value(c.__kwdefaults__, _depth + 1)]
+
+    else:
+        # a callable object: the source of its class and its state
+        try:
+            src = inspect.getsource(type(c))
+        except (OSError, TypeError):
+            src = f"{type(c).__module__}.{type(c).__qualname__}"
+
+        parts = [src, hash_value(vars(c), _depth + 1) if hasattr(c, '__dict__') else '']
+
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+def dataset_fingerprint(dataset: Dataset) -> Optional[str]:
+    """
+    Identifies a dataset by its type, length, transforms and listing (the paths of its samples) when the listing is accessible
+    through one of the attributes used by the datasets in this package (or the torchvision ones).
+
+    Returns None when the listing is not accessible: two datasets of the same type and length cannot be told apart.
+    """
+    h = hashlib.sha1()
+    h.update(f"{type(dataset).__module__}.{type(dataset).__qualname__}:{len(dataset)}".encode())
+
+    # the same listing loaded with other transforms leads to other samples (the torchvision attributes and the concept datasets one)
+    for attr in ['transforms', 'transform', 'target_transform', 'image_transform']:
+        t = getattr(dataset, attr, None)
+        h.update(f"{attr}:{hash_callable(t) if t is not None else None}".encode())
+
+    # the reference set of the KNN classes is extended with a ConcatDataset and compacted with a Subset
+    if isinstance(dataset, ConcatDataset):
+        for d in dataset.datasets:
+            fp = dataset_fingerprint(d)
+            if fp is None:
+                return None
+            h.update(fp.encode())
+        return h.hexdigest()
+
+    if isinstance(dataset, Subset):
+        fp = dataset_fingerprint(dataset.dataset)
+        if fp is None:
+            return None
+        h.update(fp.encode())
+        h.update(np.asarray(dataset.indices, dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    listing = None
+    for attr in ['idx2path', 'idx2sample_path', 'samples', 'imgs', '_image_files']:
+        if hasattr(dataset, attr):
+            listing = getattr(dataset, attr)
+            break
+
+    if listing is None:
+        return None
+
+    if isinstance(listing, Dict):
+        listing = [listing[k] for k in sorted(listing.keys())]
+
+    for item in listing:
+        h.update(str(item).encode())
+
+    return h.hexdigest()
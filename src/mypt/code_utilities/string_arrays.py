@@ -0,0 +1,31 @@
+"""
+This script contains the conversion of lists of strings to (and from) numpy arrays that can be saved in '.npz' files without pickling.
+"""
+
+import numpy as np
+
+from typing import List
+
+
+def pack_strings(strings: List[str]) -> np.ndarray:
+    # a list of strings saved as a single uint8 array (much more compact than an array of python objects)
+    return np.frombuffer("\n".join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def unpack_strings(blob: np.ndarray) -> List[str]:
+    text = blob.tobytes().decode('utf-8')
+    return text.split("\n") if len(text) > 0 else []
+
+
+def string_offsets(blob: np.ndarray) -> np.ndarray:
+    # the (n + 1,) start offsets of the n strings packed in 'blob' (shifted by one past the end): string i is blob[offsets[i]: offsets[i + 1] - 1]
+    if len(blob) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.concatenate([[0], np.flatnonzero(blob == ord("\n")) + 1, [len(blob) + 1]]).astype(np.int64)
+
+
+def unpack_string_range(blob: np.ndarray, offsets: np.ndarray, start: int, end: int) -> List[str]:
+    # the strings [start, end) decoded without unpacking the whole blob
+    if end <= start:
+        return []
+    return blob[offsets[start]: offsets[end] - 1].tobytes().decode('utf-8').split("\n")
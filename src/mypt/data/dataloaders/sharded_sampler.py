@@ -0,0 +1,100 @@
+"""
+This script contains a deterministic sharded sampler for distributed (multi-process / multi-node) training.
+"""
+
+import math, torch
+import numpy as np
+import torch.distributed as dist
+
+from typing import Iterator, List, Optional, Union
+
+from torch.utils.data import Sampler
+
+
+class ShardedSampler(Sampler):
+    """
+    Each rank iterates over a disjoint partition of the dataset. The partition is reshuffled at every epoch ('set_epoch') and depends only
+    on the seed and the epoch: all ranks compute the same permutation without any communication.
+
+    With 'weights', each rank draws (with replacement) from its own partition with probabilities proportional to the weights of the
+    partition's samples: the samples drawn by the different ranks are still disjoint.
+
+    Call 'set_epoch' at the start of each epoch (as with torch.utils.data.DistributedSampler).
+    """
+    def __init__(self,
+                 dataset_size: int,
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 seed: int = 0,
+                 shuffle: bool = True,
+                 weights: Optional[Union[List[float], np.ndarray]] = None,
+                 drop_last: bool = False) -> None:
+
+        if num_replicas is None or rank is None:
+            if not (dist.is_available() and dist.is_initialized()):
+                raise ValueError(f"The 'num_replicas' and 'rank' arguments must be passed when the default process group is not initialized")
+            num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+            rank = dist.get_rank() if rank is None else rank
+
+        if not (0 <= rank < num_replicas):
+            raise ValueError(f"The rank must be in the range [0, {num_replicas}). Found: {rank}")
+
+        if weights is not None and len(weights) != dataset_size:
+            raise ValueError(f"The length of the `weights` iterable does not match the size of the dataset: Found: {len(weights)} weights and {dataset_size} samples")
+
+        self.dataset_size = dataset_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.shuffle = shuffle
+        self.weights = torch.as_tensor(weights, dtype=torch.float64) if weights is not None else None
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # every rank yields the same number of samples (otherwise the ranks would not run the same number of steps)
+        if drop_last:
+            self.num_samples = dataset_size // num_replicas
+        else:
+            self.num_samples = math.ceil(dataset_size / num_replicas)
+
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _partition(self, pad: bool = True) -> torch.Tensor:
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.dataset_size, generator=g)
+        else:
+            indices = torch.arange(self.dataset_size)
+
+        if not pad:
+            # the partitions are strictly disjoint (possibly of different sizes)
+            return indices[self.rank::self.num_replicas]
+
+        if self.drop_last:
+            indices = indices[:self.total_size]
+        elif self.total_size > self.dataset_size:
+            # pad with the first indices (repeated as many times as needed)
+            indices = torch.cat([indices, indices.repeat(math.ceil(self.total_size / self.dataset_size))[:self.total_size - self.dataset_size]])
+
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self) -> Iterator[int]:
+        if self.weights is None:
+            return iter(self._partition().tolist())
+
+        # the draws are done with replacement: no need to pad the partition
+        partition = self._partition(pad=False)
+
+        # a generator specific to the rank and the epoch
+        g = torch.Generator()
+        g.manual_seed((self.seed + self.epoch) * self.num_replicas + self.rank)
+
+        draws = torch.multinomial(self.weights[partition], num_samples=self.num_samples, replacement=True, generator=g)
+        return iter(partition[draws].tolist())
+
+    def __len__(self) -> int:
+        return self.num_samples
@@ -1,27 +1,166 @@
 """
 This script contain functionalities related to data loading shared among different tasks
 """
-import torch, warnings
+import os, json, time, torch, warnings
 import numpy as np
 
 from functools import partial
 from warnings import warn
-from typing import List, Optional
+from typing import List, Optional, Union, Dict
 
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import WeightedRandomSampler
 
+from ...code_utilities.fingerprints import dataset_fingerprint
 from ...code_utilities.pytorch_utilities import set_worker_seed
+from .sharded_sampler import ShardedSampler
+
+
+_DEFAULT_AUTOTUNE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'mypt', 'dataloader_autotune.json')
+# the configurations found during the current run (the file cache is shared across runs)
+_AUTOTUNE_CACHE: Dict[str, Dict] = {}
+
+
+def _probe_throughput(dataset_object: Dataset, 
+                      batch_size: int, 
+                      seed: int, 
+                      num_workers: int, 
+                      prefetch_factor: Optional[int], 
+                      pin_memory: bool, 
+                      num_batches: int, 
+                      collate_fn=None) -> float:
+    gen = torch.Generator()
+    gen.manual_seed(seed)
+
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = {"worker_init_fn": partial(set_worker_seed, seed=seed), "prefetch_factor": prefetch_factor}
+
+    dl = DataLoader(dataset=dataset_object, 
+                    shuffle=True, 
+                    drop_last=True, 
+                    batch_size=batch_size, 
+                    num_workers=num_workers, 
+                    pin_memory=pin_memory, 
+                    generator=gen, 
+                    collate_fn=collate_fn, 
+                    persistent_workers=False, 
+                    **kwargs)
+
+    it = iter(dl)
+    # the first batch includes the start up of the workers: it is not timed
+    next(it)
+
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)
+    elapsed = time.perf_counter() - start
+
+    del it
+    return num_batches * batch_size / elapsed
+
+
+def autotune_dataloader(dataset_object: Dataset,
+                        batch_size: int,
+                        seed: int = 0,
+                        candidate_num_workers: Optional[List[int]] = None,
+                        candidate_prefetch_factors: Optional[List[int]] = None,
+                        candidate_pin_memory: Optional[List[bool]] = None,
+                        num_batches: int = 10,
+                        collate_fn=None,
+                        cache_path: Optional[str] = _DEFAULT_AUTOTUNE_CACHE,
+                        use_cache: bool = True) -> Dict:
+    """
+    Runs a short timed probe (a few batches) for each combination of 'num_workers', 'prefetch_factor' and 'pin_memory'
+    and returns the fastest one. The choice is cached per dataset (its fingerprint), batch size and number of cpus.
+
+    The probes use their own generators: the data loaders created afterwards are not affected. 
+    The order of the samples does not depend on the chosen configuration.
+
+    The probe is shortened to the number of batches the dataset holds: a dataset of less than 2 batches is not probed and the 
+    default configuration (no workers) is returned.
+
+    Returns:
+        a dictionary with the keys 'num_workers', 'prefetch_factor', 'pin_memory', 'throughput' (samples per second) 
+        and 'results': the throughput of every probed configuration
+    """
+    # the first batch of each probe is not timed
+    num_batches = min(num_batches, len(dataset_object) // batch_size - 1)
+    if num_batches < 1:
+        return {"num_workers": 0, "prefetch_factor": None, "pin_memory": False, "throughput": None, "results": []}
+
+    cpu_count = os.cpu_count() or 1
+
+    # datasets without an accessible listing cannot be told apart: their configuration is not cached
+    fingerprint = dataset_fingerprint(dataset_object)
+    key = f"{fingerprint}:{batch_size}:{cpu_count}" if fingerprint is not None else None
+
+    if use_cache and key is not None:
+        if key not in _AUTOTUNE_CACHE and cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                _AUTOTUNE_CACHE.update(json.load(f))
+
+        if key in _AUTOTUNE_CACHE:
+            return _AUTOTUNE_CACHE[key]
+
+    if candidate_num_workers is None:
+        # the powers of 2 up to the number of cpus, and the number of cpus itself
+        candidate_num_workers = sorted({0, cpu_count} | {2 ** i for i in range(1, cpu_count.bit_length()) if 2 ** i <= cpu_count})
+
+    if candidate_prefetch_factors is None:
+        candidate_prefetch_factors = [2, 4]
+
+    if candidate_pin_memory is None:
+        # pinning the memory is only useful when the batches are moved to the GPU
+        candidate_pin_memory = [False, True] if torch.cuda.is_available() else [False]
+
+    results = []
+    for nw in candidate_num_workers:
+        # the prefetch factor is only defined with sub-processes
+        for pf in (candidate_prefetch_factors if nw > 0 else [None]):
+            for pm in candidate_pin_memory:
+                throughput = _probe_throughput(dataset_object, 
+                                               batch_size=batch_size, 
+                                               seed=seed, 
+                                               num_workers=nw, 
+                                               prefetch_factor=pf, 
+                                               pin_memory=pm, 
+                                               num_batches=num_batches, 
+                                               collate_fn=collate_fn)
+                results.append({"num_workers": nw, "prefetch_factor": pf, "pin_memory": pm, "throughput": throughput})
+
+    best = max(results, key=lambda r: r["throughput"])
+    config = {**best, "results": results}
+
+    if key is None:
+        return config
+
+    _AUTOTUNE_CACHE[key] = config
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        cached = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+        cached[key] = config
+        with open(cache_path, 'w') as f:
+            json.dump(cached, f)
+
+    return config
 
 
 def initialize_train_dataloader(dataset_object: Dataset, 
                         seed: int,
                         batch_size: int,
-                        num_workers: int,
+                        num_workers: Union[int, str],
                         weights: Optional[List[float] | np.ndarray] = None,
                         drop_last: bool = True,
                         warning: bool = True,
-                        pin_memory:bool = False
+                        pin_memory:bool = False,
+                        prefetch_factor: Optional[int] = None,
+                        distributed: bool = False,
+                        num_replicas: Optional[int] = None,
+                        rank: Optional[int] = None,
                         ) -> DataLoader:
     """This function initializes a dataloader making sure the data loading is reproducible across runs. 
 
@@ -29,8 +168,13 @@ def initialize_train_dataloader(dataset_object: Dataset,
         dataset_object (Dataset): The dataset to load / train on
         seed (int): The seed to assume reproducibility
         batch_size (int): 
-        num_workers (int): the number of sub-processes 
+        num_workers (int | str): the number of sub-processes. If set to 'auto', the number of workers, the prefetch factor and 'pin_memory'
+            are chosen by 'autotune_dataloader' (overriding the passed values)
         drop_last (bool, optional): whether to drop the last batch. Defaults to True.
+        distributed (bool, optional): whether each rank loads only its own (disjoint) shard of the dataset with a 'ShardedSampler'
+            (weighted per shard if 'weights' is passed). Make sure to call 'dl.sampler.set_epoch(epoch)' at the start of each epoch
+        num_replicas, rank (int, optional): the number of shards and the shard of the current process. 
+            Read from the default process group (torch.distributed) if not passed
 
     Returns:
         DataLoader: A dataloader assumed to load training data for a model
@@ -52,11 +196,26 @@ def initialize_train_dataloader(dataset_object: Dataset,
     if len(dataset_object) <= batch_size:
         warnings.warn(message=f"Found a dataset with size {len(dataset_object)} and a batch size : {batch_size}. Make sure there is no issue with dataset...")
 
+    if num_workers == 'auto':
+        config = autotune_dataloader(dataset_object, batch_size=batch_size, seed=seed)
+        num_workers, prefetch_factor, pin_memory = config['num_workers'], config['prefetch_factor'], config['pin_memory']
+
     # create the generator of the dataloader
     dl_train_gen = torch.Generator()
     dl_train_gen.manual_seed(seed)
 
-    if weights is not None:
+    if distributed:
+        # the partition is reshuffled at each epoch with the same seed on all ranks
+        sampler = ShardedSampler(dataset_size=len(dataset_object), 
+                                 num_replicas=num_replicas, 
+                                 rank=rank, 
+                                 seed=seed, 
+                                 shuffle=True, 
+                                 weights=weights)
+        generator = None
+        shuffle = None
+
+    elif weights is not None:
         
         # make sure the length of the weights is equal to the number of samples
         # apparently such a constraint is not explicitly enforced by Pytorch but might lead to several issues later down the line
@@ -90,10 +249,11 @@ def initialize_train_dataloader(dataset_object: Dataset,
                             worker_init_fn=partial(set_worker_seed, seed=seed), # this function ensures reproducibility between runs in multi-process setting 
                             generator=generator, 
                             persistent_workers=True,
+                            pin_memory=pin_memory,
+                            prefetch_factor=prefetch_factor if prefetch_factor is not None else 2,
                             sampler=sampler)
         return dl_train
 
-    # if the number of workers is set to '0', then the parameter 'pin_memory' will be set to True to improve performance
     # make sure to warn the user
     if warning:
         warn(message=f"the 'num_workers' argument is set to 0. The dataloader will be run by the main process !!!")
@@ -115,11 +275,18 @@ def initialize_train_dataloader(dataset_object: Dataset,
 def initialize_val_dataloader(dataset_object: Dataset, 
                         seed: int,
                         batch_size: int,
-                        num_workers: int,
+                        num_workers: Union[int, str],
                         warning:bool=True,
                         collate_fn=None,
+                        pin_memory: bool = False,
+                        prefetch_factor: Optional[int] = None,
                         ) -> DataLoader:
 
+    if num_workers == 'auto':
+        # same as 'initialize_train_dataloader'
+        config = autotune_dataloader(dataset_object, batch_size=batch_size, seed=seed, collate_fn=collate_fn)
+        num_workers, prefetch_factor, pin_memory = config['num_workers'], config['prefetch_factor'], config['pin_memory']
+
     dl_gen = torch.Generator()
     dl_gen.manual_seed(seed)
 
@@ -132,10 +299,11 @@ def initialize_val_dataloader(dataset_object: Dataset,
                             worker_init_fn=partial(set_worker_seed, seed=seed), # this function is used to ensure reproducibility between runs in multi-process setting 
                             generator=dl_gen,
                             collate_fn=collate_fn, 
-                            persistent_workers=True)
+                            persistent_workers=True,
+                            pin_memory=pin_memory,
+                            prefetch_factor=prefetch_factor if prefetch_factor is not None else 2)
         return dl
 
-    # if the number of workers is set to '0', then the parameter 'pin_memory' will be set to True to improve performance
     # make sure to warn the user
     if warning:
         warn(message=f"the 'num_workers' argument is 0.")
@@ -145,7 +313,7 @@ def initialize_val_dataloader(dataset_object: Dataset,
                         drop_last=False, 
                         batch_size=batch_size, 
                         num_workers=0,   
-                        pin_memory=False,
+                        pin_memory=pin_memory,
                         collate_fn=collate_fn) 
     
     return dl
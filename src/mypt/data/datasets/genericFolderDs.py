@@ -14,6 +14,9 @@ from torchvision.datasets import Food101, Imagenette
 from mypt.code_utilities import directories_and_files as dirf
 from mypt.shortcuts import P
 from mypt.data.datasets.mixins.cls_ds_wrapper import ClassificationDsWrapper
+from mypt.data.datasets.image_cache import DecodedImageCache
+from mypt.data.datasets.manifest import load_or_build_manifest
+from mypt.data.datasets.compiled_transforms import CompiledTransform
 
 
 class GenericFolderDS(Dataset):
@@ -32,7 +35,11 @@ class GenericFolderDS(Dataset):
     def __init__(self, 
                  root: P,
                  transforms: List,
-                 image_extensions: Union[List[str], Tuple[str]]=None):
+                 image_extensions: Union[List[str], Tuple[str]]=None,
+                 image_cache_bytes: int=0,
+                 image_cache_size: Optional[Tuple[int, int]]=None,
+                 image_cache_dir: Optional[P]=None,
+                 manifest_path: Optional[P]=None):
     
         super().__init__()
 
@@ -42,16 +49,18 @@ class GenericFolderDS(Dataset):
         
         self.image_extensions = image_extensions
 
-        # make sure the dataset can represents an image dataset
+        # the directory must already exist: the check that it contains only image files is done while building the manifest
         self.root = dirf.process_path(root, 
-                                      must_exist=True, # the directory must already exist
+                                      must_exist=True, 
                                       dir_ok=True, 
-                                      file_ok=False,
-                                      # the directory can contain only image files
-                                      condition=lambda d: dirf.dir_contains_only_types(d, valid_extensions=self.image_extensions) 
-                                      )     
+                                      file_ok=False)     
+        
+        # the manifest file (the listing of the directory) is reused across runs as long as the directory is not modified
+        self.manifest_path = manifest_path
     
         self.transforms = transforms
+        # the pipeline is built (and fused) once
+        self._transform = CompiledTransform(transforms)
 
         # create a path from indices to path samples
         self.idx2path : Dict = {}
@@ -60,30 +69,32 @@ class GenericFolderDS(Dataset):
         # make sure to call the build_index2path method
         self.build_index2path()
 
+        # an optional cache of the decoded (and optionally pre-resized) images
+        self.image_cache = None
+        if image_cache_bytes > 0 or image_cache_dir is not None:
+            self.image_cache = DecodedImageCache(sample_paths=[self.idx2path[i] for i in range(self.data_count)], 
+                                                 memory_bytes=image_cache_bytes, 
+                                                 image_size=image_cache_size, 
+                                                 spill_dir=image_cache_dir)
+
 
     def build_index2path(self):
-        counter = 0
-        for r, _, files in os.walk(self.root):
-            for f in files:
-                file_path = os.path.join(r, f)
-                self.idx2path[counter] = file_path 
-                counter += 1
+        # the sorted listing of the directory: loaded from the cached manifest when still valid (a single scan otherwise)
+        manifest, _ = load_or_build_manifest(self.root, image_extensions=self.image_extensions, manifest_path=self.manifest_path)
+        self.idx2path = dict(enumerate(manifest.absolute_paths()))
         # at this point every number maps to a sample path
-        self.data_count = counter    
+        self.data_count = len(manifest)
+
+    def _load_image(self, index: int):
+        if self.image_cache is None:
+            return self.load_sample(self.idx2path[index])
+        return self.image_cache.get_image(index, self.idx2path[index], self.load_sample)
 
     def __getitem__(self, index:int) -> torch.Tensor:
         # load the image
-        sample = self.load_sample(self.idx2path[index])
+        sample = self._load_image(index)
         # pass it through the passed transforms
-        try:
-            compound_tr = tr.Compose(self.transforms)
-            return compound_tr(sample)
-        except Exception:
-            # the fall-back approach, call each transformation sequentially
-            for t in self.transforms:
-                sample = t(sample)
-        
-        return sample
+        return self._transform(sample)
 
     def __len__(self)->int:
         if self.data_count is None or self.data_count == 0:
@@ -113,7 +124,7 @@ class GenericDsWrapper(ClassificationDsWrapper, Dataset):
         self.train = train
         self.samples_per_cls_map = {} # initialize the samples_per_cls_map to an empty dictionary
 
-        self.ds_transform = tr.Compose(augmentations)
+        self.ds_transform = CompiledTransform(augmentations)
 
     def __getitem__(self, index:int):
         if len(self.samples_per_cls_map) > 0:            
@@ -146,7 +157,7 @@ class Food101GenericWrapper(GenericDsWrapper):
 
         self._ds = Food101(root=root_dir,     
                          split='train' if train else 'test',
-                         transform=tr.Compose(self.augmentations),
+                         transform=self.ds_transform,
                          download=True)
 
         # call the self._set_samples_per_cls method after setting the self._ds field
@@ -0,0 +1,154 @@
+"""
+This script implements a cache of decoded images for the folder datasets: a byte-budgeted in-memory LRU of uint8 arrays
+backed by an (optional) memory-mapped uint8 file on the local disk. The file is shared by all the DataLoader workers:
+an image decoded by any worker is decoded only once.
+"""
+
+import os, json, hashlib
+import numpy as np
+
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict, Callable
+from PIL import Image
+
+from ...code_utilities import directories_and_files as dirf
+from ...shortcuts import P
+
+
+class DecodedImageCache:
+    """
+    Two tiers:
+        1. an in-memory LRU of decoded images limited to 'memory_bytes' bytes (per process: each worker has its own)
+        2. a memory-mapped file with one slot of shape (height, width, 3) per sample. The slots have a fixed size,
+        so the spill file requires the images to be pre-resized to 'image_size'.
+
+    A flag file marks the filled slots: a slot is flagged only after the image is written.
+    """
+    _data_file = 'images.u8'
+    _flags_file = 'flags.u8'
+    _meta_file = 'meta.json'
+
+    def __init__(self,
+                 sample_paths: List[P],
+                 memory_bytes: int = 0,
+                 image_size: Optional[Tuple[int, int]] = None,
+                 spill_dir: Optional[P] = None) -> None:
+
+        if memory_bytes < 0:
+            raise ValueError(f"The memory budget must be non-negative. Found: {memory_bytes}")
+
+        if spill_dir is not None and image_size is None:
+            raise ValueError(f"The spill file stores images of a fixed size: 'image_size' must be passed with 'spill_dir'")
+
+        self.num_samples = len(sample_paths)
+        self.memory_bytes = memory_bytes
+        # (height, width) as in the torchvision transforms
+        self.image_size = tuple(image_size) if image_size is not None else None
+
+        self._lru: OrderedDict = OrderedDict()
+        self._lru_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.spill_dir = None
+        self._data, self._flags = None, None
+
+        if spill_dir is not None:
+            self.spill_dir = dirf.process_path(spill_dir, dir_ok=True, file_ok=False)
+            self._init_spill_files(sample_paths)
+
+    def _init_spill_files(self, sample_paths: List[P]) -> None:
+        # the spill file is valid only for the same listing and image size: otherwise it is recreated
+        listing_hash = hashlib.sha1("\n".join(str(p) for p in sample_paths).encode()).hexdigest()
+        meta = {"num_samples": self.num_samples, "image_size": list(self.image_size), "listing": listing_hash}
+
+        meta_path = os.path.join(self.spill_dir, self._meta_file)
+
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                if json.load(f) == meta:
+                    return
+
+        # the files are created in the main process (before any worker is started)
+        h, w = self.image_size
+        np.lib.format.open_memmap(os.path.join(self.spill_dir, self._data_file), mode='w+', dtype=np.uint8, shape=(self.num_samples, h, w, 3)).flush()
+        np.lib.format.open_memmap(os.path.join(self.spill_dir, self._flags_file), mode='w+', dtype=np.uint8, shape=(self.num_samples,)).flush()
+
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def _spill_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        # opened lazily: each process (worker) maps the files itself
+        if self._data is None:
+            self._data = np.load(os.path.join(self.spill_dir, self._data_file), mmap_mode='r+')
+            self._flags = np.load(os.path.join(self.spill_dir, self._flags_file), mmap_mode='r+')
+        return self._data, self._flags
+
+    def __getstate__(self) -> Dict:
+        # the memory maps (and the in-memory images) are not sent to the workers
+        state = self.__dict__.copy()
+        state['_data'], state['_flags'] = None, None
+        state['_lru'], state['_lru_bytes'] = OrderedDict(), 0
+        return state
+
+    def _decode(self, sample_path: P, loader: Callable) -> np.ndarray:
+        img: Image.Image = loader(sample_path)
+        if self.image_size is not None:
+            h, w = self.image_size
+            img = img.resize((w, h), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8)
+
+    def _put_in_memory(self, index: int, array: np.ndarray) -> None:
+        if array.nbytes > self.memory_bytes:
+            return
+
+        self._lru[index] = array
+        self._lru_bytes += array.nbytes
+
+        # evict the least recently used images
+        while self._lru_bytes > self.memory_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_bytes -= evicted.nbytes
+
+    def get(self, index: int, sample_path: P, loader: Callable) -> np.ndarray:
+        """
+        Returns the decoded image as a (height, width, 3) uint8 array. 'loader' maps a path to a RGB PIL image
+        """
+        if index in self._lru:
+            self.hits += 1
+            self._lru.move_to_end(index)
+            return self._lru[index]
+
+        if self.spill_dir is not None:
+            data, flags = self._spill_arrays()
+
+            if flags[index]:
+                self.disk_hits += 1
+                array = np.array(data[index])
+                self._put_in_memory(index, array)
+                return array
+
+        self.misses += 1
+        array = self._decode(sample_path, loader)
+
+        if self.spill_dir is not None:
+            data[index] = array
+            flags[index] = 1
+
+        self._put_in_memory(index, array)
+        return array
+
+    def get_image(self, index: int, sample_path: P, loader: Callable) -> Image.Image:
+        # the datasets apply their transforms on PIL images
+        return Image.fromarray(self.get(index, sample_path, loader))
+
+    def stats(self) -> Dict[str, float]:
+        # the counters are per process: with DataLoader workers, each worker counts its own accesses
+        total = self.hits + self.disk_hits + self.misses
+        return {"hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total if total > 0 else 0.0,
+                "memory_bytes_used": self._lru_bytes}
@@ -0,0 +1,144 @@
+"""
+This script implements a cached manifest of an image directory: the sorted relative paths of the samples, their sizes and modification times.
+
+Scanning a directory with a large number of files (especially on network filesystems) is slow. The manifest is saved once and reused
+as long as no directory was modified: adding, removing or renaming a file changes the modification time of its parent directory,
+so checking the (few) directories is enough to validate the manifest.
+"""
+
+import os, hashlib
+import numpy as np
+
+from typing import List, Optional, Tuple
+
+from ...code_utilities import directories_and_files as dirf
+from ...code_utilities.string_arrays import pack_strings, unpack_strings
+from ...shortcuts import P
+
+
+_DEFAULT_MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mypt', 'manifests')
+
+
+class FolderManifest:
+    def __init__(self,
+                 root: str,
+                 paths: List[str],
+                 sizes: np.ndarray,
+                 mtimes: np.ndarray,
+                 dirs: List[str],
+                 dir_mtimes: np.ndarray) -> None:
+        self.root = root
+        # the paths of the samples relative to the root (sorted)
+        self.paths = paths
+        self.sizes = sizes
+        self.mtimes = mtimes
+        # the directories (relative to the root, the root being '.') and their modification times (ns) when the manifest was built
+        self.dirs = dirs
+        self.dir_mtimes = dir_mtimes
+
+    @classmethod
+    def build(cls, root: P, image_extensions: List[str]) -> 'FolderManifest':
+        """
+        Scans the directory once. Raises an error if a file does not have one of the image extensions.
+        """
+        root = str(root)
+        image_extensions = [e.lower() for e in image_extensions]
+
+        files, dirs = [], []
+        stack = ['.']
+        while len(stack) > 0:
+            rel_dir = stack.pop()
+            dirs.append((rel_dir, os.stat(os.path.join(root, rel_dir)).st_mtime_ns))
+
+            # os.scandir returns the file type (and on most systems the stat results) without an additional system call per entry
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                for entry in it:
+                    rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+                    if entry.is_dir():
+                        stack.append(rel_path)
+                        continue
+
+                    if os.path.splitext(entry.name)[1].lower() not in image_extensions:
+                        raise ValueError(f"The directory {root} is expected to contain only image data: specifically those extensions: {image_extensions}. Found: {rel_path}")
+
+                    st = entry.stat()
+                    files.append((rel_path, st.st_size, st.st_mtime_ns))
+
+        # sort the samples for reproducibility across systems
+        files.sort(key=lambda f: f[0])
+        dirs.sort(key=lambda d: d[0])
+
+        return cls(root=root,
+                   paths=[f[0] for f in files],
+                   sizes=np.asarray([f[1] for f in files], dtype=np.int64),
+                   mtimes=np.asarray([f[2] for f in files], dtype=np.int64),
+                   dirs=[d[0] for d in dirs],
+                   dir_mtimes=np.asarray([d[1] for d in dirs], dtype=np.int64))
+
+    def is_valid(self) -> bool:
+        # one 'stat' per directory (and not per file)
+        for d, mtime in zip(self.dirs, self.dir_mtimes):
+            try:
+                if os.stat(os.path.join(self.root, d)).st_mtime_ns != mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def save(self, path: P) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # write to a temporary file first: concurrent readers never see a partial manifest
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path,
+                 root=pack_strings([self.root]),
+                 paths=pack_strings(self.paths),
+                 sizes=self.sizes,
+                 mtimes=self.mtimes,
+                 dirs=pack_strings(self.dirs),
+                 dir_mtimes=self.dir_mtimes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: P) -> 'FolderManifest':
+        with np.load(path) as data:
+            return cls(root=unpack_strings(data['root'])[0],
+                       paths=unpack_strings(data['paths']),
+                       sizes=data['sizes'],
+                       mtimes=data['mtimes'],
+                       dirs=unpack_strings(data['dirs']),
+                       dir_mtimes=data['dir_mtimes'])
+
+    def absolute_paths(self) -> List[str]:
+        return [os.path.join(self.root, p) for p in self.paths]
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+def default_manifest_path(root: P, image_extensions: List[str]) -> str:
+    # the manifest is saved outside of the dataset directory: writing into it would modify the directory (and invalidate the manifest)
+    key = hashlib.sha1(f"{os.path.abspath(root)}:{sorted(e.lower() for e in image_extensions)}".encode()).hexdigest()
+    return os.path.join(_DEFAULT_MANIFEST_DIR, f"{key}.npz")
+
+
+def load_or_build_manifest(root: P,
+                           image_extensions: List[str],
+                           manifest_path: Optional[P] = None) -> Tuple[FolderManifest, bool]:
+    """
+    Returns the manifest of the directory and whether it was loaded from the disk (True) or built (False).
+    """
+    root = dirf.process_path(root, must_exist=True, dir_ok=True, file_ok=False)
+    manifest_path = manifest_path if manifest_path is not None else default_manifest_path(root, image_extensions)
+
+    if os.path.exists(manifest_path):
+        try:
+            manifest = FolderManifest.load(manifest_path)
+            if manifest.root == str(root) and manifest.is_valid():
+                return manifest, True
+        except (OSError, ValueError, KeyError):
+            # a corrupted manifest is simply rebuilt
+            pass
+
+    manifest = FolderManifest.build(root, image_extensions)
+    manifest.save(manifest_path)
+    return manifest, False
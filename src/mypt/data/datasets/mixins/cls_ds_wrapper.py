@@ -3,9 +3,11 @@ This script contains a number of mixins to extend the functionalities of standar
 """
 import warnings
 
-from typing import Dict, Tuple
+import numpy as np
+
+from typing import Dict, Tuple, Union
 from tqdm import tqdm
-from bisect import bisect
+
 
 class ClassificationDsWrapper:
     # a class attribute saving the attributes that child classes are expected to have
@@ -20,7 +22,7 @@ class ClassificationDsWrapper:
         # make sure the '_ds' attribute represents a classification dataset
         if len(self._ds) == 0:
             raise ValueError(f"The self._ds must have a positive length. Found: {len(self._ds)}")
-        
+
         if not (isinstance(self._ds[0], Tuple) and len(self._ds[0]) == 2):
             raise ValueError(f"The self._ds attribute is expected to represent a classification dataset; each item represents a tuple (image, class label)")
 
@@ -28,8 +30,29 @@ class ClassificationDsWrapper:
             raise TypeError(f"The self.samples_per_cls_map attribute is expected to be a dict. Found: {type(self.samples_per_cls_map)}")
 
 
-    def _set_samples_per_cls(self, 
-                             samples_per_cls: int, 
+    def _ds_labels(self) -> np.ndarray:
+        """
+        Returns the class labels of the wrapped dataset, read from its metadata when available (without loading any sample)
+        """
+        # ImageFolder / DatasetFolder
+        if hasattr(self._ds, 'targets'):
+            return np.asarray(self._ds.targets)
+
+        # Food101
+        if hasattr(self._ds, '_labels'):
+            return np.asarray(self._ds._labels)
+
+        # Imagenette (and the datasets saving a list of (path, label) tuples)
+        for attr in ['samples', '_samples']:
+            if hasattr(self._ds, attr):
+                return np.asarray([s[1] for s in getattr(self._ds, attr)])
+
+        # the fall-back approach: load every sample
+        return np.asarray([self._ds[i][1] for i in tqdm(range(len(self._ds)), desc="iterating through the dataset to extract the labels")])
+
+
+    def _set_samples_per_cls(self,
+                             samples_per_cls: int,
                              warning: bool = True) -> Dict:
 
         # first check the attributes
@@ -38,52 +61,42 @@ class ClassificationDsWrapper:
         if warning:
             warnings.warn("The `_set_samples_per_cls` expects consecutive samples to be of the same class. Make sure this assumption is satisfied. Otherwise the results would be erroneous")
 
-        # iterate through the dataset
-        current_cls = None
-        
-        last_pointer = 0
-        cls_count = 0
-
-        mapping = {0: 0}
-        
-        for i in tqdm(range(len(self._ds)), desc="iterating through the dataset to set the samples for each class"):
-            _, c = self._ds[i]
-            
-            if current_cls is None:
-                current_cls = c
-            
-            if current_cls == c:
-                cls_count += 1    
-
-                if cls_count == samples_per_cls:
-                    last_pointer = last_pointer + cls_count
-                    
+        labels = self._ds_labels()
 
-            else:
-                if cls_count <= samples_per_cls:
-                    last_pointer = last_pointer + cls_count
+        # the first index of each block of consecutive samples of the same class
+        starts = np.concatenate([[0], np.nonzero(labels[1:] != labels[:-1])[0] + 1])
+        counts = np.diff(np.concatenate([starts, [len(labels)]]))
 
-                mapping[last_pointer] = i 
+        # each block keeps (at most) 'samples_per_cls' samples in the wrapper
+        wrapper_starts = np.concatenate([[0], np.cumsum(np.minimum(counts, samples_per_cls))[:-1]])
 
-                cls_count = 1              
-                current_cls = c          
+        return dict(zip(wrapper_starts.tolist(), starts.tolist()))
 
-        return mapping
 
+    def _index_boundaries(self) -> Tuple[np.ndarray, np.ndarray]:
+        # the sorted boundaries are computed once for each 'samples_per_cls_map' (and not on every call)
+        if getattr(self, '_boundaries_map', None) is not self.samples_per_cls_map:
+            self._verify_attrs()
+            wrapper_starts = np.asarray(sorted(self.samples_per_cls_map.keys()), dtype=np.int64)
+            original_starts = np.asarray([self.samples_per_cls_map[k] for k in wrapper_starts.tolist()], dtype=np.int64)
 
-    def _find_final_index(self, index: int) -> int:
-        self._verify_attrs()
-        
-        # extract the indices of first samples of each class in the wrapper
-        cls_first_sample_indices = sorted(list(self.samples_per_cls_map.keys()))
+            self._boundaries = (wrapper_starts, original_starts)
+            self._boundaries_map = self.samples_per_cls_map
 
-        index_in_first_sample_list = bisect(cls_first_sample_indices, index) - 1
+        return self._boundaries
 
-        cls_index_first_sample_wrapper = cls_first_sample_indices[index_in_first_sample_list]
 
-        cls_index_first_sample_original = self.samples_per_cls_map[cls_index_first_sample_wrapper]
+    def find_final_indices(self, indices: Union[np.ndarray, list]) -> np.ndarray:
+        """
+        Maps a batch of indices of the wrapper (e.g. the indices returned by a batch sampler) to the indices of the wrapped dataset
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        wrapper_starts, original_starts = self._index_boundaries()
 
-        final_index = cls_index_first_sample_original + (index - cls_index_first_sample_wrapper)
+        # the block of each index: the last block starting at or before the index
+        blocks = np.searchsorted(wrapper_starts, indices, side='right') - 1
+        return original_starts[blocks] + (indices - wrapper_starts[blocks])
 
-        return final_index
 
+    def _find_final_index(self, index: int) -> int:
+        return int(self.find_final_indices([index])[0])
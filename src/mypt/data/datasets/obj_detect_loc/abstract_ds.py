@@ -1,20 +1,47 @@
-import os, warnings
+import os, pickle, warnings
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Union, Optional, Dict, Tuple, List
 from torch.utils.data import Dataset
 from PIL import Image
 from copy import copy
+from tqdm import tqdm
 
 from abc  import ABC, abstractmethod
 
 from mypt.code_utilities import bbox_utilities as au, directories_and_files as dirf
+from mypt.data.datasets.obj_detect_loc.annotation_table import AnnotationTable, annotations_key
 
 
 # let's define a common datatype
 my_iter = Union[Tuple, List]
 
+
+def _image_shape(sample_path: str) -> Tuple[int, int]:
+    # Image.open only reads the header of the file: the pixels are decoded lazily (and never here)
+    with Image.open(sample_path) as img:
+        w, h = img.size
+    return h, w
+
+
+def _read_annotation(image2annotation: Optional[callable], 
+                     label_type: type, 
+                     sample_path: str, 
+                     annotation: Optional[my_iter]) -> Tuple[List, np.ndarray, Tuple[int, int]]:
+    """
+    Reads (if not passed), verifies the annotation of a single image and returns the class labels, the (N, 4) array of boxes and the image shape.
+    Defined at the module level to be sent to the worker processes.
+    """
+    if annotation is None:
+        annotation = image2annotation(sample_path)
+
+    bboxes, _ = ObjectDataset._verify_single_label(annotation=annotation[:2], label_type=label_type)
+    img_shape = tuple(annotation[2])[:2] if len(annotation) == 3 else _image_shape(sample_path)
+    return list(annotation[0]), bboxes, img_shape
+
 class ObjectDataset(Dataset, ABC):
     """
     This dataset was designed as an abstract dataset for the object localization and detection tasks 
@@ -57,7 +84,8 @@ class ObjectDataset(Dataset, ABC):
                 if not isinstance(c, label_type):
                     raise ValueError(f"make sure all class labels are of the same type")
             
-        ann = [au.verify_object_detection_bbox(a) for a in ann]
+        # all the boxes of the image are verified at once: a (N, 4) array
+        ann = au.verify_object_detection_bboxes(ann)
         return ann, label_type
 
     @classmethod
@@ -101,7 +129,7 @@ class ObjectDataset(Dataset, ABC):
             if keys != img_files:
                 raise ValueError(f"Please make sure to pass an annotation to all files in the root directory.")
 
-            k, val = image2annotation.items()[0]
+            k, val = next(iter(image2annotation.items()))
 
         else:
             is_callable = True
@@ -119,81 +147,116 @@ class ObjectDataset(Dataset, ABC):
         if len(ann) not in [2, 3]:
             raise ValueError(f"The img2ann mapping returns an iterable of length different from 2 and 3: {ann}")
         
-        self._verify_single_label(annotation=val[:2])
+        _, label_type = self._verify_single_label(annotation=val[:2])
 
         if len(val) == 2:
-            # first raise a warning letting the user know that passing only the annotation would require laoding the samples to extract their shapes
+            # first raise a warning letting the user know that passing only the annotation would require opening all the samples to extract their shapes
             # which is preferably avoided
-            warnings.warn(message=f"not passing the image shape requires loading all the samples !!")    
+            warnings.warn(message=f"not passing the image shape requires reading the header of all the samples !!")    
 
-        return is_callable
+        return is_callable, label_type
 
 
-    def __set_img_annotations(self, 
-                               image2annotation: Union[Dict, callable],
-                               current_format: Optional[str], 
-                               convert: callable):
-
+    def __read_annotations(self, 
+                           img_paths: List[str],
+                           image2annotation: Union[Dict, callable],
+                           num_workers: int) -> Tuple[List[List], List[np.ndarray], List[Tuple[int, int]]]:
         # let's verify that the mapping corresponds to the expected format
-        is_callable = self.__verify_img_annotation_map(image2annotation=image2annotation)
+        is_callable, label_type = self.__verify_img_annotation_map(image2annotation=image2annotation)
 
-        # copy the mapping to avoid modifying the input
         if is_callable:
-            # build a dictionary between the sample path and its annotation
-            img_files = [os.path.join(self.root_dir, img) for img in os.listdir(self.root_dir)]
-            img_annotations = {f: image2annotation(f) for f in img_files}
+            reader, annotations = image2annotation, [None] * len(img_paths)
         else:
-            img_annotations = image2annotation.copy()
+            mapping = {(k if os.path.isabs(k) else os.path.join(self.root_dir, k)): v for k, v in image2annotation.items()}
+            reader, annotations = None, [mapping[p] for p in img_paths]
 
-        # since dict.items() method is not subscriptable, to get a random element, one needs to convert the entire dictionary either to a list or an iterator
-        # which is computationally inefficient
-        
-        for key, annotation in img_annotations.items():
-            _, cls_label_type = self._verify_single_label(annotation=annotation[:2])
-            break # breaking after one iteration, as only the one label type is needed
-        
-        for key, annotation in img_annotations.items():
-            flattened_ann, _ = self._verify_single_label(annotation=annotation[:2], label_type=cls_label_type)
-            img_annotations[key] = [annotation[0], flattened_ann] + list(annotation[2:])
+        if num_workers > 0:
+            try:
+                pickle.dumps(reader)
+            except Exception:
+                warnings.warn(message=f"The 'image2annotation' callable cannot be sent to worker processes (it cannot be pickled). Reading the annotations serially")
+                num_workers = 0
+
+        read = partial(_read_annotation, reader, label_type)
+
+        # each annotation is verified exactly once (and the image shapes are read from the headers when missing)
+        if num_workers > 0:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                chunksize = max(1, len(img_paths) // (num_workers * 16))
+                results = list(tqdm(executor.map(read, img_paths, annotations, chunksize=chunksize), total=len(img_paths), desc='reading the annotations'))
+        else:
+            results = [read(p, a) for p, a in tqdm(zip(img_paths, annotations), total=len(img_paths), desc='reading the annotations')]
 
-        # annotations verified !! final step: convert to the target format
-        for img_path, img_ann in img_annotations.items():
-            
-            if len(img_ann) == 3:
-                # load the image shape  
-                cls_ann, bbox_ann, img_shape = img_ann
-            else:
-                img_shape = (np.asarray(self.load_sample(img_path)).shape)[:2] # self.load_sample return a PIL.Image, convert to numpy array of shape [w, h, 3]
-                cls_ann, bbox_ann = img_ann
-
-            if current_format is not None:
-                # the bbox annotation supposedly contains the bounding box for each object in the image
-                # convert each bounding box to the target format
-                bbox_ann = [au.convert_bbox_annotation(annotation=b, 
-                                                    current_format=current_format,
-                                                    target_format=self.target_format, 
-                                                    img_shape=img_shape) 
-                                                    for b in bbox_ann]
-            else:
+        cls_labels, bboxes, img_shapes = zip(*results) if len(results) > 0 else ([], [], [])
+        return list(cls_labels), list(bboxes), list(img_shapes)
+
+
+    def __set_img_annotations(self, 
+                               image2annotation: Union[Dict, callable],
+                               current_format: Optional[str], 
+                               convert: callable,
+                               num_workers: int,
+                               annotations_cache: Optional[Union[str, Path]]) -> AnnotationTable:
+
+        img_paths = sorted([os.path.join(self.root_dir, img) for img in os.listdir(self.root_dir)])
+
+        if annotations_cache is not None:
+            key = annotations_key(self.root_dir, 
+                                  img_paths, 
+                                  current_format=current_format, 
+                                  target_format=self.target_format, 
+                                  image2annotation=image2annotation, 
+                                  convert=convert)
+            table = AnnotationTable.load(annotations_cache, key=key)
+            if table is not None and len(table) == len(img_paths):
+                return table
+
+        table = self.__convert_annotations(img_paths, *self.__read_annotations(img_paths, image2annotation, num_workers), current_format, convert)
+
+        if annotations_cache is not None:
+            table.save(annotations_cache, key=key)
+
+        return table
+
+
+    def __convert_annotations(self, 
+                              img_paths: List[str], 
+                              cls_labels: List[List], 
+                              bboxes: List[np.ndarray], 
+                              img_shapes: List[Tuple[int, int]],
+                              current_format: Optional[str],
+                              convert: callable) -> AnnotationTable:
+        if current_format is not None:
+            # the boxes of all the images are converted in a single vectorized call (each box with the shape of its image)
+            counts = np.asarray([len(b) for b in bboxes], dtype=np.int64)
+
+            all_boxes = np.concatenate(bboxes, axis=0) if len(img_paths) > 0 else np.zeros((0, 4))
+            all_boxes = au.convert_bbox_array(all_boxes, 
+                                              current_format=current_format, 
+                                              target_format=self.target_format, 
+                                              img_shapes=np.repeat(np.asarray(img_shapes, dtype=np.int64).reshape(-1, 2), counts, axis=0))
+
+            return AnnotationTable.from_lists(cls_labels, np.split(all_boxes, np.cumsum(counts)[:-1]) if len(counts) > 0 else [])
+
+        converted = []
+        for bbox_ann, img_shape in zip(bboxes, img_shapes):
+            bbox_ann = bbox_ann.tolist()
+            try:
+                bbox_ann = [convert(b, img_shape=img_shape) for b in bbox_ann]
+            except:
                 try:
-                    bbox_ann = [convert(b, img_shape=img_shape) for b in bbox_ann]
+                    bbox_ann = [convert(b) for b in bbox_ann]
                 except:
-                    try:
-                        bbox_ann = [convert(b) for b in bbox_ann]
-                    except:
-                        raise ValueError(f"the 'convert' callable should accept only the bounding box as an input or bbox + the shape of the image as a keyword argument: 'img_shape'")
+                    raise ValueError(f"the 'convert' callable should accept only the bounding box as an input or bbox + the shape of the image as a keyword argument: 'img_shape'")
 
-            img_annotations[img_path] = [cls_ann, bbox_ann]
+            converted.append(bbox_ann)
 
-        return img_annotations
+        return AnnotationTable.from_lists(cls_labels, converted)
 
 
     def __set_indices(self):
-        self.all_classes = set()
-        # save all the classes in the data
-        for _, v in self.annotations.items():
-            cls_ann, _ = v
-            self.all_classes.update([c.lower() for c in cls_ann])
+        # the vocabulary of the annotation table contains all the classes in the data
+        self.all_classes = set([c.lower() for c in self.annotations.classes])
 
         self.cls_2_cls_index = dict([(c, i) for i, c in enumerate(sorted(list([c for c in self.all_classes if c != self.background_label])), start=0)])
         self.cls_2_cls_index[self.background_label] = len(self.cls_2_cls_index)
@@ -203,6 +266,9 @@ class ObjectDataset(Dataset, ABC):
         self.all_classes = sorted([k for k, _ in self.cls_2_cls_index.items()], key=self.cls_2_cls_index.get)
         assert self.all_classes[-1] == self.background_label, "make sure the background label is placed at the last position in the self.all_classes list"
 
+        # maps the class ids of the annotation table to the class indices
+        self.class_id_2_cls_index = np.asarray([self.cls_2_cls_index[c.lower()] for c in self.annotations.classes], dtype=np.int64)
+
     def __init__(self,
                  root_dir: Union[str, Path],
 
@@ -213,8 +279,17 @@ class ObjectDataset(Dataset, ABC):
                  background_label:Union[int, str],
 
                  convert: Optional[callable]=None,
-                 image_extensions: Optional[List[str]]=None
+                 image_extensions: Optional[List[str]]=None,
+                 num_workers: int = 0,
+                 annotations_cache: Optional[Union[str, Path]]=None
                 ) -> None:
+        """
+        Args:
+            num_workers: the number of processes reading and verifying the annotations (0: in the main process). 
+                A callable 'image2annotation' must be picklable to be used by the worker processes.
+            annotations_cache: the path to a file with the normalized annotations: loaded if it exists (and was built for the same directory, formats
+                and annotations: see 'annotations_key'), written otherwise.
+        """
         # init the parent class
         super().__init__()
 
@@ -240,9 +315,12 @@ class ObjectDataset(Dataset, ABC):
         self.target_format = target_format
 
         ######################### annotation verification #########################
+        # the annotations of the i-th sample (self.idx2sample_path[i]) are the i-th row of the table
         self.annotations = self.__set_img_annotations(image2annotation, 
                                                         current_format, 
-                                                        convert)
+                                                        convert,
+                                                        num_workers=num_workers,
+                                                        annotations_cache=annotations_cache)
 
         ######################### class conversion #########################        
         self.idx2sample_path = dict(enumerate(sorted([os.path.join(self.root_dir, img) for img in os.listdir(self.root_dir)])))
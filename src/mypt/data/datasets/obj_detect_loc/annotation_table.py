@@ -0,0 +1,121 @@
+"""
+This script implements the columnar storage of the annotations of an ObjectDataset: the boxes of all the images concatenated in a single
+(total_boxes, 4) float32 array, split by an offsets array, and the class labels as integer ids into a (small) vocabulary.
+
+Compared to a dictionary of python lists, the table holds a handful of arrays: it is compact in memory, pickled to the DataLoader workers
+as raw buffers, and forked workers do not touch (and copy) millions of python objects. The same columns are saved as the on-disk cache
+that later constructions of the dataset load instead of reading and converting the annotations again.
+"""
+
+import os, hashlib
+import numpy as np
+
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from mypt.code_utilities.fingerprints import hash_callable, hash_value
+from mypt.code_utilities.string_arrays import pack_strings, unpack_strings
+from mypt.shortcuts import P
+
+
+def annotations_key(root_dir: str, 
+                    img_paths: List[str], 
+                    current_format: Optional[str], 
+                    target_format: str,
+                    image2annotation: Union[Dict, callable],
+                    convert: Optional[callable] = None) -> str:
+    """
+    Identifies the annotations by the directory, its listing, the formats and the source of the annotations: the content of 
+    the 'image2annotation' dictionary, or the code (and captured values) of the 'image2annotation' and 'convert' callables.
+    The files a callable reads the annotations from are not part of the key: delete the cache file after modifying them.
+    """
+    h = hashlib.sha1()
+    h.update(f"{os.path.abspath(root_dir)}:{current_format}:{target_format}".encode())
+    h.update("\n".join(os.path.relpath(p, root_dir) for p in img_paths).encode())
+    h.update(hash_value(image2annotation).encode() if isinstance(image2annotation, Dict) else hash_callable(image2annotation).encode())
+    h.update(hash_callable(convert).encode())
+    return h.hexdigest()
+
+
+class AnnotationTable:
+    __slots__ = ('offsets', 'boxes', 'class_ids', 'classes')
+
+    def __init__(self, offsets: np.ndarray, boxes: np.ndarray, class_ids: np.ndarray, classes: List) -> None:
+        if len(offsets) == 0 or offsets[0] != 0 or offsets[-1] != len(boxes) or len(boxes) != len(class_ids):
+            raise ValueError(f"The offsets must start at 0 and end at the number of boxes. Found offsets ending at {offsets[-1] if len(offsets) else None}, {len(boxes)} boxes and {len(class_ids)} class ids")
+
+        # the annotations of the i-th image are the rows offsets[i]: offsets[i + 1]
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.class_ids = np.ascontiguousarray(class_ids, dtype=np.int64)
+        # the vocabulary of the class labels (as passed by the user)
+        self.classes = classes
+
+    @classmethod
+    def from_lists(cls, cls_labels: Sequence[Sequence], bboxes: Sequence[Sequence]) -> 'AnnotationTable':
+        """
+        Args:
+            cls_labels: the class labels of each image
+            bboxes: the boxes of each image: a (N_i, 4) array or a list of N_i boxes
+        """
+        counts = np.asarray([len(b) for b in bboxes], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        # numpy scalars (e.g. the labels of an array) are converted to python ints and strings: the only label types saved in the cache
+        labels = [c.item() if isinstance(c, np.generic) else c for image_labels in cls_labels for c in image_labels]
+        classes = sorted(set(labels), key=str)
+        cls_index = {c: i for i, c in enumerate(classes)}
+
+        boxes = np.concatenate([np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in bboxes], axis=0) if len(bboxes) > 0 else np.zeros((0, 4))
+
+        return cls(offsets=offsets, boxes=boxes, class_ids=np.asarray([cls_index[c] for c in labels], dtype=np.int64), classes=classes)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def boxes_of(self, index: int) -> np.ndarray:
+        # a view: no copy
+        return self.boxes[self.offsets[index]: self.offsets[index + 1]]
+
+    def class_ids_of(self, index: int) -> np.ndarray:
+        return self.class_ids[self.offsets[index]: self.offsets[index + 1]]
+
+    def __getitem__(self, index: int) -> Tuple[List, np.ndarray]:
+        return [self.classes[i] for i in self.class_ids_of(index).tolist()], self.boxes_of(index)
+
+    def save(self, path: P, key: str) -> None:
+        label_type = type(self.classes[0]).__name__ if len(self.classes) > 0 else 'str'
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # write to a temporary file first: concurrent readers never see a partial cache
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path,
+                 key=pack_strings([key]),
+                 label_type=pack_strings([label_type]),
+                 classes=pack_strings([str(c) for c in self.classes]),
+                 offsets=self.offsets,
+                 class_ids=self.class_ids,
+                 boxes=self.boxes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: P, key: str) -> Optional['AnnotationTable']:
+        """
+        Returns None if the cache is missing, corrupted or was built for other annotations.
+        """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                if unpack_strings(data['key']) != [key]:
+                    return None
+
+                label_type = {'int': int, 'str': str}[unpack_strings(data['label_type'])[0]]
+                return cls(offsets=data['offsets'],
+                           boxes=data['boxes'],
+                           class_ids=data['class_ids'],
+                           classes=[label_type(c) for c in unpack_strings(data['classes'])])
+
+        except (OSError, ValueError, KeyError):
+            # a corrupted cache is simply rebuilt
+            return None
@@ -32,6 +32,8 @@ class ObjectLocalizationDs(ObjectDataset):
                  convert: Optional[callable]=None,
                  image_extensions: Optional[List[str]]=None,
                  seed:int=69,
+                 num_workers: int = 0,
+                 annotations_cache: Optional[Union[str, Path]]=None,
                 ) -> None:
 
         # init the parent class
@@ -42,7 +44,9 @@ class ObjectLocalizationDs(ObjectDataset):
                     convert=convert,
 
                     background_label=background_label,
-                    image_extensions=image_extensions
+                    image_extensions=image_extensions,
+                    num_workers=num_workers,
+                    annotations_cache=annotations_cache
                     )   
 
         pu.seed_everything(seed=seed)
@@ -78,24 +82,24 @@ class ObjectLocalizationDs(ObjectDataset):
         # load the sample
         sample_path = self.idx2sample_path[index]
         img = np.asarray(self.load_sample(sample_path).copy()) # albumentations requires the input to a numpy array
-        # fetch the bounding boxes and the class labels
-        cls_labels, bboxes = self.annotations[sample_path]
+        # fetch the bounding boxes and the class indices (views on the annotation table: no copy)
+        bboxes = self.annotations.boxes_of(index)
+        cls_indices = self.class_id_2_cls_index[self.annotations.class_ids_of(index)]
 
-        if len(cls_labels) > 1 or len(bboxes) > 1:
+        if len(cls_indices) > 1 or len(bboxes) > 1:
             raise ValueError(f"found a sample with more than one cls or bounding box !!!")
 
         # pass the sample through the final augmentation
-        transform = self.final_aug(image=img, bboxes=bboxes, cls_labels=cls_labels)
+        transform = self.final_aug(image=img, bboxes=bboxes, cls_labels=cls_indices.tolist())
 
         # fetch the labels after augmentations
-        img, cls_labels, bboxes = transform['image'], transform['cls_labels'][0], transform['bboxes'][0]
+        img, cls_label_index, bboxes = transform['image'], transform['cls_labels'][0], transform['bboxes'][0]
 
         # convert the image to a torch tensor 
         img = tr.ToTensor()(img.copy())
         
         # first the object indicator: a boolean flat indicating whether there is an object of interest on the image or not
-        object_indicator = int(cls_labels != self.background_label)
-        cls_label_index = self.cls_2_cls_index[cls_labels]
+        object_indicator = int(cls_label_index != self.cls_2_cls_index[self.background_label])
     
         if self.compact:
             # one-hot encode the label
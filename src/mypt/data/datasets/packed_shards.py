@@ -0,0 +1,222 @@
+"""
+This script implements a packed format for image directories: the encoded image files are concatenated into a few large shard files
+and an offset index maps each sample to its shard, offset and length. Reading a sample is a slice of a memory-mapped shard
+(no directory listing, no per-file open).
+
+Two layouts are supported:
+    1. 'flat': any directory of images (as in GenericFolderDS and ParallelAugDirDs): the samples are sorted by their relative path
+    2. 'class_folders': one sub-directory per class (as in ImageFolder and AbstractConceptDataset.find_classes): the classes are sorted
+    alphabetically and the samples of each class are sorted by file name
+"""
+
+import io, os, json, math, torch
+import numpy as np
+
+from typing import List, Optional, Tuple, Union, Iterator
+from PIL import Image
+from torch.utils.data import Dataset, Sampler
+
+from ...code_utilities import directories_and_files as dirf
+from ...shortcuts import P
+from .compiled_transforms import CompiledTransform
+
+
+_INDEX_FILE = 'index.npz'
+_META_FILE = 'meta.json'
+
+
+def _shard_name(shard_id: int) -> str:
+    return f"shard_{shard_id:05d}.bin"
+
+
+def _list_samples(src_dir: str,
+                  layout: str,
+                  image_extensions: List[str],
+                  ignore_dirs_ending: Optional[str]) -> Tuple[List[str], List[int], List[str]]:
+    if layout == 'flat':
+        paths = []
+        for r, _, files in os.walk(src_dir):
+            paths.extend(os.path.relpath(os.path.join(r, f), src_dir) for f in files if os.path.splitext(f)[1].lower() in image_extensions)
+        return sorted(paths), [-1] * len(paths), []
+
+    classes = sorted(d for d in os.listdir(src_dir)
+                     if os.path.isdir(os.path.join(src_dir, d)) and not (ignore_dirs_ending is not None and d.endswith(ignore_dirs_ending)))
+
+    paths, labels = [], []
+    for cls_index, cls in enumerate(classes):
+        files = sorted(f for f in os.listdir(os.path.join(src_dir, cls)) if os.path.splitext(f)[1].lower() in image_extensions)
+        paths.extend(os.path.join(cls, f) for f in files)
+        labels.extend([cls_index] * len(files))
+
+    return paths, labels, classes
+
+
+def pack_directory(src_dir: P,
+                   output_dir: P,
+                   images_per_shard: int = 10000,
+                   layout: str = 'flat',
+                   image_extensions: Optional[List[str]] = None,
+                   ignore_dirs_ending: Optional[str] = None) -> int:
+    """
+    Packs the images of 'src_dir' into shards of (at most) 'images_per_shard' images saved in 'output_dir'.
+    The encoded bytes are copied as they are: the shards take (about) the same space as the original files.
+
+    Args:
+        layout: either 'flat' or 'class_folders'
+        ignore_dirs_ending: with the 'class_folders' layout, the sub-directories ending with this suffix are not considered classes
+            (e.g. the concept labels directories of the concept datasets: 'AbstractConceptDataset.concept_label_ending')
+
+    Returns: the number of packed images
+    """
+    if layout not in ['flat', 'class_folders']:
+        raise NotImplementedError(f"The supported layouts are 'flat' and 'class_folders'. Found: {layout}")
+
+    if images_per_shard <= 0:
+        raise ValueError(f"The number of images per shard must be positive. Found: {images_per_shard}")
+
+    src_dir = dirf.process_path(src_dir, must_exist=True, dir_ok=True, file_ok=False)
+    output_dir = dirf.process_path(output_dir, dir_ok=True, file_ok=False,
+                                   condition=lambda d: len(os.listdir(d)) == 0,
+                                   error_message="The output directory must be empty")
+
+    image_extensions = [e.lower() for e in (image_extensions if image_extensions is not None else dirf.IMAGE_EXTENSIONS)]
+    paths, labels, classes = _list_samples(src_dir, layout, image_extensions, ignore_dirs_ending)
+
+    if len(paths) == 0:
+        raise ValueError(f"The directory {src_dir} does not contain any image with the extensions: {image_extensions}")
+
+    shard_ids = np.empty(len(paths), dtype=np.int32)
+    offsets = np.empty(len(paths), dtype=np.int64)
+    lengths = np.empty(len(paths), dtype=np.int64)
+
+    for shard_id in range(math.ceil(len(paths) / images_per_shard)):
+        offset = 0
+        with open(os.path.join(output_dir, _shard_name(shard_id)), 'wb') as shard:
+            for i in range(shard_id * images_per_shard, min((shard_id + 1) * images_per_shard, len(paths))):
+                with open(os.path.join(src_dir, paths[i]), 'rb') as f:
+                    data = f.read()
+
+                shard.write(data)
+                shard_ids[i], offsets[i], lengths[i] = shard_id, offset, len(data)
+                offset += len(data)
+
+    np.savez(os.path.join(output_dir, _INDEX_FILE),
+             shard_ids=shard_ids,
+             offsets=offsets,
+             lengths=lengths,
+             labels=np.asarray(labels, dtype=np.int64))
+
+    # the meta file is written last: a directory without it is an incomplete conversion
+    with open(os.path.join(output_dir, _META_FILE), 'w') as f:
+        json.dump({"layout": layout,
+                   "num_samples": len(paths),
+                   "num_shards": int(shard_ids[-1]) + 1,
+                   "classes": classes,
+                   "paths": paths}, f)
+
+    return len(paths)
+
+
+class PackedShardDataset(Dataset):
+    """
+    Reads the samples of a directory packed by 'pack_directory'. The shards are memory-mapped lazily in each process (DataLoader worker).
+    With the 'class_folders' layout, each item is a tuple (image, class index) as in ImageFolder. Otherwise, only the image is returned.
+    """
+    def __init__(self,
+                 root: P,
+                 transforms: Optional[List] = None) -> None:
+
+        super().__init__()
+
+        self.root = dirf.process_path(root,
+                                      must_exist=True,
+                                      dir_ok=True,
+                                      file_ok=False,
+                                      condition=lambda d: os.path.exists(os.path.join(d, _META_FILE)),
+                                      error_message=f"The directory is expected to be the output of 'pack_directory' (with a '{_META_FILE}' file)")
+
+        with open(os.path.join(self.root, _META_FILE), 'r') as f:
+            meta = json.load(f)
+
+        with np.load(os.path.join(self.root, _INDEX_FILE)) as index:
+            self.shard_ids, self.offsets, self.lengths, labels = index['shard_ids'], index['offsets'], index['lengths'], index['labels']
+
+        self.layout = meta['layout']
+        self.num_shards = meta['num_shards']
+        # the paths relative to the original directory
+        self.paths: List[str] = meta['paths']
+
+        self.classes: List[str] = meta['classes']
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        # the same attribute as the torchvision classification datasets
+        self.targets: Optional[List[int]] = labels.tolist() if self.layout == 'class_folders' else None
+
+        self.transforms = transforms
+        # the transforms are compiled once (and not for each sample)
+        self._transform = CompiledTransform(transforms) if transforms is not None else None
+
+        self._shards = {}
+
+    def __getstate__(self):
+        # the memory maps are not sent to the workers
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _shard(self, shard_id: int) -> np.memmap:
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(os.path.join(self.root, _shard_name(shard_id)), dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def load_bytes(self, index: int) -> bytes:
+        offset = self.offsets[index]
+        return self._shard(int(self.shard_ids[index]))[offset: offset + self.lengths[index]].tobytes()
+
+    def load_sample(self, index: int) -> Image.Image:
+        return Image.open(io.BytesIO(self.load_bytes(index))).convert("RGB")
+
+    def shard_indices(self, shard_id: int) -> np.ndarray:
+        # the samples are packed in order: each shard holds a contiguous range of indices
+        return np.nonzero(self.shard_ids == shard_id)[0]
+
+    def __getitem__(self, index: int) -> Union[torch.Tensor, Tuple[torch.Tensor, int]]:
+        sample = self.load_sample(index)
+
+        if self._transform is not None:
+            sample = self._transform(sample)
+
+        if self.targets is None:
+            return sample
+
+        return sample, self.targets[index]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+
+class ShardAwareSampler(Sampler):
+    """
+    Shuffles the samples while keeping the reads (mostly) sequential: the order of the shards is shuffled, and so are the samples
+    within each shard, but all the samples of a shard are returned before moving to the next one.
+    Call 'set_epoch' at the start of each epoch to get a different (reproducible) order.
+    """
+    def __init__(self, dataset: PackedShardDataset, shuffle: bool = True, seed: int = 0) -> None:
+        self.shards = [dataset.shard_indices(s) for s in range(dataset.num_shards)]
+        self.num_samples = len(dataset)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[int]:
+        if not self.shuffle:
+            return iter(range(self.num_samples))
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = np.concatenate([rng.permutation(self.shards[s]) for s in rng.permutation(len(self.shards))])
+        return iter(order.tolist())
+
+    def __len__(self) -> int:
+        return self.num_samples
@@ -0,0 +1,244 @@
+"""
+This script contains a batched (on-device) version of the augmentations of the Parallel Augmentation datasets.
+
+With 'batched_augs=True', the datasets return only the decoded images as uint8 tensors (of the same size): the DataLoader workers
+do not run any augmentation. The augmentations are then applied to the whole batch (on the GPU if needed) by 'BatchedParallelAugs':
+
+    engine = ds.augmentation_engine(device='cuda')
+    for epoch in range(num_epochs):
+        engine.set_epoch(epoch)
+        for batch in dataloader:
+            x1, x2 = engine(batch)
+"""
+
+import math, torch
+
+import torchvision.transforms as tr
+import torchvision.transforms.functional as trf
+
+from torchvision.ops import roi_align
+from typing import Callable, Dict, List, Tuple, Optional, Union
+
+
+def _uniform(low: float, high: float, n: int, device) -> torch.Tensor:
+    return (torch.rand(n) * (high - low) + low).to(device)
+
+
+def _random_flip(aug, x: torch.Tensor, dim: int) -> torch.Tensor:
+    flip = _uniform(0, 1, len(x), x.device) < aug.p
+    return torch.where(flip[:, None, None, None], x.flip(dim), x)
+
+
+def _random_grayscale(aug, x: torch.Tensor) -> torch.Tensor:
+    gray = _uniform(0, 1, len(x), x.device) < aug.p
+    return torch.where(gray[:, None, None, None], trf.rgb_to_grayscale(x, num_output_channels=x.shape[1]), x)
+
+
+def _random_resized_crop(aug: tr.RandomResizedCrop, x: torch.Tensor) -> torch.Tensor:
+    # the sampling of tr.RandomResizedCrop.get_params (10 attempts, then the fallback crop) vectorized over the batch
+    n, (H, W), attempts = len(x), x.shape[-2:], 10
+
+    target_area = H * W * (torch.rand(n, attempts) * (aug.scale[1] - aug.scale[0]) + aug.scale[0])
+    log_ratio = torch.rand(n, attempts) * (math.log(aug.ratio[1]) - math.log(aug.ratio[0])) + math.log(aug.ratio[0])
+    aspect_ratio = torch.exp(log_ratio)
+
+    w = torch.round(torch.sqrt(target_area * aspect_ratio))
+    h = torch.round(torch.sqrt(target_area / aspect_ratio))
+    valid = (w > 0) & (w <= W) & (h > 0) & (h <= H)
+
+    # the first valid attempt of each sample
+    first = valid.int().argmax(dim=1, keepdim=True)
+    w, h, found = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1), valid.any(dim=1)
+
+    # the fallback: the largest central crop within the ratio bounds
+    in_ratio = W / H
+    if in_ratio < min(aug.ratio):
+        fw, fh = W, round(W / min(aug.ratio))
+    elif in_ratio > max(aug.ratio):
+        fw, fh = round(H * max(aug.ratio)), H
+    else:
+        fw, fh = W, H
+
+    top = torch.where(found, torch.floor(torch.rand(n) * (H - h + 1)), torch.full((n,), float((H - fh) // 2)))
+    left = torch.where(found, torch.floor(torch.rand(n) * (W - w + 1)), torch.full((n,), float((W - fw) // 2)))
+    w, h = torch.where(found, w, torch.full((n,), float(fw))), torch.where(found, h, torch.full((n,), float(fh)))
+
+    boxes = torch.stack([torch.arange(n, dtype=torch.float32), left, top, left + w, top + h], dim=1).to(x.device, x.dtype)
+    # each crop is resized to the output size by bilinear sampling: averaging ceil(crop size / output size) samples per output pixel
+    return roi_align(x, boxes, output_size=tuple(aug.size), spatial_scale=1.0, sampling_ratio=-1, aligned=True).clamp_(0, 1)
+
+
+def _gray(x: torch.Tensor) -> torch.Tensor:
+    return trf.rgb_to_grayscale(x) if x.shape[-3] == 3 else x
+
+
+def _color_jitter(aug: tr.ColorJitter, x: torch.Tensor) -> torch.Tensor:
+    n = len(x)
+    # the same operations as trf.adjust_brightness / adjust_contrast / adjust_saturation with a factor per sample
+    ops, factors = [], []
+
+    if aug.brightness is not None:
+        ops.append(lambda img, f: (img * f).clamp(0, 1))
+        factors.append(_uniform(*aug.brightness, n, x.device))
+
+    if aug.contrast is not None:
+        ops.append(lambda img, f: (img * f + (1 - f) * _gray(img).mean(dim=(-3, -2, -1), keepdim=True)).clamp(0, 1))
+        factors.append(_uniform(*aug.contrast, n, x.device))
+
+    if aug.saturation is not None:
+        ops.append(lambda img, f: (img * f + (1 - f) * _gray(img)).clamp(0, 1))
+        factors.append(_uniform(*aug.saturation, n, x.device))
+
+    if aug.hue is not None:
+        # the hue is rotated in the hsv space: no batched version with a factor per sample
+        ops.append(lambda img, f: torch.stack([trf.adjust_hue(i, float(h)) for i, h in zip(img, f)]))
+        factors.append(_uniform(*aug.hue, n, x.device))
+
+    if len(ops) == 0:
+        return x
+
+    # the operations are applied in a random order per sample (as tr.ColorJitter does per call)
+    orders = torch.rand(n, len(ops)).argsort(dim=1).to(x.device)
+
+    for position in range(len(ops)):
+        x = x.clone()
+        for op_index in range(len(ops)):
+            mask = orders[:, position] == op_index
+            if mask.any():
+                x[mask] = ops[op_index](x[mask], factors[op_index][mask][:, None, None, None])
+
+    return x
+
+
+def _per_sample(aug: Callable, x: torch.Tensor) -> torch.Tensor:
+    # any other transformation is applied to each sample separately: its random parameters are drawn for each sample
+    outputs = [aug(sample) for sample in x]
+    size = list(outputs[0].shape[-2:])
+    return torch.stack([o if list(o.shape[-2:]) == size else trf.resize(o, size=size, antialias=True) for o in outputs])
+
+
+# the transformations whose random parameters are drawn per sample in a single batched operation
+_BATCHED: Dict[type, Callable] = {
+    tr.RandomHorizontalFlip: lambda aug, x: _random_flip(aug, x, dim=-1),
+    tr.RandomVerticalFlip: lambda aug, x: _random_flip(aug, x, dim=-2),
+    tr.RandomGrayscale: _random_grayscale,
+    tr.RandomResizedCrop: _random_resized_crop,
+    tr.ColorJitter: _color_jitter,
+}
+
+# the deterministic transformations: applied to the whole batch at once
+_DETERMINISTIC = (tr.Resize, tr.CenterCrop, tr.Normalize, tr.Grayscale, tr.ConvertImageDtype)
+
+
+def apply_per_sample(aug: Callable, x: torch.Tensor) -> torch.Tensor:
+    """
+    Applies a transformation to a (B, C, H, W) batch with random parameters drawn independently for each sample
+    """
+    if isinstance(aug, _DETERMINISTIC):
+        return aug(x)
+
+    batched = _BATCHED.get(type(aug))
+    return batched(aug, x) if batched is not None else _per_sample(aug, x)
+
+
+class BatchedParallelAugs:
+    """
+    Each sample of the batch is associated with its own random choice (and order) of 'augs_per_sample' augmentations for each view
+    (exactly as in AbstractParallelAugsDs._set_augmentations). The samples that share the same augmentation at the same position are
+    augmented together, but the random parameters of every transformation are drawn per sample (see 'apply_per_sample'): the common
+    torchvision augmentations (flips, grayscale, resized crops, color jitter) are batched, any other one is applied sample by sample.
+
+    The random choices depend only on the seed, the epoch and the index of the batch within the epoch: the augmentations are
+    reproducible regardless of the number of DataLoader workers.
+    """
+    def __init__(self,
+                 output_shape: Tuple[int, int],
+                 augs_per_sample: int,
+                 sampled_data_augs: List,
+                 uniform_augs_before: List,
+                 uniform_augs_after: List,
+                 seed: int = 0,
+                 device: Optional[Union[str, torch.device]] = None) -> None:
+
+        if len(sampled_data_augs) == 0 and augs_per_sample > 0:
+            raise ValueError(f"At least one augmentation must be passed to sample 'augs_per_sample' augmentations per view. Found: {augs_per_sample}")
+
+        self.output_shape = output_shape
+        self.sampled_data_augs = sampled_data_augs
+        self.augs_per_sample = min(augs_per_sample, len(sampled_data_augs))
+
+        # the uniform augmentations are applied to the whole batch (with per-sample parameters)
+        self._augs_before = list(uniform_augs_before)
+        self._augs_after = list(uniform_augs_after)
+
+        self.seed = seed
+        self.device = device
+
+        self.epoch = 0
+        self._batch_index = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self._batch_index = 0
+
+    def _generator(self) -> torch.Generator:
+        # the hash of a tuple of integers is the same across runs (no hash randomization for integers)
+        g = torch.Generator()
+        g.manual_seed(hash((self.seed, self.epoch, self._batch_index)) & ((1 << 63) - 1))
+        return g
+
+    def sample_orders(self, batch_size: int, generator: torch.Generator) -> torch.Tensor:
+        """
+        Returns a (2, batch_size, augs_per_sample) tensor: the indices of the augmentations applied to each sample for each view (in order)
+        """
+        scores = torch.rand(2, batch_size, len(self.sampled_data_augs), generator=generator)
+        return scores.argsort(dim=-1)[..., :self.augs_per_sample]
+
+    @classmethod
+    def _uniform_augs(cls, augs: List, x: torch.Tensor) -> torch.Tensor:
+        for aug in augs:
+            x = apply_per_sample(aug, x)
+        return x
+
+    def _view(self, images: torch.Tensor, order: torch.Tensor) -> torch.Tensor:
+        x = self._uniform_augs(self._augs_before, images)
+
+        for position in range(order.shape[1]):
+            x = x.clone()
+            for aug_index in order[:, position].unique().tolist():
+                mask = (order[:, position] == aug_index).to(x.device)
+                group = apply_per_sample(self.sampled_data_augs[aug_index], x[mask])
+
+                # the output of an augmentation (e.g. a crop) is brought back to the spatial size of the batch
+                if group.shape[-2:] != x.shape[-2:]:
+                    group = trf.resize(group, size=list(x.shape[-2:]), antialias=True)
+
+                x[mask] = group
+
+        x = self._uniform_augs(self._augs_after, x)
+        # resize after all transformations
+        return trf.resize(x, size=list(self.output_shape), antialias=True)
+
+    @torch.no_grad()
+    def __call__(self, images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            images: a (batch_size, C, H, W) uint8 batch (as returned by the datasets with 'batched_augs=True')
+
+        Returns: the 2 augmented views as float tensors in [0, 1] (before normalization)
+        """
+        if images.dtype != torch.uint8 or images.ndim != 4:
+            raise ValueError(f"The images are expected to be a batch of uint8 tensors of the shape (batch_size, C, H, W). Found: {images.dtype}, {tuple(images.shape)}")
+
+        generator = self._generator()
+        self._batch_index += 1
+
+        # the equivalent of 'tr.ToTensor' on the whole batch
+        images = images.to(self.device, non_blocking=True).float().div_(255) if self.device is not None else images.float().div_(255)
+
+        orders = self.sample_orders(len(images), generator)
+
+        # the random parameters are drawn from the global (cpu) generator: seed it without affecting the caller
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(int(torch.randint(0, 2 ** 62, (1,), generator=generator).item()))
+            return self._view(images, orders[0]), self._view(images, orders[1])
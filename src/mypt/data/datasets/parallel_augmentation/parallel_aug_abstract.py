@@ -2,15 +2,16 @@
 This script contains the implementation of a general dataset object designed for Constrastive Learning Parallel Augmentation approaches 
 (https://arxiv.org/pdf/2002.05709, https://arxiv.org/abs/2103.03230) for example
 """
-import os, random
+import os, random, torch
 
 import torchvision.transforms as tr
 from torch.utils.data import Dataset
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Optional
 from pathlib import Path
 from PIL import Image
 from abc import ABC, abstractmethod
 
+from .batched_augs import BatchedParallelAugs
 from ....code_utilities import pytorch_utilities as pu
 
 
@@ -18,6 +19,9 @@ class AbstractParallelAugsDs(Dataset, ABC):
     """
     The parent class of Parallel Augmentation Datasets. The main functionality is implemented in
     in the ._set_augmentations() method: returning 2 tr.Compose each outputting images of the same output shape
+
+    With 'batched_augs=True', the dataset returns the decoded images as uint8 tensors (resized to 'decode_size') and the augmentations
+    are applied to whole batches by the engine returned by .augmentation_engine()
     """
 
     @classmethod
@@ -38,7 +42,9 @@ class AbstractParallelAugsDs(Dataset, ABC):
                 uniform_augs_before: List,
                 uniform_augs_after:List,
                 sampled_data_augs:List,
-                seed: int=0):
+                seed: int=0,
+                batched_augs: bool=False,
+                decode_size: Optional[Tuple[int, int]]=None):
 
         # reproducibility is crucial for a consistent evaluation of the model
         pu.seed_everything(seed=seed)
@@ -53,6 +59,26 @@ class AbstractParallelAugsDs(Dataset, ABC):
 
         self.augs_per_sample = min(augs_per_sample, len(self.sampled_data_augs))
 
+        self.seed = seed
+        # the images must be of the same size to be batched: the output shape by default
+        self.batched_augs = batched_augs
+        self.decode_size = decode_size if decode_size is not None else output_shape
+
+    def _to_uint8(self, image: Image.Image) -> torch.Tensor:
+        # PIL expects the size as (width, height)
+        size = (self.decode_size[1], self.decode_size[0])
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        return tr.functional.pil_to_tensor(image)
+
+    def augmentation_engine(self, device: Optional[Union[str, torch.device]] = None) -> BatchedParallelAugs:
+        return BatchedParallelAugs(output_shape=self.output_shape, 
+                                   augs_per_sample=self.augs_per_sample, 
+                                   sampled_data_augs=self.sampled_data_augs, 
+                                   uniform_augs_before=self.uniform_augs_before, 
+                                   uniform_augs_after=self.uniform_augs_after, 
+                                   seed=self.seed, 
+                                   device=device)
 
     def _set_augmentations(self) -> Tuple[tr.Compose, tr.Compose]:
         # sample from the passed augmentations
@@ -10,6 +10,9 @@ from typing import Union, List, Tuple, Optional
 from pathlib import Path
 
 from .parallel_aug_abstract import AbstractParallelAugsDs
+from ..image_cache import DecodedImageCache
+from ..manifest import load_or_build_manifest
+from ..compiled_transforms import CompiledTransform
 from ....code_utilities import directories_and_files as dirf
 
 
@@ -23,7 +26,13 @@ class ParallelAugDirDs(AbstractParallelAugsDs):
                 uniform_augs_after: List,
                 classification_mode:bool = False,
                 image_extensions:Optional[List[str]]=None,
-                seed: int=0):
+                seed: int=0,
+                image_cache_bytes: int=0,
+                image_cache_size: Optional[Tuple[int, int]]=None,
+                image_cache_dir: Optional[Union[str, Path]]=None,
+                manifest_path: Optional[Union[str, Path]]=None,
+                batched_augs: bool=False,
+                decode_size: Optional[Tuple[int, int]]=None):
         
         super().__init__(
                 output_shape=output_shape,
@@ -31,40 +40,45 @@ class ParallelAugDirDs(AbstractParallelAugsDs):
                 sampled_data_augs=sampled_data_augs,
                 uniform_augs_before= uniform_augs_before,
                 uniform_augs_after=uniform_augs_after,
-                seed=seed)
+                seed=seed,
+                batched_augs=batched_augs,
+                decode_size=decode_size)
 
         if image_extensions is None:
             image_extensions = dirf.IMAGE_EXTENSIONS
 
         # the root directory can have any structure as long as 
-        # it contains only image data
+        # it contains only image data (checked while building the manifest)
         self.root_dir = dirf.process_path(root_dir, 
                                       file_ok=False,
                                       dir_ok=True,
-                                      condition=lambda x: dirf.dir_contains_only_types(x, valid_extensions=image_extensions), # contains only image data
-                                      error_message=f'The root directory is expectd to contain only image data: specifically those extensions: {image_extensions}'
-                                      )
+                                      must_exist=True)
         
+        self.image_extensions = image_extensions
+        # the manifest file (the listing of the directory) is reused across runs as long as the directory is not modified
+        self.manifest_path = manifest_path
+
         # create a mapping between a numerical index and the associated sample path for O(1) access time (on average...)
         self.idx2path = None
         # set the mapping from the index to the sample's path
         self._prepare_idx2path()
 
         self.classification_mode = classification_mode
+        # built once (and not for each sample)
+        self._to_tensor = CompiledTransform([tr.ToTensor()])
+
+        # an optional cache of the decoded (and optionally pre-resized) images
+        self.image_cache = None
+        if image_cache_bytes > 0 or image_cache_dir is not None:
+            self.image_cache = DecodedImageCache(sample_paths=[self.idx2path[i] for i in range(self.data_count)], 
+                                                 memory_bytes=image_cache_bytes, 
+                                                 image_size=image_cache_size, 
+                                                 spill_dir=image_cache_dir)
 
     def _prepare_idx2path(self):
-        # define a dictionary
-        idx2path = {}
-        counter = 0
-
-        for r, _, files in os.walk(self.root_dir):
-            for f in files:
-                file_path = os.path.join(r, f)
-                idx2path[counter] = file_path
-                counter += 1
-        # sorted the samples for reproducibility
-        paths = sorted(list(idx2path.values()))
-        self.idx2path = dict([(i, p) for i, p in enumerate(paths)])
+        # the manifest lists the samples sorted (for reproducibility): it is loaded from the disk when still valid
+        manifest, _ = load_or_build_manifest(self.root_dir, image_extensions=self.image_extensions, manifest_path=self.manifest_path)
+        self.idx2path = dict(enumerate(manifest.absolute_paths()))
         self.data_count = len(self.idx2path)
 
         # I initially thought of shuffling the indices since the directory might represent an image classification task
@@ -72,16 +86,25 @@ class ParallelAugDirDs(AbstractParallelAugsDs):
         # for Pytorch built-in datasets
         # and the shuffling part should be done at the dataloader level
 
-    def __getitem__aug(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _load_image(self, index: int):
         # extract the path to the sample (using the map between the index and the sample path !!!)
-        sample_image = self.load_sample(self.idx2path[index])   
+        if self.image_cache is None:
+            return self.load_sample(self.idx2path[index])
+        return self.image_cache.get_image(index, self.idx2path[index], self.load_sample)
+
+    def __getitem__aug(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        sample_image = self._load_image(index)
+        if self.batched_augs:
+            # the augmentations are applied to the whole batch
+            return self._to_uint8(sample_image)
+
         augs1, augs2 = self._set_augmentations()
         s1, s2 = augs1(sample_image), augs2(sample_image) 
         return s1, s2
 
     def __getitem__cl(self, index: int) -> torch.Tensor:
         # convert the sample from a PIL image to a torch Tensor
-        return (tr.ToTensor()).forward(self.load_sample(self.idx2path[index]))
+        return self._to_tensor(self._load_image(index))
 
     def __getitem__(self, index: int):
         if self.classification_mode:
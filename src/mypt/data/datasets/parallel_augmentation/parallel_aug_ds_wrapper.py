@@ -20,13 +20,17 @@ class ParallelAugWrapperDS(ClassificationDsWrapper, AbstractParallelAugsDs):
                 sampled_data_augs:List,
                 uniform_augs_before: List,
                 uniform_augs_after: List,
-                train:bool=True) -> None:
+                train:bool=True,
+                batched_augs: bool=False,
+                decode_size: Optional[Tuple[int, int]]=None) -> None:
 
         super().__init__(output_shape=output_shape, 
                          augs_per_sample=augs_per_sample,
                          sampled_data_augs=sampled_data_augs,                         
                          uniform_augs_before=uniform_augs_before,
-                         uniform_augs_after=uniform_augs_after)
+                         uniform_augs_after=uniform_augs_after,
+                         batched_augs=batched_augs,
+                         decode_size=decode_size)
 
         self.root_dir = root_dir
         self._ds: Dataset = None
@@ -44,6 +48,10 @@ class ParallelAugWrapperDS(ClassificationDsWrapper, AbstractParallelAugsDs):
         else:
             sample_image:torch.Tensor = self._ds[index][0]   
 
+        if self.batched_augs:
+            # the augmentations are applied to the whole batch
+            return self._to_uint8(sample_image)
+
         augs1, augs2 = self._set_augmentations()
         s1, s2 = augs1(sample_image), augs2(sample_image) 
 
@@ -70,7 +78,9 @@ class Food101Wrapper(ParallelAugWrapperDS):
                 uniform_augs_before: List,
                 uniform_augs_after: List,
                 train:bool=True,
-                samples_per_cls: Optional[int] = None) -> None:
+                samples_per_cls: Optional[int] = None,
+                batched_augs: bool=False,
+                decode_size: Optional[Tuple[int, int]]=None) -> None:
 
         super().__init__(
                 root_dir=root_dir,
@@ -79,7 +89,9 @@ class Food101Wrapper(ParallelAugWrapperDS):
                 sampled_data_augs=sampled_data_augs,
                 uniform_augs_before=uniform_augs_before,
                 uniform_augs_after=uniform_augs_after,
-                train=train)
+                train=train,
+                batched_augs=batched_augs,
+                decode_size=decode_size)
 
 
         self._ds = Food101(root=root_dir,     
@@ -116,7 +128,9 @@ class ImagenetterWrapper(ParallelAugWrapperDS):
                 uniform_augs_before: List,
                 uniform_augs_after: List,
                 train:bool=True,
-                samples_per_cls: Optional[int] = None) -> None:
+                samples_per_cls: Optional[int] = None,
+                batched_augs: bool=False,
+                decode_size: Optional[Tuple[int, int]]=None) -> None:
 
         super().__init__(
                 root_dir=root_dir,
@@ -125,7 +139,9 @@ class ImagenetterWrapper(ParallelAugWrapperDS):
                 sampled_data_augs=sampled_data_augs,
                 uniform_augs_before=uniform_augs_before,
                 uniform_augs_after=uniform_augs_after,
-                train=train)
+                train=train,
+                batched_augs=batched_augs,
+                decode_size=decode_size)
 
         # for some reason, setting the download parameter to True raises an error if the directory already exists
         # wrap the self._ds field in a try and catch statment to cover all cases (setting the download argument with whether the directly exists or not is not enough as certain files might be missing...)
@@ -0,0 +1,575 @@
+"""
+This script implements index backends for the KNN classes: an exact (brute-force) index, an exact-scan index over quantized (float16 / int8)
+embeddings and an approximate inverted-file index (IVF) with a k-means coarse quantizer and an optional product quantization (PQ) of the residuals.
+All of them are written in pure Pytorch.
+"""
+
+import time, torch
+
+import torch.nn.functional as F
+
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple, List, Dict
+
+from ...code_utilities import pytorch_utilities as pu
+from ...shortcuts import str2distance
+from .topk import init_topk_buffers, merge_topk, masked_topk
+
+
+def _kmeans(x: torch.Tensor,
+            num_clusters: int,
+            num_iterations: int,
+            spherical: bool,
+            generator: torch.Generator,
+            batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Lloyd's algorithm. The spherical variant (used with the cosine similarity) keeps the centroids normalized.
+    Returns the centroids and the cluster of each sample.
+    """
+    num_clusters = min(num_clusters, len(x))
+    init = torch.randperm(len(x), generator=generator)[:num_clusters].to(x.device)
+    centroids = x[init].clone()
+
+    for _ in range(num_iterations):
+        assignment = _assign(x, centroids, spherical=spherical, batch_size=batch_size)
+
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=num_clusters).to(x.dtype)
+
+        # empty clusters keep their previous centroid
+        centroids = torch.where((counts > 0).unsqueeze(1), sums / counts.clamp(min=1).unsqueeze(1), centroids)
+
+        if spherical:
+            centroids = F.normalize(centroids, dim=1)
+
+    return centroids, _assign(x, centroids, spherical=spherical, batch_size=batch_size)
+
+
+def _assign(x: torch.Tensor, centroids: torch.Tensor, spherical: bool, batch_size: int) -> torch.Tensor:
+    c_norms = (centroids ** 2).sum(dim=1)
+    assignment = torch.empty(len(x), dtype=torch.int64, device=x.device)
+
+    for start in range(0, len(x), batch_size):
+        xc = x[start: start + batch_size] @ centroids.T
+        if spherical:
+            assignment[start: start + batch_size] = torch.argmax(xc, dim=1)
+        else:
+            # ||x - c|| ^ 2 = ||x|| ^ 2 - 2 <x, c> + ||c|| ^ 2: the first term does not depend on the centroid
+            assignment[start: start + batch_size] = torch.argmin(c_norms.unsqueeze(0) - 2 * xc, dim=1)
+
+    return assignment
+
+
+class NeighborsIndex(ABC):
+    """
+    The parent class of the index backends. The measure is passed as one of the string keys of 'shortcuts.str2distance'.
+    """
+    # whether larger values of the measure mean closer samples: only measures between pairs of vectors can be indexed
+    _measure_is_similarity = {"cosine_sim": True, "euclidean": False}
+
+    def __init__(self,
+                 measure: str = 'cosine_sim',
+                 device: Optional[str] = None,
+                 batch_size: int = 1024) -> None:
+
+        if measure not in str2distance:
+            raise NotImplementedError(f"The index accepts only the measures in 'str2distance': {list(str2distance.keys())}. Found: {measure}")
+
+        if measure not in self._measure_is_similarity:
+            raise NotImplementedError(f"The measure {measure} does not define a distance between pairs of vectors and cannot be indexed. Supported measures: {list(self._measure_is_similarity.keys())}")
+
+        self.measure = measure
+        self.measure_as_similarity = self._measure_is_similarity[measure]
+
+        # the callable is either a class or a function (the same logic as KNN._measures)
+        m = str2distance[measure]
+        self.msr = m() if isinstance(m, type) else m
+
+        self.device = device if device is not None else pu.get_default_device()
+        if isinstance(self.msr, torch.nn.Module):
+            self.msr = self.msr.to(self.device)
+
+        self.batch_size = batch_size
+        self.num_samples = 0
+
+        # tombstones: removed samples are ignored by the search until the index is compacted
+        self.removed: Optional[torch.Tensor] = None
+
+    def _prepare(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.to(device=self.device, dtype=torch.float32)
+        # with normalized vectors, the cosine similarity reduces to the dot product
+        return F.normalize(x, dim=1) if self.measure == 'cosine_sim' else x
+
+    @abstractmethod
+    def build(self, embeddings: torch.Tensor) -> 'NeighborsIndex':
+        pass
+
+    @abstractmethod
+    def search(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the values of the measure and the indices (in the original embeddings) of the 'k' nearest neighbors of each query.
+        Approximate indices (or removed samples) might leave less than 'k' candidates for a query: the missing entries have the index -1.
+        """
+        pass
+
+    @abstractmethod
+    def add(self, embeddings: torch.Tensor) -> None:
+        """
+        Appends new embeddings: their indices follow the existing ones.
+        """
+        pass
+
+    @abstractmethod
+    def compact(self, keep: torch.Tensor) -> None:
+        """
+        Physically removes the samples where 'keep' is False. The kept samples are re-indexed consecutively (in their original order).
+        """
+        pass
+
+    def reattach(self, embeddings: torch.Tensor) -> None:
+        """
+        Points the index to another copy of the embeddings it currently holds (e.g. the same embeddings memory-mapped from the disk).
+        Only the indices referencing the passed embeddings (instead of copying them) have to override this method.
+        """
+        pass
+
+    def remove(self, ids: torch.Tensor) -> None:
+        if self.removed is None:
+            self.removed = torch.zeros(self.num_samples, dtype=torch.bool, device=self.device)
+        self.removed[torch.as_tensor(ids, dtype=torch.int64, device=self.device)] = True
+
+    def _extend_removed(self, num_new_samples: int) -> None:
+        if self.removed is not None:
+            self.removed = torch.cat([self.removed, torch.zeros(num_new_samples, dtype=torch.bool, device=self.device)])
+
+
+class ExactIndex(NeighborsIndex):
+    def build(self, embeddings: torch.Tensor) -> 'ExactIndex':
+        self.embeddings = self._prepare(embeddings)
+        self.num_samples = len(self.embeddings)
+        return self
+
+    def search(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, self.num_samples)
+        queries = self._prepare(queries)
+
+        values, indices = init_topk_buffers(num_queries=len(queries), k=k, measure_as_similarity=self.measure_as_similarity, device=self.device)
+
+        for start in range(0, self.num_samples, self.batch_size):
+            with torch.no_grad():
+                scores = self.msr(queries, self.embeddings[start: start + self.batch_size])
+
+            removed = self.removed[start: start + self.batch_size] if self.removed is not None else None
+            bv, bi = masked_topk(scores, k=k, measure_as_similarity=self.measure_as_similarity, removed=removed, offset=start)
+            values, indices = merge_topk(values, indices, bv, bi, measure_as_similarity=self.measure_as_similarity)
+
+        return values, indices
+
+    def add(self, embeddings: torch.Tensor) -> None:
+        self.embeddings = torch.cat([self.embeddings, self._prepare(embeddings)], dim=0)
+        self._extend_removed(len(embeddings))
+        self.num_samples = len(self.embeddings)
+
+    def compact(self, keep: torch.Tensor) -> None:
+        self.embeddings = self.embeddings[keep.to(self.device)]
+        self.num_samples = len(self.embeddings)
+        self.removed = None
+
+
+def _quantize(x: torch.Tensor, dtype: str) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    if dtype == 'float16':
+        return x.to(torch.float16), None
+
+    # symmetric int8 quantization with a scale per vector: x ~ codes * scale
+    scales = (x.abs().amax(dim=1) / 127).clamp(min=10 ** -12)
+    codes = torch.round(x / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+    return codes, scales
+
+
+class QuantizedIndex(NeighborsIndex):
+    """
+    An exact-scan index over embeddings stored in reduced precision: float16 or int8 with a float32 scale per vector (2x / ~4x less memory).
+    Each block of codes is decoded to float32 on the device before computing the measure (the accumulation is in float32).
+
+    With 'rerank_factor' set, the 'k * rerank_factor' best candidates are re-ranked with the float32 embeddings passed to 'build'.
+    The index keeps a reference to these embeddings (no copy): passing a memory-mapped tensor (e.g. the KNN embeddings store) 
+    keeps them on the disk, only the rows of the candidates are read.
+    """
+    __supported_dtypes = ['float16', 'int8']
+
+    def __init__(self,
+                 dtype: str = 'int8',
+                 measure: str = 'cosine_sim',
+                 rerank_factor: Optional[int] = None,
+                 device: Optional[str] = None,
+                 batch_size: int = 1024) -> None:
+
+        super().__init__(measure=measure, device=device, batch_size=batch_size)
+
+        if dtype not in self.__supported_dtypes:
+            raise NotImplementedError(f"The quantized index supports only the following dtypes: {self.__supported_dtypes}. Found: {dtype}")
+
+        if rerank_factor is not None and rerank_factor < 1:
+            raise ValueError(f"The 'rerank_factor' must be at least 1. Found: {rerank_factor}")
+
+        self.dtype = dtype
+        self.rerank_factor = rerank_factor
+
+    def _encode(self, embeddings: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # encode block by block: the float32 copy of the whole matrix is never materialized on the device
+        blocks = [_quantize(self._prepare(embeddings[start: start + self.batch_size]), self.dtype) 
+                  for start in range(0, len(embeddings), self.batch_size)]
+        codes = torch.cat([b[0] for b in blocks], dim=0)
+        scales = torch.cat([b[1] for b in blocks], dim=0) if self.dtype == 'int8' else None
+        return codes, scales
+
+    def _decode(self, start: int, end: int) -> torch.Tensor:
+        block = self.codes[start: end].to(torch.float32)
+        if self.scales is not None:
+            block = block * self.scales[start: end].unsqueeze(1)
+        return block
+
+    def memory_bytes(self) -> int:
+        # the memory used by the codes (and scales): the float32 embeddings used for the re-ranking are not owned by the index
+        return self.codes.numel() * self.codes.element_size() + (0 if self.scales is None else self.scales.numel() * self.scales.element_size())
+
+    def build(self, embeddings: torch.Tensor) -> 'QuantizedIndex':
+        self.codes, self.scales = self._encode(embeddings)
+        self.originals = embeddings if self.rerank_factor is not None else None
+        self.num_samples = len(self.codes)
+        return self
+
+    def reattach(self, embeddings: torch.Tensor) -> None:
+        if self.originals is not None:
+            if len(embeddings) != self.num_samples:
+                raise ValueError(f"The index holds {self.num_samples} samples. Found {len(embeddings)} embeddings")
+            self.originals = embeddings
+
+    def _rerank(self, queries: torch.Tensor, candidates: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        values = torch.empty(size=(len(queries), k), dtype=torch.float32, device=self.device)
+        indices = torch.empty(size=(len(queries), k), dtype=torch.int64, device=self.device)
+
+        # the number of queries per chunk so that each chunk reads (about) 'batch_size' original embeddings
+        chunk = max(1, self.batch_size // candidates.shape[1])
+
+        for start in range(0, len(queries), chunk):
+            q, c = queries[start: start + chunk], candidates[start: start + chunk]
+            valid = c >= 0
+
+            x = self._prepare(self.originals[c.clamp(min=0).reshape(-1).cpu()]).reshape(c.shape + (-1,))
+
+            if self.measure == 'cosine_sim':
+                scores = torch.einsum('qd,qcd->qc', q, x)
+            else:
+                scores = ((q.unsqueeze(1) - x) ** 2).sum(dim=-1)
+
+            fill_value = -float('inf') if self.measure_as_similarity else float('inf')
+            scores = scores.masked_fill(~valid, fill_value)
+
+            v, pos = torch.topk(scores, k=k, dim=1, largest=self.measure_as_similarity)
+            values[start: start + chunk], indices[start: start + chunk] = v, torch.gather(c, 1, pos)
+
+        return values, indices
+
+    def search(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, self.num_samples)
+        shortlist = k if self.rerank_factor is None else min(k * self.rerank_factor, self.num_samples)
+        queries = self._prepare(queries)
+
+        values, indices = init_topk_buffers(num_queries=len(queries), k=shortlist, measure_as_similarity=self.measure_as_similarity, device=self.device)
+
+        for start in range(0, self.num_samples, self.batch_size):
+            with torch.no_grad():
+                scores = self.msr(queries, self._decode(start, start + self.batch_size))
+
+            removed = self.removed[start: start + self.batch_size] if self.removed is not None else None
+            bv, bi = masked_topk(scores, k=shortlist, measure_as_similarity=self.measure_as_similarity, removed=removed, offset=start)
+            values, indices = merge_topk(values, indices, bv, bi, measure_as_similarity=self.measure_as_similarity)
+
+        if self.rerank_factor is None:
+            return values, indices
+
+        return self._rerank(queries, indices, k)
+
+    def add(self, embeddings: torch.Tensor) -> None:
+        codes, scales = self._encode(embeddings)
+        self.codes = torch.cat([self.codes, codes], dim=0)
+        if self.scales is not None:
+            self.scales = torch.cat([self.scales, scales], dim=0)
+        if self.originals is not None:
+            self.originals = torch.cat([self.originals, embeddings.to(self.originals.device, self.originals.dtype)], dim=0)
+
+        self._extend_removed(len(embeddings))
+        self.num_samples = len(self.codes)
+
+    def compact(self, keep: torch.Tensor) -> None:
+        self.codes = self.codes[keep.to(self.device)]
+        if self.scales is not None:
+            self.scales = self.scales[keep.to(self.device)]
+        if self.originals is not None:
+            self.originals = self.originals[keep.to(self.originals.device)]
+
+        self.num_samples = len(self.codes)
+        self.removed = None
+
+
+class IVFIndex(NeighborsIndex):
+    """
+    An inverted-file index: the embeddings are clustered with k-means ('num_lists' clusters), and each query is compared only
+    to the embeddings of the 'nprobe' closest clusters. With 'pq_subspaces' set, the residuals (embedding - centroid) are
+    compressed with product quantization: each of the 'pq_subspaces' chunks of a residual is replaced by the index of its closest
+    centroid (out of 2 ** pq_bits) and the measure is estimated with lookup tables (asymmetric distance computation).
+    """
+    def __init__(self,
+                 num_lists: int,
+                 nprobe: int = 8,
+                 measure: str = 'cosine_sim',
+                 pq_subspaces: Optional[int] = None,
+                 pq_bits: int = 8,
+                 kmeans_iterations: int = 20,
+                 max_train_samples: Optional[int] = None,
+                 seed: int = 0,
+                 device: Optional[str] = None,
+                 batch_size: int = 1024) -> None:
+
+        super().__init__(measure=measure, device=device, batch_size=batch_size)
+
+        if num_lists <= 0 or nprobe <= 0:
+            raise ValueError(f"Both 'num_lists' and 'nprobe' must be positive. Found: num_lists: {num_lists}, nprobe: {nprobe}")
+
+        if not (1 <= pq_bits <= 8):
+            raise ValueError(f"The codes are saved as uint8: 'pq_bits' must be between 1 and 8. Found: {pq_bits}")
+
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.pq_subspaces = pq_subspaces
+        self.pq_bits = pq_bits
+        self.kmeans_iterations = kmeans_iterations
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+
+    def build(self, embeddings: torch.Tensor) -> 'IVFIndex':
+        x = self._prepare(embeddings)
+        self.num_samples, dim = x.shape
+
+        if self.pq_subspaces is not None and dim % self.pq_subspaces != 0:
+            raise ValueError(f"The embedding dimension must be divisible by 'pq_subspaces'. Found: dim: {dim}, pq_subspaces: {self.pq_subspaces}")
+
+        g = torch.Generator()
+        g.manual_seed(self.seed)
+
+        # the quantizers can be trained on a subset of the data
+        train_x = x
+        if self.max_train_samples is not None and self.max_train_samples < len(x):
+            train_x = x[torch.randperm(len(x), generator=g)[:self.max_train_samples].to(self.device)]
+
+        spherical = self.measure == 'cosine_sim'
+        self.centroids, _ = _kmeans(train_x, self.num_lists, self.kmeans_iterations, spherical=spherical, generator=g, batch_size=self.batch_size)
+        self.num_lists = len(self.centroids)
+
+        assignment = _assign(x, self.centroids, spherical=spherical, batch_size=self.batch_size)
+        ids = torch.arange(self.num_samples, device=self.device)
+
+        if self.pq_subspaces is None:
+            self._set_lists(assignment, ids, x)
+            return self
+
+        # product quantization of the residuals
+        train_assignment = assignment if train_x is x else _assign(train_x, self.centroids, spherical=spherical, batch_size=self.batch_size)
+        train_residuals = (train_x - self.centroids[train_assignment]).reshape(len(train_x), self.pq_subspaces, -1)
+
+        codebooks = []
+        for m in range(self.pq_subspaces):
+            cb, _ = _kmeans(train_residuals[:, m, :].contiguous(), 2 ** self.pq_bits, self.kmeans_iterations, spherical=False, generator=g, batch_size=self.batch_size)
+            codebooks.append(cb)
+
+        # the codebooks might have less than 2 ** pq_bits centroids with few training samples: pad them to stack them
+        num_codes = max(len(cb) for cb in codebooks)
+        self.codebooks = torch.stack([F.pad(cb, (0, 0, 0, num_codes - len(cb))) for cb in codebooks], dim=0) # (pq_subspaces, num_codes, sub_dim)
+
+        self._set_lists(assignment, ids, self._encode(x, assignment))
+        return self
+
+    def _encode(self, x: torch.Tensor, assignment: torch.Tensor) -> torch.Tensor:
+        residuals = (x - self.centroids[assignment]).reshape(len(x), self.pq_subspaces, -1)
+        codes = [_assign(residuals[:, m, :].contiguous(), self.codebooks[m], spherical=False, batch_size=self.batch_size) 
+                 for m in range(self.pq_subspaces)]
+        return torch.stack(codes, dim=1).to(torch.uint8) # (num_samples, pq_subspaces)
+
+    def _set_lists(self, assignment: torch.Tensor, ids: torch.Tensor, payload: torch.Tensor) -> None:
+        # sort the samples by list: the samples of list 'l' are at positions [offsets[l], offsets[l + 1])
+        order = torch.argsort(assignment, stable=True)
+        self.ids = ids[order]
+
+        if self.pq_subspaces is None:
+            self.vectors = payload[order]
+        else:
+            self.codes = payload[order]
+
+        counts = torch.bincount(assignment, minlength=self.num_lists)
+        self.offsets = [0] + torch.cumsum(counts, dim=0).tolist()
+
+    def _sorted_assignment(self) -> torch.Tensor:
+        # the list of each sample in the sorted arrays
+        counts = torch.tensor([e - s for s, e in zip(self.offsets[:-1], self.offsets[1:])], device=self.device)
+        return torch.repeat_interleave(torch.arange(self.num_lists, device=self.device), counts)
+
+    def add(self, embeddings: torch.Tensor) -> None:
+        # the new samples are assigned to the existing lists (and encoded with the existing codebooks): the quantizers are not retrained
+        x = self._prepare(embeddings)
+        assignment = _assign(x, self.centroids, spherical=self.measure == 'cosine_sim', batch_size=self.batch_size)
+        new_ids = torch.arange(self.num_samples, self.num_samples + len(x), device=self.device)
+
+        payload = self.vectors if self.pq_subspaces is None else self.codes
+        new_payload = x if self.pq_subspaces is None else self._encode(x, assignment)
+
+        self._set_lists(torch.cat([self._sorted_assignment(), assignment]), 
+                        torch.cat([self.ids, new_ids]), 
+                        torch.cat([payload, new_payload], dim=0))
+
+        self._extend_removed(len(x))
+        self.num_samples += len(x)
+
+    def compact(self, keep: torch.Tensor) -> None:
+        keep = keep.to(self.device)
+        # the new index of each kept sample
+        remap = torch.cumsum(keep.long(), dim=0) - 1
+        mask = keep[self.ids]
+
+        payload = self.vectors if self.pq_subspaces is None else self.codes
+        self._set_lists(self._sorted_assignment()[mask], remap[self.ids[mask]], payload[mask])
+
+        self.num_samples = int(keep.sum().item())
+        self.removed = None
+
+    def _list_scores(self, queries: torch.Tensor, list_index: int) -> torch.Tensor:
+        start, end = self.offsets[list_index], self.offsets[list_index + 1]
+
+        if self.pq_subspaces is None:
+            return self.msr(queries, self.vectors[start: end])
+
+        codes = self.codes[start: end].long()
+        sub_indices = torch.arange(self.pq_subspaces, device=self.device).unsqueeze(0)
+        centroid = self.centroids[list_index]
+
+        if self.measure == 'cosine_sim':
+            # <q, c + r> = <q, c> + sum_m <q_m, r_m>
+            q = queries.reshape(len(queries), self.pq_subspaces, -1)
+            tables = torch.einsum('nmd,mkd->nmk', q, self.codebooks)
+            return (queries @ centroid).unsqueeze(1) + tables[:, sub_indices, codes].sum(dim=-1)
+
+        # ||q - c - r|| ^ 2 = sum_m ||(q - c)_m - r_m|| ^ 2
+        q = (queries - centroid).reshape(len(queries), self.pq_subspaces, -1)
+        tables = (q ** 2).sum(dim=-1, keepdim=True) - 2 * torch.einsum('nmd,mkd->nmk', q, self.codebooks) + (self.codebooks ** 2).sum(dim=-1).unsqueeze(0)
+        return tables[:, sub_indices, codes].sum(dim=-1)
+
+    def search(self, queries: torch.Tensor, k: int, nprobe: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        nprobe = min(nprobe if nprobe is not None else self.nprobe, self.num_lists)
+        k = min(k, self.num_samples)
+
+        queries = self._prepare(queries)
+        values, indices = init_topk_buffers(num_queries=len(queries), k=k, measure_as_similarity=self.measure_as_similarity, device=self.device)
+
+        for q_start in range(0, len(queries), self.batch_size):
+            q = queries[q_start: q_start + self.batch_size]
+
+            with torch.no_grad():
+                coarse_scores = self.msr(q, self.centroids)
+            probes = torch.topk(coarse_scores, k=nprobe, dim=1, largest=self.measure_as_similarity).indices
+
+            # iterate over the probed lists (instead of the queries): each list is compared to all the queries probing it at once
+            for list_index in torch.unique(probes).tolist():
+                if self.offsets[list_index + 1] == self.offsets[list_index]:
+                    continue
+
+                q_ids = torch.nonzero((probes == list_index).any(dim=1)).squeeze(1)
+
+                with torch.no_grad():
+                    scores = self._list_scores(q[q_ids], list_index)
+
+                start = self.offsets[list_index]
+                removed = self.removed[self.ids[start: self.offsets[list_index + 1]]] if self.removed is not None else None
+                bv, bi = masked_topk(scores, k=k, measure_as_similarity=self.measure_as_similarity, removed=removed)
+                global_ids = torch.where(bi >= 0, self.ids[start + bi.clamp(min=0)], bi)
+
+                rows = q_ids + q_start
+                values[rows], indices[rows] = merge_topk(values[rows], indices[rows], bv, global_ids, measure_as_similarity=self.measure_as_similarity)
+
+        return values, indices
+
+
+def _timed_search(index: NeighborsIndex, queries: torch.Tensor, k: int, **search_kwargs) -> Tuple[torch.Tensor, float]:
+    if 'cuda' in str(index.device):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    _, indices = index.search(queries, k, **search_kwargs)
+    if 'cuda' in str(index.device):
+        torch.cuda.synchronize()
+    return indices, time.perf_counter() - start
+
+
+def recall_latency_report(index: IVFIndex,
+                          embeddings: torch.Tensor,
+                          queries: torch.Tensor,
+                          k: int,
+                          nprobes: List[int]) -> List[Dict]:
+    """
+    Compares the (built) approximate index against the exact search over the same embeddings for different values of 'nprobe'.
+
+    Returns:
+        a list of dictionaries (one per 'nprobe' value, preceded by the exact search) with the recall@k
+        (the portion of the exact 'k' neighbors found by the index), the latency per query in milliseconds and the speedup over the exact search
+    """
+    exact = ExactIndex(measure=index.measure, device=index.device, batch_size=index.batch_size).build(embeddings)
+    exact_indices, exact_time = _timed_search(exact, queries, k)
+
+    report = [{"nprobe": None, f"recall@{k}": 1.0, "latency_ms_per_query": 1000 * exact_time / len(queries), "speedup": 1.0}]
+
+    for nprobe in nprobes:
+        approx_indices, approx_time = _timed_search(index, queries, k, nprobe=nprobe)
+        found = (approx_indices.unsqueeze(2) == exact_indices.unsqueeze(1)).any(dim=2).sum(dim=1)
+        report.append({"nprobe": nprobe,
+                       f"recall@{k}": (found.float() / exact_indices.shape[1]).mean().item(),
+                       "latency_ms_per_query": 1000 * approx_time / len(queries),
+                       "speedup": exact_time / approx_time})
+
+    return report
+
+
+def quantization_report(embeddings: torch.Tensor,
+                        queries: torch.Tensor,
+                        k: int,
+                        measure: str = 'cosine_sim',
+                        dtypes: List[str] = None,
+                        rerank_factors: List[Optional[int]] = None,
+                        device: Optional[str] = None,
+                        batch_size: int = 1024) -> List[Dict]:
+    """
+    Measures the memory saved and the accuracy lost by each combination of quantized dtype and re-ranking factor.
+
+    Returns:
+        a list of dictionaries with the recall@k (w.r.t the float32 exact search), the ratio between the memory of the float32 
+        embeddings and the memory of the quantized ones and the latency per query in milliseconds
+    """
+    dtypes = dtypes if dtypes is not None else ['float16', 'int8']
+    rerank_factors = rerank_factors if rerank_factors is not None else [None, 4]
+
+    exact = ExactIndex(measure=measure, device=device, batch_size=batch_size).build(embeddings)
+    exact_indices, exact_time = _timed_search(exact, queries, k)
+    float32_bytes = exact.embeddings.numel() * exact.embeddings.element_size()
+
+    report = [{"dtype": "float32", "rerank_factor": None, f"recall@{k}": 1.0, "memory_ratio": 1.0, "latency_ms_per_query": 1000 * exact_time / len(queries)}]
+
+    for dtype in dtypes:
+        for rf in rerank_factors:
+            index = QuantizedIndex(dtype=dtype, measure=measure, rerank_factor=rf, device=device, batch_size=batch_size).build(embeddings)
+            approx_indices, approx_time = _timed_search(index, queries, k)
+            found = (approx_indices.unsqueeze(2) == exact_indices.unsqueeze(1)).any(dim=2).sum(dim=1)
+
+            report.append({"dtype": dtype, 
+                           "rerank_factor": rf, 
+                           f"recall@{k}": (found.float() / exact_indices.shape[1]).mean().item(), 
+                           "memory_ratio": float32_bytes / index.memory_bytes(), 
+                           "latency_ms_per_query": 1000 * approx_time / len(queries)})
+
+    return report
@@ -0,0 +1,136 @@
+"""
+This script implements a persistent on-disk store for the embeddings of the reference (train) dataset used by the KNN classes.
+
+Each entry is keyed by the identity of the dataset (its listing), the model weights (the checkpoint file or the model's state dict)
+and the callables applied to the items / model outputs. The embeddings are saved as a memory-mapped numpy array so that loading
+an entry is (almost) free and the backbone does not need to be run again.
+"""
+
+import os, json, hashlib, shutil, warnings
+import torch
+import numpy as np
+
+from typing import Optional, Union, Dict, Tuple
+from torch.utils.data import Dataset
+
+from ...code_utilities import directories_and_files as dirf
+from ...code_utilities.fingerprints import dataset_fingerprint, hash_callable, hash_file, hash_model
+from ...shortcuts import P
+
+
+class EmbeddingStore:
+    """
+    A directory of entries: each entry is a sub-directory named after the hash of its key and contains
+        1. the embeddings as a '.npy' file (loaded as a memory map)
+        2. optionally the labels of the samples as a '.npy' file
+        3. a meta file written last: an entry without a meta file is considered incomplete and ignored
+
+    The 'int8' dtype stores the codes and a float32 scale per vector (~4x less disk space than float32): such entries are decoded
+    into float32 on load and are not memory-mapped.
+    """
+    _embeddings_file = 'embeddings.npy'
+    _scales_file = 'scales.npy'
+    _labels_file = 'labels.npy'
+    _meta_file = 'meta.json'
+
+    __supported_dtypes = ['float16', 'float32', 'int8']
+
+    def __init__(self, cache_dir: P, dtype: str = 'float32') -> None:
+        if dtype not in self.__supported_dtypes:
+            raise NotImplementedError(f"The embeddings store supports only the following dtypes: {self.__supported_dtypes}. Found: {dtype}")
+
+        self.cache_dir = dirf.process_path(cache_dir, dir_ok=True, file_ok=False)
+        self.dtype = dtype
+
+    @property
+    def memory_mapped(self) -> bool:
+        # whether the loaded embeddings are backed by the files of the entry (only the rows read are brought to memory)
+        return self.dtype != 'int8'
+
+    def key(self,
+            dataset: Dataset,
+            model: torch.nn.Module,
+            model_ckpnt: Optional[Union[str, P, callable]] = None,
+            **callables) -> Optional[Dict[str, str]]:
+        """
+        Returns None (the embeddings are not cached) if the dataset cannot be identified by its content (see 'dataset_fingerprint')
+        """
+        fingerprint = dataset_fingerprint(dataset)
+        if fingerprint is None:
+            warnings.warn(f"Could not find the listing of the dataset of type: {type(dataset)}. Its embeddings are not cached")
+            return None
+
+        # a checkpoint file is hashed directly: the model weights are hashed only if the checkpoint is not a file
+        if isinstance(model_ckpnt, (str, os.PathLike)):
+            model_hash = hash_file(model_ckpnt)
+        else:
+            model_hash = hash_model(model)
+
+        key = {"dataset": fingerprint, "model": model_hash, "dtype": self.dtype}
+        key.update({name: hash_callable(c) for name, c in sorted(callables.items())})
+        return key
+
+    def _entry_dir(self, key: Dict[str, str]) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest())
+
+    def load(self, key: Dict[str, str]) -> Optional[Tuple[torch.Tensor, Optional[np.ndarray]]]:
+        entry = self._entry_dir(key)
+        meta_path = os.path.join(entry, self._meta_file)
+
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        # any change in the dataset listing, the checkpoint or the callables leads to a different key
+        if meta['key'] != key:
+            return None
+
+        # the 'c' (copy-on-write) mode returns a writable array (required by torch.from_numpy) without ever modifying the file
+        embeddings = torch.from_numpy(np.load(os.path.join(entry, self._embeddings_file), mmap_mode='c'))
+        if self.dtype == 'int8':
+            embeddings = embeddings.to(torch.float32) * torch.from_numpy(np.load(os.path.join(entry, self._scales_file))).unsqueeze(1)
+
+        labels = np.load(os.path.join(entry, self._labels_file), mmap_mode='r') if meta['has_labels'] else None
+
+        return embeddings, labels
+
+    def save(self,
+             key: Dict[str, str],
+             embeddings: torch.Tensor,
+             labels: Optional[np.ndarray] = None) -> Tuple[torch.Tensor, Optional[np.ndarray]]:
+        entry = self._entry_dir(key)
+
+        # remove any incomplete entry
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+
+        embeddings = embeddings.cpu()
+        if self.dtype == 'int8':
+            # symmetric quantization with a scale per vector: embeddings ~ codes * scale
+            embeddings = embeddings.to(torch.float32)
+            scales = (embeddings.abs().amax(dim=1) / 127).clamp(min=10 ** -12)
+            embeddings = torch.round(embeddings / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+            np.save(os.path.join(entry, self._scales_file), scales.numpy())
+
+        mm = np.lib.format.open_memmap(os.path.join(entry, self._embeddings_file),
+                                       mode='w+',
+                                       dtype=self.dtype,
+                                       shape=tuple(embeddings.shape))
+        mm[:] = embeddings.numpy()
+        mm.flush()
+        del mm
+
+        if labels is not None:
+            np.save(os.path.join(entry, self._labels_file), np.asarray(labels))
+
+        with open(os.path.join(entry, self._meta_file), 'w') as f:
+            json.dump({"key": key, "num_samples": len(embeddings), "has_labels": labels is not None}, f)
+
+        return self.load(key)
+
+    def clear(self) -> None:
+        for entry in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, entry))
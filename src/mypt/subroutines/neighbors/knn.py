@@ -8,14 +8,18 @@ import numpy as np
 
 from pathlib import Path
 from typing import Union, Optional, Tuple, List
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Subset
 from tqdm import tqdm
-from collections import Counter,defaultdict
 from functools import partial
 
 from ...code_utilities import pytorch_utilities as pu
+from ...code_utilities.fingerprints import hash_model
 from ...data.dataloaders.standard_dataloaders import initialize_val_dataloader
-from ...shortcuts import str2distance
+from ...shortcuts import str2distance, P
+from .embeddings_store import EmbeddingStore
+from .topk import init_topk_buffers, merge_topk, masked_topk
+from .sharded_search import ShardedSearcher
+from .ann_index import NeighborsIndex
 
 
 class KNN:
@@ -94,6 +98,12 @@ class KNN:
 
                 model_ckpnt: Optional[Union[str, Path, callable]]=None, 
                 inference_device:Optional[str]=None,
+                embeddings_cache_dir: Optional[P]=None,
+                embeddings_dtype: str='float32',
+                index: Optional[NeighborsIndex]=None,
+                num_shards: int=1,
+                shard_backend: str='process',
+                shard_devices: Optional[List[str]]=None,
                 ) -> None:
 
         # the train dataset
@@ -139,19 +149,52 @@ class KNN:
                 self._load_model()            
             except Exception as e:
                 raise ValueError(f"The passed checkpoint raised the following error: {e}")
+
+        # the embeddings of the train dataset: computed once when predicting with 'embed_once' set to True (and again if the model weights change)
+        self.train_embeddings: Optional[torch.Tensor] = None
+        # the labels of the train dataset (only saved by classifiers)
+        self.train_labels: Optional[np.ndarray] = None
+        # whether the train embeddings are memory-mapped from the embeddings store (rather than held in memory)
+        self._embeddings_mapped = False
+        # a hash of the model weights the train embeddings (and the index / shards over them) were computed with
+        self._embeddings_model_hash: Optional[str] = None
+
+        # persisting the train embeddings on the disk avoids running the model on the train dataset across calls and runs
+        self.embeddings_store = EmbeddingStore(embeddings_cache_dir, dtype=embeddings_dtype) if embeddings_cache_dir is not None else None
+
+        # an (optionally approximate) index built on top of the train embeddings
+        self.index = index
+        self._index_built = False
+
+        # tombstones of the removed train samples: ignored by the search until the next compaction
+        self.removed: Optional[torch.Tensor] = None
+
+        # the train embeddings can be split into shards searched in parallel (worker processes or threads)
+        if num_shards < 1:
+            raise ValueError(f"The number of shards must be a positive integer. Found: {num_shards}")
+
+        self.num_shards = num_shards
+        self.shard_backend = shard_backend
+        self.shard_devices = shard_devices
+        # the shards (and the worker processes searching them) are created once per reference set: released by 'close' or any change of the reference set
+        self._searcher: Optional[ShardedSearcher] = None
             
     
     def __build_candidates(self, 
                           train_dl: DataLoader, 
                           val_dl: DataLoader,
+                          num_queries: int,
                           num_neighbors:int,
                           msr: callable,
                           measure_as_similarity:bool,
                           val_process_item_ds: callable,
-                          ) -> Tuple[dict, dict]:
+                          ) -> Tuple[torch.Tensor, torch.Tensor]:
 
-        nearest_neighbors_distances = {}
-        nearest_neighbors_indices = {}
+        # a preallocated (num_queries, k) buffer on the inference device, merged with the candidates of each reference batch 
+        values_res, indices_res = init_topk_buffers(num_queries=num_queries, 
+                                                    k=num_neighbors, 
+                                                    measure_as_similarity=measure_as_similarity, 
+                                                    device=self.inference_device)
 
         ref_count = 0
 
@@ -170,84 +213,385 @@ class KNN:
 
                     distances2ref = msr(inf_b_embs, ref_b_embs)
 
-                # find the closest samples for the current batch
-                values, local_indices  = torch.topk(distances2ref, 
-                                                    k=min(num_neighbors, len(distances2ref[0])), 
-                                                    dim=-1, 
-                                                    largest=measure_as_similarity)
-                # the indices should be convert to global indices with respect to the training dataset
-                global_indices = (local_indices + ref_count).cpu().numpy()
+                # find the closest samples for the current batch: the indices are converted to global indices with respect to the training dataset
+                values, global_indices = masked_topk(distances2ref, 
+                                                     k=num_neighbors, 
+                                                     measure_as_similarity=measure_as_similarity, 
+                                                     removed=self._removed_block(ref_count, ref_count + len(ref_b_embs)), 
+                                                     offset=ref_count)
 
-                values = values.cpu().numpy()                             
+                batch_slice = slice(inf_count, inf_count + len(inf_b_embs))
+                values_res[batch_slice], indices_res[batch_slice] = merge_topk(values=values_res[batch_slice], 
+                                                                               indices=indices_res[batch_slice], 
+                                                                               new_values=values, 
+                                                                               new_indices=global_indices, 
+                                                                               measure_as_similarity=measure_as_similarity)
 
-                for i in range(len(inf_b)):
+                # make sure to increase the 'inf_count' variable
+                inf_count += len(inf_b_embs)
+
+            ref_count += len(ref_b_embs)
+
+        # if the train dataset has less than 'num_neighbors' samples, the last columns are never filled 
+        k = min(num_neighbors, ref_count)
+        return values_res[:, :k], indices_res[:, :k]
+
+
+    def _embed_dataset(self, 
+                       dataset: Dataset, 
+                       batch_size: int,
+                       process_item_ds: callable,
+                       num_workers: int, 
+                       desc: str) -> torch.Tensor:
+        """
+        Passes the entire dataset through the (already loaded) model exactly once and returns the embeddings 
+        as a contiguous matrix of shape (len(dataset), embedding_dim) saved on the cpu
+        """
+        dl = initialize_val_dataloader(dataset, 
+                                       seed=0, 
+                                       batch_size=batch_size, 
+                                       num_workers=num_workers,
+                                       warning=False)
+
+        embeddings = None
+        count = 0
+
+        for b in tqdm(dl, desc=desc):
+            b = process_item_ds(b)
+            with torch.no_grad():
+                b_embs = self.process_model_output(self.model, b.to(self.inference_device))
 
-                    if inf_count + i not in nearest_neighbors_distances:
+            if embeddings is None:
+                # the embedding dimension is only known after the first batch: preallocate the matrix at this point
+                embeddings = torch.empty(size=(len(dataset),) + tuple(b_embs.shape[1:]), dtype=b_embs.dtype)
 
-                        nearest_neighbors_distances[inf_count + i] = values[[i], :]
-                        nearest_neighbors_indices[inf_count + i] = global_indices[[i], :] 
+            embeddings[count: count + len(b_embs)] = b_embs.cpu()
+            count += len(b_embs)
 
-                    else:
+        return embeddings
 
-                        nearest_neighbors_distances[inf_count + i] = np.concatenate([nearest_neighbors_distances[inf_count + i], 
-                                                                                     values[[i], :]
-                                                                                     ], # extracting the values as an np.array with shape [1, width] 
-                                                                                     axis=1)
-                        
-                        nearest_neighbors_indices[inf_count + i] = np.concatenate([nearest_neighbors_indices[inf_count + i], 
-                                                                                   global_indices[[i], :]
-                                                                                   ], 
-                                                                                   axis=1)
 
+    def _extract_labels(self, dataset: Dataset) -> Optional[np.ndarray]:
+        # the KNN class does not use labels: classifiers override this method
+        return None
+
+    def _extract_train_labels(self) -> Optional[np.ndarray]:
+        if self.train_labels is not None:
+            return self.train_labels
+        return self._extract_labels(self.train_ds)
+
+    def _on_reference_change(self) -> None:
+        # called whenever samples are added to / removed from the reference set: classifiers reset their label lookup
+        pass
+
+    def _store_callables(self) -> dict:
+        # the callables whose outputs are persisted with the train embeddings: changing any of them invalidates the stored entry
+        return {"process_item_ds": self.process_item_ds, "process_model_output": self.process_model_output}
+
+
+    def _train_embeddings(self, num_workers: int) -> torch.Tensor:
+        # the train dataset is embedded only once and reused across calls to the predict method
+        if self.train_embeddings is not None:
+            return self.train_embeddings
+
+        if self.embeddings_store is not None:
+            # the model is loaded at this point: the key reflects the weights used for inference
+            key = self._store_key()
+            entry = self.embeddings_store.load(key) if key is not None else None
+
+            if entry is not None:
+                self.train_embeddings, self.train_labels = entry
+                self._embeddings_mapped = self.embeddings_store.memory_mapped
+                return self.train_embeddings
+
+        self.train_embeddings = self._embed_dataset(dataset=self.train_ds, 
+                                                    batch_size=self.tbs, 
+                                                    process_item_ds=self.process_item_ds, 
+                                                    num_workers=num_workers, 
+                                                    desc="embedding the train_ds")
+        self._embeddings_mapped = False
+
+        self._persist_train_embeddings()
+        return self.train_embeddings
 
-                # make sure to increase the 'inf_count' variable
-                inf_count += len(inf_b)
-        
-            # assert len(nearest_neighbors_distances) == len(nearest_neighbors_indices)
-            ref_count += len(ref_b)
-
-        return nearest_neighbors_distances, nearest_neighbors_indices
-
-
-    def __filter_candidates(self, 
-                            nearest_neighbors_distances: dict[int, np.ndarray], 
-                            nearest_neighbors_indices: dict[int, np.ndarray],
-                            num_neighbors: int, 
-                            measure_as_similarity:bool,
-                            batch_size:int, 
-                            num_samples:int
-                            ) -> Tuple[np.ndarray, np.ndarray]:
-        # first extract the candidates
-        values_res = None
-        indices_res = None
-
-        for batch_index_start in range(0, num_samples, batch_size):
-            vs = np.concatenate([nearest_neighbors_distances[batch_index_start + i] 
-                                 for i in 
-                                 range(min(batch_size, num_samples - batch_index_start))
-                                ], 
-                                axis=0)
-            
-            gis = np.concatenate([nearest_neighbors_indices[batch_index_start + i] for i in range(min(batch_size, num_samples - batch_index_start))], axis=0)
 
-            batch_best_values, intermediate_indices  = torch.topk(torch.from_numpy(vs).to(self.inference_device), 
-                                                                  k=num_neighbors, 
-                                                                  dim=-1, 
-                                                                  largest=measure_as_similarity)
+    def _store_key(self) -> Optional[dict]:
+        return self.embeddings_store.key(dataset=self.train_ds, 
+                                         model=self.model, 
+                                         model_ckpnt=self.ckpnt, 
+                                         **self._store_callables())
 
-            # batch_best_indices = gis[:, ]
-            batch_best_indices = gis[[[i] for i in range(len(gis))], intermediate_indices.cpu().tolist()]
+    def _persist_train_embeddings(self) -> None:
+        if self.embeddings_store is None or self.train_embeddings is None:
+            return
 
-            batch_best_values = batch_best_values.cpu().numpy()
+        key = self._store_key()
+        if key is None:
+            return
 
-            if values_res is None:
-                values_res = batch_best_values
-                indices_res = batch_best_indices
-            else:
-                values_res = np.concatenate([values_res, batch_best_values], axis=0)
-                indices_res = np.concatenate([indices_res, batch_best_indices], axis=0)
+        self.train_embeddings, self.train_labels = self.embeddings_store.save(key, 
+                                                                              embeddings=self.train_embeddings, 
+                                                                              labels=self._extract_train_labels())
+        self._embeddings_mapped = self.embeddings_store.memory_mapped
 
-        # These functions are not supposed to be called directly, the model won't be moved back to the cpu...
+    def _offload_train_embeddings(self) -> None:
+        # once built, the index holds the reference set: the train embeddings are kept only if memory-mapped from the store
+        # (e.g. for the re-ranking of a quantized index), otherwise their float32 copy is released
+        if self.index is None or not self._index_built or self.train_embeddings is None:
+            return
+
+        if self._embeddings_mapped:
+            self.index.reattach(self.train_embeddings)
+        else:
+            self.train_embeddings = None
+
+    def _removed_block(self, start: int, end: int) -> Optional[torch.Tensor]:
+        if self.removed is None:
+            return None
+        return self.removed[start: end].to(self.inference_device)
+
+
+    def add(self, dataset: Dataset, num_workers: int = 2) -> None:
+        """
+        Adds the samples of 'dataset' to the reference set: their indices follow the existing ones. 
+        If the train embeddings were already computed, only the new samples are passed through the model.
+        """
+        if len(dataset) == 0:
+            raise ValueError(f"Make sure not to pass an empty dataset. The dataset passed is of length: {len(dataset)}")
+
+        self.train_ds = ConcatDataset([self.train_ds, dataset])
+
+        if self.train_labels is not None:
+            new_labels = self._extract_labels(dataset)
+            self.train_labels = None if new_labels is None else np.concatenate([np.asarray(self.train_labels), new_labels])
+
+        if self.removed is not None:
+            self.removed = torch.cat([self.removed, torch.zeros(len(dataset), dtype=torch.bool)])
+
+        self._on_reference_change()
+
+        if self.train_embeddings is None and not self._index_built:
+            # the new samples will be embedded with the rest of the reference set at the next prediction
+            return
+
+        self._load_model()
+        # the reference set embedded with other weights is embedded again (with the new samples) at the next prediction
+        self._check_model_unchanged()
+        if self.train_embeddings is None and not self._index_built:
+            self.model = self.model.to('cpu')
+            return
+
+        new_embs = self._embed_dataset(dataset=dataset, 
+                                       batch_size=self.tbs, 
+                                       process_item_ds=self.process_item_ds, 
+                                       num_workers=num_workers, 
+                                       desc="embedding the added samples")
+        self.model = self.model.to('cpu')
+
+        if self.train_embeddings is not None:
+            self.train_embeddings = torch.cat([self.train_embeddings, new_embs.to(self.train_embeddings.dtype)], dim=0)
+            self._embeddings_mapped = False
+            self._release_searcher()
+
+        if self.index is not None and self._index_built:
+            self.index.add(new_embs)
+
+        self._persist_train_embeddings()
+        self._offload_train_embeddings()
+
+
+    def remove(self, indices: Union[List[int], np.ndarray, torch.Tensor], compaction_threshold: float = 0.25) -> None:
+        """
+        Marks the given samples of the reference set as removed (tombstones). Once the portion of removed samples reaches 
+        'compaction_threshold', the reference set is compacted: the remaining samples are re-indexed consecutively.
+        """
+        indices = torch.as_tensor(np.asarray(indices), dtype=torch.int64).reshape(-1)
+
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self.train_ds)):
+            raise IndexError(f"The indices to remove must be in the range [0, {len(self.train_ds)}). Found: min: {indices.min().item()}, max: {indices.max().item()}")
+
+        # the new tombstones are validated before being committed: a failed call leaves the reference set (and the index) unchanged
+        removed = self.removed.clone() if self.removed is not None else torch.zeros(len(self.train_ds), dtype=torch.bool)
+        removed[indices] = True
+
+        if bool(removed.all()):
+            raise ValueError(f"The reference set cannot be empty: all samples were removed")
+
+        self.removed = removed
+
+        if self.index is not None and self._index_built:
+            self.index.remove(indices)
+
+        if self.removed.float().mean().item() >= compaction_threshold:
+            self.compact()
+
+
+    def compact(self) -> None:
+        """
+        Physically removes the samples marked as removed from the reference set, its embeddings, labels and index.
+        """
+        if self.removed is None or not bool(self.removed.any()):
+            return
+
+        keep = ~self.removed
+        keep_indices = torch.nonzero(keep).squeeze(1)
+
+        self.train_ds = Subset(self.train_ds, keep_indices.tolist())
+
+        if self.train_embeddings is not None:
+            self.train_embeddings = self.train_embeddings[keep_indices]
+            self._embeddings_mapped = False
+            self._release_searcher()
+
+        if self.train_labels is not None:
+            self.train_labels = np.asarray(self.train_labels)[keep_indices.numpy()]
+
+        if self.index is not None and self._index_built:
+            self.index.compact(keep)
+
+        self.removed = None
+        self._on_reference_change()
+        self._persist_train_embeddings()
+        self._offload_train_embeddings()
+
+
+    def _search_embeddings(self, 
+                           query_embs: torch.Tensor, 
+                           ref_embs: torch.Tensor,
+                           num_neighbors: int,
+                           msr: callable,
+                           measure_as_similarity: bool,
+                           query_batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbors of each query embedding among the reference embeddings. Both sets of embeddings are precomputed, 
+        so this method only moves blocks of both matrices to the inference device(s). With more than one shard, the reference embeddings 
+        are split into shards searched in parallel (the results are identical to the single shard search)
+        """
+        return self._sharded_searcher(ref_embs).search(query_embs, 
+                                                       k=num_neighbors, 
+                                                       msr=msr, 
+                                                       measure_as_similarity=measure_as_similarity, 
+                                                       query_batch_size=query_batch_size, 
+                                                       removed=self.removed)
+
+    def _sharded_searcher(self, ref_embs: torch.Tensor) -> ShardedSearcher:
+        # the searcher (its shards and workers) is reused as long as the reference embeddings do not change
+        if self._searcher is None or self._searcher.ref_embs is not ref_embs:
+            self._release_searcher()
+            self._searcher = ShardedSearcher(ref_embs, 
+                                             num_shards=self.num_shards, 
+                                             ref_batch_size=self.tbs, 
+                                             backend=self.shard_backend, 
+                                             devices=self.shard_devices if self.shard_devices is not None else [self.inference_device])
+        return self._searcher
+
+    def _release_searcher(self) -> None:
+        if self._searcher is not None:
+            self._searcher.close()
+            self._searcher = None
+
+    def close(self) -> None:
+        """
+        Releases the worker processes (and the shared memory) of the sharded search
+        """
+        self._release_searcher()
+
+
+    def invalidate_train_embeddings(self) -> None:
+        """
+        Drops the train embeddings, the index built over them and the shards: the train dataset is embedded again at the next prediction
+        """
+        self.train_embeddings = None
+        self._embeddings_mapped = False
+        self._embeddings_model_hash = None
+        self._index_built = False
+        self._release_searcher()
+
+    def _check_model_unchanged(self) -> None:
+        # the weights are hashed at each call (one pass over the parameters, much cheaper than embedding the train dataset):
+        # the train embeddings computed with different weights are stale
+        model_hash = hash_model(self.model)
+        if self._embeddings_model_hash is not None and self._embeddings_model_hash != model_hash:
+            self.invalidate_train_embeddings()
+        self._embeddings_model_hash = model_hash
+
+    def _prepare_reference(self, num_workers: int) -> None:
+        """
+        Computes (or loads) the train embeddings and builds the index (if any) or the shards over them. All are kept for the next calls
+        as long as the model weights do not change.
+        """
+        self._check_model_unchanged()
+
+        if self.index is None:
+            self._sharded_searcher(self._train_embeddings(num_workers=num_workers))
+            return
+
+        if self._index_built:
+            return
+
+        self.index.build(self._train_embeddings(num_workers=num_workers))
+        self._index_built = True
+
+        if self.removed is not None:
+            self.index.remove(torch.nonzero(self.removed).squeeze(1))
+
+        self._offload_train_embeddings()
+
+
+    def _search(self, 
+                query_embs: torch.Tensor, 
+                num_neighbors: int,
+                msr: callable,
+                measure_as_similarity: bool,
+                query_batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        # the reference set must be prepared beforehand
+        if self.index is not None:
+            values_res, indices_res = self.index.search(query_embs, k=num_neighbors)
+            return values_res.cpu().numpy(), indices_res.cpu().numpy()
+
+        return self._search_embeddings(query_embs=query_embs, 
+                                       ref_embs=self.train_embeddings, 
+                                       num_neighbors=num_neighbors, 
+                                       msr=msr, 
+                                       measure_as_similarity=measure_as_similarity, 
+                                       query_batch_size=query_batch_size)
+
+
+    def _check_index_measure(self, measure: Union[str, callable, torch.nn.Module], measure_as_similarity: bool) -> None:
+        if self.index is not None and (measure != self.index.measure or measure_as_similarity != self.index.measure_as_similarity):
+            raise ValueError(f"The index was created with the measure: {self.index.measure} (measure_as_similarity: {self.index.measure_as_similarity}). Found: {measure} (measure_as_similarity: {measure_as_similarity})")
+
+
+    def _find_neighbors_embed_once(self, 
+                                   val_ds: Dataset,
+                                   num_neighbors:int,
+                                   msr: callable,
+                                   measure_as_similarity:bool,
+                                   val_process_item_ds: callable,
+                                   val_batch_size:int,
+                                   num_workers:int=2
+                                   ) -> Tuple[np.ndarray, np.ndarray]:
+
+        if isinstance(msr, torch.nn.Module):
+            msr = msr.to(self.inference_device)
+
+        self._prepare_reference(num_workers=num_workers)
+
+        query_embs = self._embed_dataset(dataset=val_ds, 
+                                         batch_size=val_batch_size, 
+                                         process_item_ds=val_process_item_ds, 
+                                         num_workers=num_workers, 
+                                         desc="embedding the val_ds")
+
+        values_res, indices_res = self._search(query_embs=query_embs, 
+                                               num_neighbors=num_neighbors, 
+                                               msr=msr, 
+                                               measure_as_similarity=measure_as_similarity, 
+                                               query_batch_size=val_batch_size)
+
+        self.model = self.model.to('cpu')
+        if isinstance(msr, torch.nn.Module):
+            msr = msr.cpu()
 
         return values_res, indices_res
 
@@ -277,20 +621,16 @@ class KNN:
         if isinstance(msr, torch.nn.Module):
             msr = msr.to(self.inference_device)
 
-        nearest_neighbors_distances, nearest_neighbors_indices = self.__build_candidates(train_dl=train_dl, 
-                                                                                         val_dl=val_dl,
-                                                                                         num_neighbors=num_neighbors, 
-                                                                                         msr=msr, 
-                                                                                         measure_as_similarity=measure_as_similarity, 
-                                                                                         val_process_item_ds=val_process_item_ds,
-                                                                                        )
-        
-        values_res, indices_res = self.__filter_candidates(nearest_neighbors_distances=nearest_neighbors_distances,
-                                        nearest_neighbors_indices=nearest_neighbors_indices, 
-                                        num_neighbors=num_neighbors,
-                                        measure_as_similarity=measure_as_similarity,
-                                        batch_size=val_batch_size,
-                                        num_samples=len(val_ds))
+        values_res, indices_res = self.__build_candidates(train_dl=train_dl, 
+                                                          val_dl=val_dl,
+                                                          num_queries=len(val_ds),
+                                                          num_neighbors=num_neighbors, 
+                                                          msr=msr, 
+                                                          measure_as_similarity=measure_as_similarity, 
+                                                          val_process_item_ds=val_process_item_ds,
+                                                          )
+
+        values_res, indices_res = values_res.cpu().numpy(), indices_res.cpu().numpy()
 
         # move the model back to cpu
         self.model = self.model.to('cpu')
@@ -312,8 +652,11 @@ class KNN:
                 process_item_ds: Optional[callable]=None,
                 process_model_output: Optional[callable]=None,
                 num_workers:int=2,
+                embed_once: bool=False,
                 ) -> Tuple[np.ndarray, np.ndarray]:
 
+        self._check_index_measure(measure, measure_as_similarity)
+
         msr = self._measures(measure, measure_init_kargs)
 
         # process the batch size
@@ -328,8 +671,12 @@ class KNN:
             process_model_output = self.process_model_output
 
         self._load_model()
-        
-        res = self._find_neighbors( 
+
+        # embedding both datasets once trades memory (the embeddings of both datasets) for a single pass of each sample through the model
+        # (the embeddings store, the index and the sharded search require the train embeddings to be computed once)
+        find_neighbors = self._find_neighbors_embed_once if (embed_once or self.embeddings_store is not None or self.index is not None or self.num_shards > 1) else self._find_neighbors
+
+        res = find_neighbors( 
                         val_ds=val_ds,
                         num_neighbors=num_neighbors,
                         msr=msr,
@@ -356,7 +703,13 @@ class KnnClassifier(KNN):
                 process_model_output: Optional[callable]=None,
 
                 model_ckpnt: Optional[Union[str, Path, callable]]=None, 
-                inference_device:Optional[str]=None):
+                inference_device:Optional[str]=None,
+                embeddings_cache_dir: Optional[P]=None,
+                embeddings_dtype: str='float32',
+                index: Optional[NeighborsIndex]=None,
+                num_shards: int=1,
+                shard_backend: str='process',
+                shard_devices: Optional[List[str]]=None):
 
         super().__init__(
                         train_ds=train_ds,
@@ -367,42 +720,112 @@ class KnnClassifier(KNN):
                         process_model_output=process_model_output,
 
                         model_ckpnt=model_ckpnt, 
-                        inference_device=inference_device)
+                        inference_device=inference_device,
+                        embeddings_cache_dir=embeddings_cache_dir,
+                        embeddings_dtype=embeddings_dtype,
+                        index=index,
+                        num_shards=num_shards,
+                        shard_backend=shard_backend,
+                        shard_devices=shard_devices)
         
+        # the labels can be read from the dataset's metadata (without loading the samples) only with the default label lookup
+        self._default_label_lookup = process_item_ds_class is None
+
         if process_item_ds_class is None:
             warnings.warn("the 'process_item_ds_class' is not Passed. The class assumes that the dataset is a classification dataset where each item is a tuple of an image and a classification label")
             process_item_ds_class = lambda ds, index: ds[index][1] #  
 
         self.process_item_ds_class = process_item_ds_class
 
+        # the sorted unique labels and the index of the label of each train sample in this array: set once, at the first prediction
+        self.classes: Optional[np.ndarray] = None
+        self.train_label_ids: Optional[torch.Tensor] = None
 
-    def __predict_per_sample(self, 
-                             sample_distances: Union[List[float]], 
-                             sample_classes: Union[List[int]], 
-                             measure_as_similarity: bool) -> int:
 
-        counter = Counter(sample_classes)
-        max_freq = max([v for _, v in counter.items()])
-        modes = [k for k, v in counter.items() if v == max_freq]
+    def _extract_labels(self, dataset: Dataset) -> np.ndarray:
+        # the reference set might have been extended / compacted
+        if isinstance(dataset, ConcatDataset):
+            return np.concatenate([self._extract_labels(d) for d in dataset.datasets])
 
-        if len(modes) == 1:
-            return modes[0]
+        if isinstance(dataset, Subset):
+            return self._extract_labels(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
 
-        msr_dict = defaultdict(lambda : [])
+        # the metadata holds the raw labels: a 'target_transform' (torchvision convention) is only applied by __getitem__
+        if self._default_label_lookup and getattr(dataset, 'target_transform', None) is None:
+            # the labels of the torchvision classification datasets (and the ones following the same conventions) 
+            for attr in ['targets', '_labels', 'labels']:
+                labels = getattr(dataset, attr, None)
+                if labels is not None and len(labels) == len(dataset):
+                    return np.asarray(labels)
 
-        if measure_as_similarity:
-            for index,c in enumerate(sample_classes):
-                if c in modes:
-                    msr_dict[c].append(sample_distances[index])
-            label = max(msr_dict, key=lambda x: np.mean(msr_dict[x]))
-            return label
+            for attr in ['samples', '_samples']:
+                samples = getattr(dataset, attr, None)
+                if samples is not None and len(samples) == len(dataset):
+                    return np.asarray([s[1] for s in samples])
+
+        # the fallback: load each sample exactly once
+        return np.asarray([self.process_item_ds_class(dataset, index) 
+                           for index in tqdm(range(len(dataset)), desc="extracting the labels of the reference samples")])
+
+    def _on_reference_change(self) -> None:
+        # the label ids are recomputed at the next prediction
+        self.classes, self.train_label_ids = None, None
+
+    def _store_callables(self) -> dict:
+        callables = super()._store_callables()
+        callables["process_item_ds_class"] = self.process_item_ds_class
+        return callables
+
+    def _set_train_label_ids(self) -> None:
+        if self.train_label_ids is not None:
+            return
+
+        if self.train_labels is None:
+            self.train_labels = self._extract_train_labels()
 
-        for index,c in enumerate(sample_classes):
-            if c in modes:
-                msr_dict[c].append(sample_distances[index])
+        # map the labels (of any type) to consecutive integers for the vectorized voting
+        self.classes, label_ids = np.unique(np.asarray(self.train_labels), return_inverse=True)
+        self.train_label_ids = torch.from_numpy(label_ids.reshape(-1).astype(np.int64))
 
-        label = min(msr_dict, key=lambda x: np.mean(msr_dict[x]))
-        return label
+
+    @classmethod
+    def _vote(cls, 
+              values: torch.Tensor, 
+              neighbor_labels: torch.Tensor, 
+              valid: torch.Tensor,
+              num_classes: int,
+              measure_as_similarity: bool, 
+              weighted: bool) -> torch.Tensor:
+        """
+        Returns the winning class (as an index) of each row. Each neighbor votes for its class: with a weight of 1 or, if 'weighted' is True, 
+        with a weight of 'exp(similarity)' or '1 / distance'. Ties are broken by the mean measure of the tied classes' neighbors.
+        The rows without any valid neighbor are assigned -1.
+        """
+        valid = valid.to(values.dtype)
+        # the missing neighbors (index -1) might have infinite values: zero them out to avoid 'inf * 0' 
+        values = torch.where(valid.bool(), values, torch.zeros_like(values))
+
+        if weighted:
+            weights = torch.exp(values) if measure_as_similarity else 1 / (values.clamp(min=0) + 10 ** -8)
+            weights = weights * valid
+        else:
+            weights = valid
+
+        votes = torch.zeros(len(values), num_classes, dtype=values.dtype).scatter_add_(1, neighbor_labels, weights)
+        counts = torch.zeros(len(values), num_classes, dtype=values.dtype).scatter_add_(1, neighbor_labels, valid)
+        sums = torch.zeros(len(values), num_classes, dtype=values.dtype).scatter_add_(1, neighbor_labels, values * valid)
+
+        mean_measure = sums / counts.clamp(min=1)
+
+        # only the classes with the maximum number of votes (the modes) compete in the tie-break
+        modes = (votes == votes.max(dim=1, keepdim=True).values) & (counts > 0)
+
+        if measure_as_similarity:
+            winners = torch.where(modes, mean_measure, torch.full_like(mean_measure, -float('inf'))).argmax(dim=1)
+        else:
+            winners = torch.where(modes, mean_measure, torch.full_like(mean_measure, float('inf'))).argmin(dim=1)
+
+        return torch.where(counts.sum(dim=1) > 0, winners, torch.full_like(winners, -1))
 
 
     def predict(
@@ -417,7 +840,10 @@ class KnnClassifier(KNN):
 
             process_item_ds: Optional[callable]=None,
             process_model_output: Optional[callable]=None,
-            num_workers:int=2) -> np.ndarray:
+            num_workers:int=2,
+            embed_once: bool=False,
+            weighted_voting: bool=False,
+            voting_batch_size: int=4096) -> np.ndarray:
         # let's see how it goes
         distances_res, indices_res =super().predict(val_ds=val_ds,
                                                 inference_batch_size=inference_batch_size,
@@ -427,15 +853,46 @@ class KnnClassifier(KNN):
                                                 measure_init_kargs=measure_init_kargs,
                                                 process_item_ds=process_item_ds,
                                                 process_model_output=process_model_output,
-                                                num_workers=num_workers                        
+                                                num_workers=num_workers,
+                                                embed_once=embed_once
                                                 )   
 
-        classes = np.asarray([[self.process_item_ds_class(self.train_ds, index) for index in arr_indices] for arr_indices in indices_res])
-
-        predictions = np.asarray([self.__predict_per_sample(distances_res[i, :].tolist(), 
-                                                            classes[i, :].tolist(), 
-                                                            measure_as_similarity) 
-                                    for i in range(len(classes))
-                                ])
-
-        return predictions
+        return self._vote_neighbors(values_res=distances_res, 
+                                    indices_res=indices_res, 
+                                    measure_as_similarity=measure_as_similarity, 
+                                    weighted_voting=weighted_voting, 
+                                    voting_batch_size=voting_batch_size)
+
+
+    def _vote_neighbors(self, 
+                        values_res: np.ndarray, 
+                        indices_res: np.ndarray, 
+                        measure_as_similarity: bool, 
+                        weighted_voting: bool, 
+                        voting_batch_size: int) -> np.ndarray:
+        self._set_train_label_ids()
+
+        values = torch.from_numpy(np.asarray(values_res, dtype=np.float32))
+        indices = torch.from_numpy(np.asarray(indices_res, dtype=np.int64))
+
+        # approximate indices might not find all the neighbors (index -1)
+        valid = indices >= 0
+
+        predictions = torch.empty(len(indices), dtype=torch.int64)
+
+        for start in range(0, len(indices), voting_batch_size):
+            end = start + voting_batch_size
+            neighbor_labels = self.train_label_ids[indices[start:end].clamp(min=0)]
+            predictions[start:end] = self._vote(values=values[start:end], 
+                                                neighbor_labels=neighbor_labels, 
+                                                valid=valid[start:end], 
+                                                num_classes=len(self.classes), 
+                                                measure_as_similarity=measure_as_similarity, 
+                                                weighted=weighted_voting)
+
+        # all the neighbors of these queries were removed or missed by an approximate index
+        no_neighbors = torch.nonzero(predictions == -1).reshape(-1)
+        if len(no_neighbors) > 0:
+            raise ValueError(f"Found {len(no_neighbors)} queries without any valid neighbor (the first ones: {no_neighbors[:10].tolist()}). Consider increasing the number of neighbors (or the number of probes of the index)")
+
+        return self.classes[predictions.numpy()]
@@ -1,5 +1,6 @@
 import torchvision.transforms as tr 
-import os, torch, pickle
+import os, torch
+import numpy as np
 
 from typing import Union, Optional, Dict, List, Tuple
 from pathlib import Path
@@ -9,61 +10,97 @@ from tqdm import tqdm
 from ...code_utilities import pytorch_utilities as pu
 from ...code_utilities import directories_and_files as dirf 
 from ...shortcuts import str2distance
+from .topk import init_topk_buffers, merge_topk
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def _top_k_nearest_model(dataset: Dataset,
-                        get_sample_callable: callable,
-                        
-                        model: torch.nn.Module,
-                        
-                        batch_size: int, 
-                        k_neighbors: int,
-                  
-                        measure: Union[callable, torch.nn.Module] ,
-                        measure_as_similarity:bool,
-                        device:str,
-                        ) -> Dict[int, Tuple[List[int], List[int]]]:
-      results = {}
+# the built-in measures satisfying measure(x, y) = measure(y, x)
+_SYMMETRIC_MEASURES = ['cosine_sim', 'euclidean']
+
+def _embed_dataset(dataset: Dataset,
+                   get_sample_callable: callable,
+                   model: torch.nn.Module,
+                   batch_size: int,
+                   device: str) -> torch.Tensor:
+      """
+      Passes each sample through the model exactly once. The embeddings are returned as a (N, dim) matrix saved on the cpu
+      """
+      embeddings = None
 
-      for id1 in tqdm(range(0, len(dataset), batch_size), desc='finding the nearest neighbors'):
-            ref_batch = torch.stack([get_sample_callable(dataset, i) for i in range(id1, min(id1 + batch_size, len(dataset)))]).to(device)
+      for start in tqdm(range(0, len(dataset), batch_size), desc='embedding the dataset'):
+            batch = torch.stack([get_sample_callable(dataset, i) for i in range(start, min(start + batch_size, len(dataset)))]).to(device)
 
             # pass it through the model 
             try:
-                  ref_batch = model(ref_batch)  
+                  with torch.no_grad():
+                        batch_embs = model(batch)
             except:
                   raise ValueError(f"This function expects the __call__ function to return the final output of the model: only one tensor")
 
-            distances2ref = None
-      
-            for id2 in range(0, len(dataset), batch_size):
+            if embeddings is None:
+                  embeddings = torch.empty(size=(len(dataset),) + tuple(batch_embs.shape[1:]), dtype=batch_embs.dtype)
+
+            embeddings[start: start + len(batch_embs)] = batch_embs.cpu()
+
+      return embeddings
 
-                  batch = torch.stack([get_sample_callable(dataset, j) for j in range(id2, min(id2 + batch_size, len(dataset)))]).to(device)
 
-                  # pass through the model (no need for the try catch clause, as the first clause would raise an error in case of unexpected input !!)
-                  batch = model(batch)
+def _knn_graph(embeddings: torch.Tensor,
+               k_neighbors: int,
+               measure: Union[callable, torch.nn.Module],
+               measure_as_similarity: bool,
+               batch_size: int,
+               device: str,
+               symmetric_measure: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+      """
+      Computes the 'k_neighbors' nearest neighbors of each sample (excluding the sample itself) among the rest of the samples.
+      The (batch_size, batch_size) tiles of the measure are computed on the device and merged into a running (N, k) top-k: the memory is O(N * k).
+      For a symmetric measure, each tile is computed once and provides the candidates of both its rows and its columns.
 
-                  # compute the distance
-                  batch_dis = measure(ref_batch, batch).cpu()
+      Returns the (N, k) values of the measure and the (N, k) indices of the neighbors (both on the cpu)
+      """
+      n = len(embeddings)
+      k = min(k_neighbors, n - 1)
 
-                  if distances2ref is None:
-                        distances2ref = batch_dis
-                  else:
-                        distances2ref = torch.concat([distances2ref, batch_dis], dim=1)
+      if k <= 0:
+            raise ValueError(f"The dataset must contain at least 2 samples. Found: {n}")
 
-            values, indices  = torch.topk(distances2ref, k=k_neighbors + 1, dim=-1, largest=measure_as_similarity)
+      worst_value = -float('inf') if measure_as_similarity else float('inf')
+      values, indices = init_topk_buffers(num_queries=n, k=k, measure_as_similarity=measure_as_similarity, device=device)
 
-            # make sure to ignore the first element at each row as it should be the element itself
-            indices = indices[:, 1:]
-            values = values[:, 1:]
+      for r_start in tqdm(range(0, n, batch_size), desc='building the knn graph'):
+            r_end = min(r_start + batch_size, n)
+            row_block = embeddings[r_start: r_end].to(device)
 
-            # save the results for the current batch
-            batch_res = {id1 + i : list(zip(indices[i, :].squeeze().tolist(), values[i, :].squeeze().tolist())) # associating each index with a list of tuples (index, measure) 
-                         for i in range(len(indices))}
-            results.update(batch_res)
+            # with a symmetric measure, the tiles below the diagonal are the transpose of the ones above it
+            for c_start in range(r_start if symmetric_measure else 0, n, batch_size):
+                  c_end = min(c_start + batch_size, n)
+                  col_block = row_block if c_start == r_start else embeddings[c_start: c_end].to(device)
+
+                  with torch.no_grad():
+                        tile = measure(row_block, col_block).float()
+
+                  if c_start == r_start:
+                        # a sample is not its own neighbor
+                        tile.fill_diagonal_(worst_value)
+
+                  tile_values, tile_indices = torch.topk(tile, k=min(k, tile.shape[1]), dim=1, largest=measure_as_similarity)
+                  values[r_start: r_end], indices[r_start: r_end] = merge_topk(values=values[r_start: r_end], 
+                                                                               indices=indices[r_start: r_end], 
+                                                                               new_values=tile_values, 
+                                                                               new_indices=tile_indices + c_start, 
+                                                                               measure_as_similarity=measure_as_similarity)
+
+                  if symmetric_measure and c_start != r_start:
+                        tile_values, tile_indices = torch.topk(tile.T, k=min(k, tile.shape[0]), dim=1, largest=measure_as_similarity)
+                        values[c_start: c_end], indices[c_start: c_end] = merge_topk(values=values[c_start: c_end], 
+                                                                                     indices=indices[c_start: c_end], 
+                                                                                     new_values=tile_values, 
+                                                                                     new_indices=tile_indices + r_start, 
+                                                                                     measure_as_similarity=measure_as_similarity)
+
+      return values.cpu(), indices.cpu()
 
-      return results
 
 def topk_nearest_model_ckpnt(
                         results_directory: Union[str, Path],
@@ -80,8 +117,17 @@ def topk_nearest_model_ckpnt(
                         measure: Union[str, callable, torch.nn.Module] = 'cosine_sim',
                         measure_as_similarity:bool=True,
                         measure_init_kargs: Dict = None,
+                        symmetric_measure: Optional[bool] = None,
+
+                        res_file_name: str = None) -> Tuple[np.ndarray, np.ndarray]:
+      """
+      Builds the k-nearest-neighbors graph of the dataset in the embedding space of the model. 
+      The results are saved as two (N, k) arrays: '{res_file_name}_indices.npy' and '{res_file_name}_values.npy' 
+      where the i-th row contains the neighbors of the i-th sample (sorted from the closest) and the corresponding values of the measure.
 
-                        res_file_name: str = None) -> Dict:
+      'symmetric_measure' halves the number of computed tiles. It defaults to True only for the built-in symmetric measures ('cosine_sim', 'euclidean'): 
+      a callable measure must opt in explicitly (an asymmetric measure such as the KL divergence would lead to wrong neighbors).
+      """
       ########################################## set the model ##########################################
 
       device = pu.get_default_device()
@@ -145,6 +191,9 @@ def topk_nearest_model_ckpnt(
       
       measure_init_kargs = measure_init_kargs if measure_init_kargs is not None else {}
 
+      if symmetric_measure is None:
+            symmetric_measure = isinstance(measure, str) and measure in _SYMMETRIC_MEASURES
+
       if isinstance(measure, str):
             measure_str = measure
             try:
@@ -175,30 +224,32 @@ def topk_nearest_model_ckpnt(
 
       
       ########################################## find the neighbors ##########################################
-      results = _top_k_nearest_model(dataset=dataset,
-                        get_sample_callable=get_sample_callable,
-                        model=model,
-                        
-                        batch_size=batch_size, 
-                        k_neighbors=k_neighbors,
-                  
-                        measure=measure,
-                        measure_as_similarity=measure_as_similarity,
-                        device=device
-                        )
+      embeddings = _embed_dataset(dataset=dataset,
+                                  get_sample_callable=get_sample_callable,
+                                  model=model,
+                                  batch_size=batch_size,
+                                  device=device)
+
+      values, indices = _knn_graph(embeddings=embeddings,
+                                   k_neighbors=k_neighbors,
+                                   measure=measure,
+                                   measure_as_similarity=measure_as_similarity,
+                                   batch_size=batch_size,
+                                   device=device,
+                                   symmetric_measure=symmetric_measure)
 
       ########################################## Save the results on the file system ##########################################
       
       if res_file_name is None:
             if model_ckpnt is not None:
-                  res_file_name = os.path.splitext(os.path.basename(model_ckpnt))[0] + "_results.obj"
+                  res_file_name = os.path.splitext(os.path.basename(model_ckpnt))[0] + "_knn"
             else:
-                  res_file_name = "results.obj"
+                  res_file_name = "knn"
 
-      res_path = dirf.process_path(results_directory, file_ok=False)
-      res_path = os.path.join(results_directory, res_file_name)
+      results_directory = dirf.process_path(results_directory, file_ok=False)
 
-      with open(res_path, 'wb') as f:
-            pickle.dump(results, f)
+      indices, values = indices.numpy(), values.numpy()
+      np.save(os.path.join(results_directory, f"{res_file_name}_indices.npy"), indices)
+      np.save(os.path.join(results_directory, f"{res_file_name}_values.npy"), values)
 
-      return results
+      return indices, values
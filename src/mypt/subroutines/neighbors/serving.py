@@ -0,0 +1,212 @@
+"""
+This script implements a long-lived serving object for the KnnClassifier: the model stays on the inference device, the reference embeddings
+(and index) stay in memory and concurrent requests are grouped into micro-batches by a background thread.
+"""
+
+import time, queue, asyncio, threading, torch
+import numpy as np
+
+from concurrent.futures import Future
+from typing import Union, Optional, List, Tuple
+
+from .knn import KnnClassifier
+
+
+class KnnServer:
+    """
+    Wraps a KnnClassifier to answer single samples (or small lists of samples) with a low latency.
+
+    A request is queued by 'submit' and processed with the requests queued in the meantime: a micro-batch is run as soon as it
+    contains 'max_batch_size' samples or 'max_latency_ms' milliseconds after its first request arrived (whichever comes first).
+    A request that does not fit in the current micro-batch starts the next one; a single request larger than 'max_batch_size' is
+    processed in chunks of 'max_batch_size' samples.
+
+    A request raising an error (e.g. a sample of the wrong shape) fails only its own future: the other requests of its micro-batch
+    are answered.
+
+    The reference set (the index, or the shards and their worker processes) is prepared once by 'start' and released by 'stop'.
+    """
+    def __init__(self,
+                 classifier: KnnClassifier,
+                 num_neighbors: int,
+                 measure: Union[str, callable, torch.nn.Module] = 'cosine_sim',
+                 measure_as_similarity: bool = True,
+                 measure_init_kargs: dict = None,
+                 process_item: Optional[callable] = None,
+                 weighted_voting: bool = False,
+                 max_batch_size: int = 64,
+                 max_latency_ms: float = 5.0,
+                 num_workers: int = 2) -> None:
+
+        if max_batch_size < 1:
+            raise ValueError(f"The 'max_batch_size' must be a positive integer. Found: {max_batch_size}")
+
+        if max_latency_ms < 0:
+            raise ValueError(f"The 'max_latency_ms' must be non-negative. Found: {max_latency_ms}")
+
+        classifier._check_index_measure(measure, measure_as_similarity)
+
+        self.classifier = classifier
+        self.num_neighbors = num_neighbors
+        self.msr = classifier._measures(measure, measure_init_kargs) if isinstance(measure, str) else measure
+        self.measure_as_similarity = measure_as_similarity
+        # applied to each sample before stacking the micro-batch (e.g. a transform)
+        self.process_item = process_item if process_item is not None else (lambda x: x)
+        self.weighted_voting = weighted_voting
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.num_workers = num_workers
+
+        self._queue: queue.Queue = queue.Queue()
+        # a request held over to the next micro-batch (only accessed by the worker thread)
+        self._held = None
+        self._worker: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> 'KnnServer':
+        if self._worker is not None:
+            return self
+
+        # warm up: the model on the device, the reference embeddings (and index) and the labels are prepared once
+        self.classifier._load_model()
+        self.classifier._prepare_reference(num_workers=self.num_workers)
+        self.classifier._set_train_label_ids()
+
+        if isinstance(self.msr, torch.nn.Module):
+            self.msr = self.msr.to(self.classifier.inference_device)
+
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._serve, daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self) -> None:
+        if self._worker is None:
+            return
+
+        self._stop.set()
+        self._worker.join()
+        self._worker = None
+
+        # fail the requests that were never processed
+        if self._held is not None:
+            self._held[1].set_exception(RuntimeError("The server was stopped before processing the request"))
+            self._held = None
+
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.set_exception(RuntimeError("The server was stopped before processing the request"))
+
+        self.classifier.model = self.classifier.model.to('cpu')
+        self.classifier.close()
+
+    def __enter__(self) -> 'KnnServer':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def predict_batch(self, samples: torch.Tensor) -> np.ndarray:
+        """
+        Predicts the labels of a batch of (processed) samples synchronously: no queueing. The search reuses the reference set
+        prepared by 'start' (no shards or worker processes are created per call)
+        """
+        with torch.no_grad():
+            query_embs = self.classifier.process_model_output(self.classifier.model, samples.to(self.classifier.inference_device)).cpu()
+
+        values_res, indices_res = self.classifier._search(query_embs=query_embs,
+                                                          num_neighbors=self.num_neighbors,
+                                                          msr=self.msr,
+                                                          measure_as_similarity=self.measure_as_similarity,
+                                                          query_batch_size=len(query_embs))
+
+        return self.classifier._vote_neighbors(values_res=values_res,
+                                               indices_res=indices_res,
+                                               measure_as_similarity=self.measure_as_similarity,
+                                               weighted_voting=self.weighted_voting,
+                                               voting_batch_size=len(query_embs))
+
+    def submit(self, x: Union[torch.Tensor, List[torch.Tensor]]) -> Future:
+        """
+        Queues a request: a single sample (a tensor) or a list of samples. Returns a future resolved with the predicted label
+        (or an array of labels for a list). The future can be awaited in asyncio code with 'asyncio.wrap_future' (see 'asubmit').
+        """
+        if self._worker is None:
+            raise RuntimeError(f"The server must be started (with 'start' or as a context manager) before submitting requests")
+
+        samples = [x] if isinstance(x, torch.Tensor) else list(x)
+
+        if len(samples) == 0:
+            raise ValueError(f"Make sure not to submit an empty list of samples")
+
+        future = Future()
+        self._queue.put(((samples, isinstance(x, torch.Tensor)), future))
+        return future
+
+    async def asubmit(self, x: Union[torch.Tensor, List[torch.Tensor]]):
+        return await asyncio.wrap_future(self.submit(x))
+
+    def _collect(self) -> List[Tuple[Tuple[List[torch.Tensor], bool], Future]]:
+        if self._held is not None:
+            requests, self._held = [self._held], None
+        else:
+            # block until the first request (checking regularly whether the server was stopped)
+            while True:
+                try:
+                    requests = [self._queue.get(timeout=0.1)]
+                    break
+                except queue.Empty:
+                    if self._stop.is_set():
+                        return []
+
+        num_samples = len(requests[0][0][0])
+        deadline = time.perf_counter() + self.max_latency
+
+        while num_samples < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                r = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            # a request that would push the micro-batch past its cap starts the next one
+            if num_samples + len(r[0][0]) > self.max_batch_size:
+                self._held = r
+                break
+
+            requests.append(r)
+            num_samples += len(r[0][0])
+
+        return requests
+
+    def _process(self, requests: List[Tuple[Tuple[List[torch.Tensor], bool], Future]]) -> None:
+        try:
+            samples = torch.stack([self.process_item(s) for (request_samples, _), _ in requests for s in request_samples])
+            # only a single request can exceed the cap: processed in chunks
+            predictions = np.concatenate([self.predict_batch(samples[i: i + self.max_batch_size]) 
+                                          for i in range(0, len(samples), self.max_batch_size)])
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0][1].set_exception(e)
+                return
+
+            # the micro-batch is processed again request by request: only the failing requests receive the error
+            for r in requests:
+                self._process([r])
+            return
+
+        # split the predictions of the micro-batch between the requests
+        start = 0
+        for (request_samples, single), future in requests:
+            res = predictions[start: start + len(request_samples)]
+            future.set_result(res[0] if single else res)
+            start += len(request_samples)
+
+    def _serve(self) -> None:
+        while not self._stop.is_set():
+            requests = self._collect()
+
+            if len(requests) > 0:
+                self._process(requests)
@@ -0,0 +1,268 @@
+"""
+This script implements the sharded similarity search used by the KNN classes: the reference embeddings are split into contiguous shards,
+each shard is searched independently (in a worker process or a thread) and the per-shard top-k are merged at the end.
+
+The shard boundaries are aligned to the reference batch size: each shard sees exactly the same reference blocks as the sequential search
+and the merges break ties by index, so the results are identical to the single-process path.
+"""
+
+import os, pickle, torch
+import numpy as np
+import torch.multiprocessing as mp
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from .topk import init_topk_buffers, merge_topk, masked_topk
+
+
+def shard_bounds(num_samples: int, num_shards: int, block_size: int) -> List[Tuple[int, int]]:
+    """
+    Splits [0, num_samples) into (at most) 'num_shards' contiguous ranges whose boundaries are multiples of 'block_size'
+    """
+    num_blocks = (num_samples + block_size - 1) // block_size
+    num_shards = max(1, min(num_shards, num_blocks))
+
+    # distribute the blocks as evenly as possible
+    blocks_per_shard = [num_blocks // num_shards + int(i < num_blocks % num_shards) for i in range(num_shards)]
+
+    bounds, start = [], 0
+    for nb in blocks_per_shard:
+        end = min(start + nb * block_size, num_samples)
+        bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+def search_shard(query_embs: torch.Tensor,
+                 ref_embs: torch.Tensor,
+                 k: int,
+                 msr: callable,
+                 measure_as_similarity: bool,
+                 query_batch_size: int,
+                 ref_batch_size: int,
+                 device: str,
+                 offset: int = 0,
+                 removed: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Finds the 'k' nearest neighbors of each query among the references of a shard: 'ref_embs' (and 'removed') are the rows of the shard
+    and 'offset' is the global index of its first row. Returns two (num_queries, k) tensors saved on the cpu.
+    """
+    if isinstance(msr, torch.nn.Module):
+        msr = msr.to(device)
+
+    values_res = torch.empty(size=(len(query_embs), k), dtype=torch.float32)
+    indices_res = torch.empty(size=(len(query_embs), k), dtype=torch.int64)
+
+    for q_start in range(0, len(query_embs), query_batch_size):
+        q_embs = query_embs[q_start: q_start + query_batch_size].to(device)
+
+        values, indices = init_topk_buffers(num_queries=len(q_embs), k=k, measure_as_similarity=measure_as_similarity, device=device)
+
+        for r_start in range(0, len(ref_embs), ref_batch_size):
+            r_end = r_start + ref_batch_size
+
+            with torch.no_grad():
+                distances2ref = msr(q_embs, ref_embs[r_start: r_end].to(device))
+
+            block_values, block_indices = masked_topk(distances2ref,
+                                                      k=k,
+                                                      measure_as_similarity=measure_as_similarity,
+                                                      removed=removed[r_start: r_end].to(device) if removed is not None else None,
+                                                      offset=offset + r_start)
+
+            values, indices = merge_topk(values=values,
+                                         indices=indices,
+                                         new_values=block_values,
+                                         new_indices=block_indices,
+                                         measure_as_similarity=measure_as_similarity)
+
+        values_res[q_start: q_start + len(q_embs)] = values.cpu()
+        indices_res[q_start: q_start + len(q_embs)] = indices.cpu()
+
+    return values_res, indices_res
+
+
+# the reference shards of a worker process: set once by the pool initializer (as handles to the shared memory)
+_WORKER_SHARDS: List[torch.Tensor] = []
+
+
+def _init_worker(num_threads: int, ref_shards: List[torch.Tensor]) -> None:
+    # each worker uses a fixed number of threads: the workers do not compete for the cores
+    torch.set_num_threads(num_threads)
+    _WORKER_SHARDS[:] = ref_shards
+
+
+def _search_shard_worker(kwargs: dict) -> Tuple[np.ndarray, np.ndarray]:
+    if "shard" in kwargs:
+        # the worker processes receive the index of the shard: the references are not sent with every task
+        kwargs = dict(kwargs)
+        kwargs["ref_embs"] = _WORKER_SHARDS[kwargs.pop("shard")]
+
+    values, indices = search_shard(**kwargs)
+    return values.numpy(), indices.numpy()
+
+
+class ShardedSearcher:
+    """
+    Splits the reference embeddings into shards once and keeps the workers alive across searches: the 'process' backend copies the shards 
+    to the shared memory and starts the pool of worker processes (each receiving the handles to all the shards) at the first search only.
+    Call 'close' to release the workers and the shared memory.
+
+    Args:
+        backend: either 'process' (a pool of worker processes sharing the embeddings through shared memory: cpu only)
+            or 'thread' (a thread pool: the shards can be spread over several devices)
+        devices: the devices used by the 'thread' backend: the i-th shard runs on devices[i % len(devices)]
+        threads_per_shard: the number of torch threads used by each worker process. Defaults to cpu_count // num_shards
+    """
+    def __init__(self,
+                 ref_embs: torch.Tensor,
+                 num_shards: int,
+                 ref_batch_size: int,
+                 backend: str = 'process',
+                 devices: Optional[List[str]] = None,
+                 threads_per_shard: Optional[int] = None) -> None:
+
+        if backend not in ['process', 'thread']:
+            raise NotImplementedError(f"The sharded search supports only the 'process' and 'thread' backends. Found: {backend}")
+
+        self.devices = devices if devices is not None else ['cpu']
+
+        self.ref_embs = ref_embs
+        self.ref_batch_size = ref_batch_size
+        self.backend = backend
+        self.bounds = shard_bounds(len(ref_embs), num_shards=num_shards, block_size=ref_batch_size)
+
+        # a single shard is searched in the calling process (on any device)
+        if backend == 'process' and len(self.bounds) > 1 and any(d != 'cpu' for d in self.devices):
+            raise ValueError(f"The 'process' backend runs only on the cpu. Use the 'thread' backend to spread the shards over the devices: {self.devices}")
+        self.threads_per_shard = threads_per_shard if threads_per_shard is not None else max(1, (os.cpu_count() or 1) // len(self.bounds))
+
+        self._pool = None
+
+    def __len__(self) -> int:
+        return len(self.ref_embs)
+
+    def _start(self) -> None:
+        if self._pool is not None or len(self.bounds) == 1:
+            return
+
+        if self.backend == 'thread':
+            self._pool = ThreadPoolExecutor(max_workers=len(self.bounds))
+            return
+
+        # each shard is copied (at most) once to the shared memory (the embeddings might be backed by a memory-mapped file that cannot be moved 
+        # to the shared memory in place). The pool only keeps the handles: the copies are released with the pool
+        shards = [self.ref_embs[start: end] for start, end in self.bounds]
+        shards = [t if t.is_shared() else t.contiguous().clone().share_memory_() for t in shards]
+
+        self._pool = mp.get_context('spawn').Pool(processes=len(self.bounds), initializer=_init_worker, initargs=(self.threads_per_shard, shards))
+
+    def search(self,
+               query_embs: torch.Tensor,
+               k: int,
+               msr: callable,
+               measure_as_similarity: bool,
+               query_batch_size: int,
+               removed: Optional[torch.Tensor] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the shards in parallel and merges their results: identical to the single-process search
+        """
+        if removed is not None and len(removed) != len(self.ref_embs):
+            raise ValueError(f"The removed mask must have one entry per reference. Found {len(removed)} entries for {len(self.ref_embs)} references")
+
+        k = min(k, len(self.ref_embs))
+
+        shard_kwargs = [{"query_embs": query_embs,
+                         "ref_embs": self.ref_embs[start: end],
+                         "offset": start,
+                         "k": k,
+                         "msr": msr,
+                         "measure_as_similarity": measure_as_similarity,
+                         "query_batch_size": query_batch_size,
+                         "ref_batch_size": self.ref_batch_size,
+                         "device": self.devices[i % len(self.devices)],
+                         "removed": removed[start: end] if removed is not None else None}
+                        for i, (start, end) in enumerate(self.bounds)]
+
+        if len(self.bounds) == 1:
+            shard_results = [_search_shard_worker(shard_kwargs[0])]
+
+        elif self.backend == 'thread':
+            self._start()
+            shard_results = list(self._pool.map(_search_shard_worker, shard_kwargs))
+
+        else:
+            try:
+                pickle.dumps(msr)
+            except Exception as e:
+                raise ValueError(f"The 'process' backend requires a picklable measure (lambdas and local functions are not). Use the 'thread' backend instead. Error: {e}")
+
+            self._start()
+
+            # only the queries (and the removed masks) are sent with each search
+            query_embs = query_embs if query_embs.is_shared() else query_embs.clone().share_memory_()
+            for i, kwargs in enumerate(shard_kwargs):
+                kwargs["query_embs"] = query_embs
+                kwargs["shard"] = i
+                del kwargs["ref_embs"]
+
+            shard_results = self._pool.map(_search_shard_worker, shard_kwargs)
+
+        values, indices = [torch.from_numpy(a) for a in shard_results[0]]
+        for shard_values, shard_indices in shard_results[1:]:
+            values, indices = merge_topk(values=values,
+                                         indices=indices,
+                                         new_values=torch.from_numpy(shard_values),
+                                         new_indices=torch.from_numpy(shard_indices),
+                                         measure_as_similarity=measure_as_similarity)
+
+        return values.numpy(), indices.numpy()
+
+    def close(self) -> None:
+        if self._pool is None:
+            return
+
+        if self.backend == 'thread':
+            self._pool.shutdown()
+        else:
+            self._pool.terminate()
+            self._pool.join()
+
+        self._pool = None
+
+    def __enter__(self) -> 'ShardedSearcher':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def sharded_search(query_embs: torch.Tensor,
+                   ref_embs: torch.Tensor,
+                   k: int,
+                   msr: callable,
+                   measure_as_similarity: bool,
+                   query_batch_size: int,
+                   ref_batch_size: int,
+                   num_shards: int,
+                   backend: str = 'process',
+                   devices: Optional[List[str]] = None,
+                   threads_per_shard: Optional[int] = None,
+                   removed: Optional[torch.Tensor] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A single search with a temporary 'ShardedSearcher' (same arguments): repeated searches over the same references should keep a searcher instead.
+    """
+    with ShardedSearcher(ref_embs, 
+                         num_shards=num_shards, 
+                         ref_batch_size=ref_batch_size, 
+                         backend=backend, 
+                         devices=devices, 
+                         threads_per_shard=threads_per_shard) as searcher:
+        return searcher.search(query_embs, 
+                               k=k, 
+                               msr=msr, 
+                               measure_as_similarity=measure_as_similarity, 
+                               query_batch_size=query_batch_size, 
+                               removed=removed)
@@ -0,0 +1,63 @@
+"""
+This script contains the helpers to maintain the best 'k' candidates of a set of queries while iterating over batches of references
+"""
+
+import torch
+
+from typing import Tuple, Optional
+
+
+def init_topk_buffers(num_queries: int, 
+                      k: int, 
+                      measure_as_similarity: bool, 
+                      device: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    # the buffers are filled with the worst possible value so that any actual neighbor replaces them
+    fill_value = -float('inf') if measure_as_similarity else float('inf')
+    values = torch.full(size=(num_queries, k), fill_value=fill_value, dtype=torch.float32, device=device)
+    indices = torch.full(size=(num_queries, k), fill_value=-1, dtype=torch.int64, device=device)
+    return values, indices
+
+
+def merge_topk(values: torch.Tensor, 
+               indices: torch.Tensor,
+               new_values: torch.Tensor,
+               new_indices: torch.Tensor,
+               measure_as_similarity: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Merges the current best 'k' neighbors of each query with the candidates of a new reference batch in a single vectorized step.
+    The memory used is O(num_queries * k) regardless of the number of reference batches.
+
+    Ties are broken by the smallest index: the result depends only on the set of candidates (not on the order of the merges), 
+    which keeps the sharded search identical to the sequential one.
+    """
+    all_values = torch.cat([values, new_values.to(values.dtype)], dim=1)
+    all_indices = torch.cat([indices, new_indices.to(indices.dtype)], dim=1)
+
+    # sort by index first, then (stable) by value
+    index_order = torch.argsort(all_indices, dim=1)
+    all_values, all_indices = torch.gather(all_values, 1, index_order), torch.gather(all_indices, 1, index_order)
+
+    best_values, best_pos = torch.sort(all_values, dim=1, descending=measure_as_similarity, stable=True)
+    k = values.shape[1]
+    return best_values[:, :k], torch.gather(all_indices, dim=1, index=best_pos[:, :k])
+
+
+def masked_topk(scores: torch.Tensor,
+                k: int,
+                measure_as_similarity: bool,
+                removed: Optional[torch.Tensor] = None,
+                offset: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The top-k over the columns of 'scores' ignoring the columns marked as removed (tombstones). The indices are shifted by 'offset'.
+    If less than 'k' columns are kept, the missing entries have the worst possible value and the index -1.
+    """
+    if removed is not None:
+        fill_value = -float('inf') if measure_as_similarity else float('inf')
+        scores = scores.masked_fill(removed.unsqueeze(0), fill_value)
+
+    values, indices = torch.topk(scores, k=min(k, scores.shape[1]), dim=1, largest=measure_as_similarity)
+
+    if removed is None:
+        return values, indices + offset
+
+    return values, torch.where(removed[indices], torch.full_like(indices, -1), indices + offset)
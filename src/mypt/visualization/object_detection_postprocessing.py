@@ -0,0 +1,186 @@
+"""
+This script contains the post-processing of the outputs of the object localization models: decoding the predictions into bounding boxes
+and (class-aware) non-maximum suppression. Every step is a batched tensor operation (no loop over the images or the boxes).
+"""
+
+import torch
+
+from typing import Tuple
+
+from mypt.code_utilities.bbox_utilities import (_iou_kernel, bbox_array_validity, convert_bbox_array,
+                                                OBJ_DETECT_ANN_FORMATS, PASCAL_VOC, _PIXEL_FORMATS)
+
+
+def _greedy_suppression(boxes: torch.Tensor, valid: torch.Tensor, iou_threshold: float) -> torch.Tensor:
+    """
+    Args:
+        boxes: (G, S, 4) groups of boxes sorted by decreasing score (padded to the same size S)
+        valid: (G, S) the mask of the non-padded boxes
+
+    Returns: the (G, S) mask of the boxes kept by the greedy nms within each group
+    """
+    size = boxes.shape[1]
+    # overlaps[g, j, i]: box j (ranked before box i) overlaps box i
+    overlaps = (_iou_kernel(boxes, boxes).triu_(diagonal=1) > iou_threshold) & valid[:, :, None]
+
+    # box i is kept if no kept box ranked before it overlaps it. After the t-th iteration, the first t boxes of each group
+    # are final: the greedy solution is reached after at most 'size' iterations (usually much fewer). The convergence is only
+    # checked at exponentially spaced iterations: O(log(size)) synchronizations with the device
+    kept, iteration, check = valid, 0, 1
+    while iteration < size:
+        new_kept = valid & ~(overlaps & kept[:, :, None]).any(dim=1)
+        iteration += 1
+
+        if iteration == check:
+            if torch.equal(new_kept, kept):
+                break
+            check *= 2
+
+        kept = new_kept
+
+    return kept
+
+
+def batched_nms(boxes: torch.Tensor,
+                scores: torch.Tensor,
+                groups: torch.Tensor,
+                iou_threshold: float = 0.5) -> torch.Tensor:
+    """
+    Greedy non-maximum suppression run independently within each group (e.g. each (image, class) pair).
+
+    The groups are bucketed by size (the next power of 2) and each bucket is padded to its own size: the memory is bounded by
+    4 * sum(group_size ** 2) and not by num_groups * max_group_size ** 2.
+
+    Args:
+        boxes: (K, 4) boxes in the pascal_voc format
+        scores: (K,) scores
+        groups: (K,) integer group ids: boxes of different groups never suppress each other
+        iou_threshold: a box is suppressed by any kept box with a higher score and an intersection over union above the threshold
+
+    Returns: the indices of the kept boxes sorted by decreasing score
+    """
+    if iou_threshold < 0:
+        raise ValueError(f"The iou threshold must be non-negative. Found: {iou_threshold}")
+
+    if len(boxes) == 0:
+        return torch.empty(0, dtype=torch.long, device=boxes.device)
+
+    # sort by group and then by decreasing score
+    _, order = torch.sort(scores, descending=True, stable=True)
+    order = order[torch.sort(groups[order], stable=True)[1]]
+
+    # the index of the group of each box and its position within the group
+    _, counts = torch.unique_consecutive(groups[order], return_counts=True)
+    group_index = torch.repeat_interleave(torch.arange(len(counts), device=boxes.device), counts)
+    position = torch.arange(len(order), device=boxes.device) - (torch.cumsum(counts, dim=0) - counts)[group_index]
+
+    # the padded size of each group: its size rounded up to a power of 2
+    bucket_sizes = torch.pow(2, torch.ceil(torch.log2(counts.double()))).long()
+    box_bucket_sizes = bucket_sizes[group_index]
+
+    # the boxes alone in their group are always kept
+    kept = torch.ones(len(order), dtype=torch.bool, device=boxes.device)
+
+    for size in bucket_sizes.unique().tolist():
+        if size == 1:
+            continue
+
+        bucket_groups = torch.nonzero(bucket_sizes == size).squeeze(1)
+        # the row of each group of the bucket in the padded tensors
+        row = torch.full((len(counts),), -1, dtype=torch.long, device=boxes.device)
+        row[bucket_groups] = torch.arange(len(bucket_groups), device=boxes.device)
+
+        members = torch.nonzero(box_bucket_sizes == size).squeeze(1)
+        rows, cols = row[group_index[members]], position[members]
+
+        # (G_bucket, size, 4)
+        padded = torch.zeros((len(bucket_groups), size, 4), dtype=torch.float32, device=boxes.device)
+        padded[rows, cols] = boxes[order[members]].float()
+        valid = torch.zeros((len(bucket_groups), size), dtype=torch.bool, device=boxes.device)
+        valid[rows, cols] = True
+
+        kept[members] = _greedy_suppression(padded, valid, iou_threshold)[rows, cols]
+
+    keep = order[kept]
+    return keep[torch.sort(scores[keep], descending=True, stable=True)[1]]
+
+
+def postprocess_localization_output(logits: torch.Tensor,
+                                    box_format: str,
+                                    img_shapes,
+                                    target_format: str = PASCAL_VOC,
+                                    objectness_threshold: float = 0.5,
+                                    iou_threshold: float = 0.5,
+                                    class_aware: bool = True) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Decodes the output of an ObjectLocalizationModel: (B, num_classes + 5) logits laid out as the labels of ObjectLocalizationDs
+    (the object indicator, the 4 coordinates of the box and the class logits) or (B, K, num_classes + 5) for K predictions per image.
+
+    Args:
+        box_format: the format predicted by the model (the 'target_format' of the dataset it was trained on)
+        img_shapes: either a single image shape (height, width, ...) shared by the batch or a (B, 2) array: the shape of each image
+        target_format: the format of the returned boxes
+        objectness_threshold: the predictions with a sigmoid(object indicator) below the threshold are discarded
+        class_aware: if True, only the boxes of the same class suppress each other
+
+    Returns: 4 tensors with one row per detection: the boxes (D, 4) in 'target_format', the scores (D,) (the objectness probability
+        times the class probability), the class indices (D,) and the image indices (D,). The detections are sorted by image
+        and by decreasing score within each image: torch.bincount(image_indices, minlength=B) gives the number of detections per image
+    """
+    if box_format not in OBJ_DETECT_ANN_FORMATS or target_format not in OBJ_DETECT_ANN_FORMATS:
+        raise NotImplementedError(f"currently supporting only the following formats: {OBJ_DETECT_ANN_FORMATS}")
+
+    if logits.ndim == 2:
+        logits = logits[:, None, :]
+
+    if logits.ndim != 3 or logits.shape[-1] < 6:
+        raise ValueError(f"The logits are expected to be of shape (B, num_classes + 5) or (B, K, num_classes + 5). Found: {tuple(logits.shape)}")
+
+    batch_size, k, num_classes = logits.shape[0], logits.shape[1], logits.shape[2] - 5
+    device = logits.device
+
+    shapes = torch.as_tensor(img_shapes, dtype=torch.float32, device=device)
+    if shapes.ndim == 2 and len(shapes) != batch_size:
+        raise ValueError(f"Expected one image shape per image. Found {len(shapes)} shapes for {batch_size} images")
+
+    logits = logits.detach().reshape(-1, logits.shape[-1]).float()
+    image_indices = torch.arange(batch_size, device=device).repeat_interleave(k)
+
+    objectness = torch.sigmoid(logits[:, 0])
+    mask = objectness >= objectness_threshold
+    logits, objectness, image_indices = logits[mask], objectness[mask], image_indices[mask]
+
+    cls_probs, labels = torch.softmax(logits[:, 5:], dim=1).max(dim=1)
+    scores = objectness * cls_probs
+
+    # one shape per prediction
+    if shapes.ndim == 2:
+        shapes = shapes[image_indices]
+
+    # decode the boxes into the pascal_voc format: clip them to the image and drop the degenerate ones
+    boxes = logits[:, 1:5]
+    if box_format not in _PIXEL_FORMATS:
+        boxes = boxes.clamp(0, 1)
+
+    if box_format != PASCAL_VOC:
+        boxes = convert_bbox_array(boxes, current_format=box_format, target_format=PASCAL_VOC, img_shapes=shapes)
+
+    H, W = shapes[..., 0], shapes[..., 1]
+    boxes = torch.round(boxes.float())
+    x_min, y_min, x_max, y_max = [c.clamp(min=0) for c in boxes.unbind(dim=1)]
+    boxes = torch.stack([torch.minimum(x_min, W), torch.minimum(y_min, H), torch.minimum(x_max, W), torch.minimum(y_max, H)], dim=1).long()
+
+    valid = bbox_array_validity(boxes, current_format=PASCAL_VOC, img_shapes=shapes)
+    boxes, scores, labels, image_indices = boxes[valid], scores[valid], labels[valid], image_indices[valid]
+    if shapes.ndim == 2:
+        shapes = shapes[valid]
+
+    groups = image_indices * num_classes + labels if class_aware else image_indices
+    keep = batched_nms(boxes, scores, groups, iou_threshold=iou_threshold)
+
+    # sort by image (the order within each image is the decreasing score returned by the nms)
+    keep = keep[torch.sort(image_indices[keep], stable=True)[1]]
+
+    boxes = convert_bbox_array(boxes[keep], current_format=PASCAL_VOC, target_format=target_format, img_shapes=shapes[keep] if shapes.ndim == 2 else shapes)
+
+    return boxes, scores[keep], labels[keep], image_indices[keep]
@@ -2,8 +2,13 @@
 This script tests whether the dataloaders are reproducible across different runs (after multiple declarations + definitions) without returning the exact same sequence of indices 
 """
 
+import os, shutil
+
 from torch.utils.data.dataset import Dataset
-from mypt.data.dataloaders.standard_dataloaders import initialize_train_dataloader
+from mypt.data.dataloaders import standard_dataloaders as sdl
+from mypt.data.dataloaders.standard_dataloaders import initialize_train_dataloader, autotune_dataloader
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 class _IntegerDataset(Dataset):
     def __init__(self, length:int) -> None:
@@ -17,6 +22,13 @@ class _IntegerDataset(Dataset):
         return index
 
 
+class _ListedIntegerDataset(_IntegerDataset):
+    def __init__(self, length: int) -> None:
+        super().__init__(length)
+        # the listing identifies the dataset: its autotuned configuration can be cached
+        self.idx2path = {i: f"sample_{i}" for i in range(length)}
+
+
 def _test_different_sequences(num_sequences: int=100):
     for nw in range(2):
         for seed in range(10):
@@ -67,6 +79,47 @@ def _test_reproducibility_across_runs(num_sequences: int=10):
             for s in sequences:
                 assert s == sequences[0], "The dataloader does not return the same sequence across multiple runs"
 
+
+def _test_autotune():
+    cache_path = os.path.join(SCRIPT_DIR, 'autotune_cache', 'autotune.json')
+    ds = _ListedIntegerDataset(length=100)
+
+    config = autotune_dataloader(ds, batch_size=5, candidate_num_workers=[0, 2], candidate_prefetch_factors=[2], cache_path=cache_path)
+    assert len(config['results']) == 2 and config['throughput'] == max(r['throughput'] for r in config['results'])
+
+    # the choice is cached in memory and on the disk
+    assert autotune_dataloader(ds, batch_size=5, cache_path=cache_path) is config
+    sdl._AUTOTUNE_CACHE.clear()
+    assert autotune_dataloader(ds, batch_size=5, cache_path=cache_path)['num_workers'] == config['num_workers']
+
+    # the autotuned data loader returns the same sequence as the manually configured one
+    seqs = []
+    for nw in ['auto', 0]:
+        dl = initialize_train_dataloader(ds, seed=0, batch_size=5, num_workers=nw, warning=False)
+        seqs.append([b.item() for batch in dl for b in batch])
+    assert seqs[0] == seqs[1]
+
+    sdl._AUTOTUNE_CACHE.clear()
+
+    # a dataset without a listing is probed but its configuration is not cached
+    config = autotune_dataloader(_IntegerDataset(length=100), batch_size=5, candidate_num_workers=[0], cache_path=cache_path)
+    assert len(sdl._AUTOTUNE_CACHE) == 0 and config['num_workers'] == 0
+
+    # small datasets: the probe is shortened, or skipped below 2 batches
+    config = autotune_dataloader(_ListedIntegerDataset(length=12), batch_size=5, candidate_num_workers=[0, 2], candidate_prefetch_factors=[2], use_cache=False)
+    assert len(config['results']) == 2
+    config = autotune_dataloader(_ListedIntegerDataset(length=7), batch_size=5, use_cache=False)
+    assert config['num_workers'] == 0 and config['results'] == []
+
+    # the default candidates follow the number of cpus
+    config = autotune_dataloader(_ListedIntegerDataset(length=100), batch_size=5, candidate_prefetch_factors=[2], use_cache=False)
+    assert max(r['num_workers'] for r in config['results']) == (os.cpu_count() or 1)
+
+    sdl._AUTOTUNE_CACHE.clear()
+    shutil.rmtree(os.path.dirname(cache_path))
+
+
 if __name__ == '__main__':
     _test_different_sequences()
     _test_reproducibility_across_runs()
+    _test_autotune()
@@ -0,0 +1,104 @@
+"""
+This script tests the batched augmentations of the Parallel Augmentation datasets
+"""
+
+import os, shutil, torch
+import numpy as np
+import torchvision.transforms as tr
+import torchvision.transforms.functional as trf
+
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from mypt.data.datasets.parallel_augmentation.batched_augs import BatchedParallelAugs
+from mypt.data.datasets.parallel_augmentation.parallel_aug_dir import ParallelAugDirDs
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_batched_augs():
+    data_dir = os.path.join(SCRIPT_DIR, 'batched_augs_images')
+    os.makedirs(data_dir)
+
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        Image.fromarray(rng.integers(0, 256, size=(30 + i, 40, 3), dtype=np.uint8)).save(os.path.join(data_dir, f"{i}.png"))
+
+    # deterministic augmentations: the batched output can be compared to the per-sample one
+    augs = [tr.RandomHorizontalFlip(p=1), tr.RandomVerticalFlip(p=1), tr.Lambda(lambda x: 1 - x)]
+
+    ds = ParallelAugDirDs(root_dir=data_dir,
+                          output_shape=(24, 24),
+                          augs_per_sample=2,
+                          sampled_data_augs=augs,
+                          uniform_augs_before=[],
+                          uniform_augs_after=[],
+                          batched_augs=True,
+                          decode_size=(32, 32))
+
+    batch = next(iter(DataLoader(ds, batch_size=len(ds), shuffle=False)))
+    assert batch.dtype == torch.uint8 and batch.shape == (len(ds), 3, 32, 32)
+
+    engine = ds.augmentation_engine()
+    x1, x2 = engine(batch)
+    assert x1.shape == x2.shape == (len(ds), 3, 24, 24)
+
+    # the per-sample choices
+    orders = engine.sample_orders(len(ds), ds.augmentation_engine()._generator())
+    assert len({tuple(o) for o in orders[0].tolist()}) > 1
+
+    for view, order in zip([x1, x2], orders):
+        for i in range(len(ds)):
+            expected = batch[i].float() / 255
+            for aug_index in order[i].tolist():
+                expected = augs[aug_index](expected)
+            expected = trf.resize(expected, size=[24, 24], antialias=True)
+            assert torch.allclose(view[i], expected, atol=1e-6)
+
+    # reproducible under the seed, different across batches and epochs
+    other = ds.augmentation_engine()
+    y1, _ = other(batch)
+    z1, _ = other(batch)
+    assert torch.equal(x1, y1) and not torch.equal(y1, z1)
+
+    other.set_epoch(0)
+    assert torch.equal(other(batch)[0], x1)
+
+    shutil.rmtree(data_dir)
+
+
+def test_per_sample_randomness():
+    # identical images: any difference between the views of two samples comes from their own random parameters
+    image = torch.from_numpy(np.random.default_rng(0).integers(0, 256, size=(3, 32, 32), dtype=np.uint8))
+    batch = image.unsqueeze(0).repeat(8, 1, 1, 1)
+
+    cases = [([tr.RandomResizedCrop(size=(16, 16))], [], []),
+             ([tr.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.1)], [], []),
+             # applied sample by sample
+             ([tr.RandomRotation(degrees=90)], [], []),
+             # the uniform augmentations as well
+             ([tr.Lambda(lambda x: x)], [tr.RandomResizedCrop(size=(32, 32))], []),
+             ([tr.Lambda(lambda x: x)], [], [tr.RandomHorizontalFlip(p=0.5), tr.ColorJitter(brightness=0.5)])]
+
+    for sampled_data_augs, before, after in cases:
+        engine = BatchedParallelAugs(output_shape=(16, 16),
+                                     augs_per_sample=1,
+                                     sampled_data_augs=sampled_data_augs,
+                                     uniform_augs_before=before,
+                                     uniform_augs_after=after)
+        x1, x2 = engine(batch)
+        assert x1.shape == x2.shape == (8, 3, 16, 16)
+
+        for view in [x1, x2]:
+            assert len({tuple(v.flatten().tolist()) for v in view}) > 1, f"the samples share the same parameters: {sampled_data_augs}, {before}, {after}"
+
+    # each crop lies within the image: a crop of the whole image (scale=1, ratio=1) is the resized image
+    engine = BatchedParallelAugs(output_shape=(32, 32), augs_per_sample=1, sampled_data_augs=[tr.RandomResizedCrop(size=(32, 32), scale=(1, 1), ratio=(1, 1))],
+                                 uniform_augs_before=[], uniform_augs_after=[])
+    x1, _ = engine(batch)
+    assert torch.allclose(x1, batch.float() / 255, atol=1e-5)
+
+
+if __name__ == '__main__':
+    test_batched_augs()
+    test_per_sample_randomness()
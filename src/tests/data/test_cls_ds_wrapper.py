@@ -0,0 +1,53 @@
+"""
+This script tests the index mapping of the ClassificationDsWrapper mixin
+"""
+
+import numpy as np
+
+from torch.utils.data import Dataset
+
+from mypt.data.datasets.mixins.cls_ds_wrapper import ClassificationDsWrapper
+
+
+class _LabeledDs(Dataset):
+    def __init__(self, targets):
+        self.targets = targets
+        self.loaded = 0
+
+    def __getitem__(self, index: int):
+        self.loaded += 1
+        return index, self.targets[index]
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+
+class _Wrapper(ClassificationDsWrapper):
+    def __init__(self, targets, samples_per_cls: int):
+        self._ds = _LabeledDs(targets)
+        self.samples_per_cls_map = {}
+        self.samples_per_cls_map = self._set_samples_per_cls(samples_per_cls, warning=False)
+
+
+def test_samples_per_cls():
+    # the class sizes: smaller, equal and larger than 'samples_per_cls'
+    counts = [2, 3, 5, 3]
+    targets = np.repeat(np.arange(len(counts)), counts).tolist()
+
+    w = _Wrapper(targets, samples_per_cls=3)
+    assert w.samples_per_cls_map == {0: 0, 2: 2, 5: 5, 8: 10}
+
+    # the labels are read from the metadata: only '_verify_attrs' loads the first sample
+    assert w._ds.loaded <= 2
+
+    expected = [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12]
+    assert w.find_final_indices(np.arange(len(expected))).tolist() == expected
+
+    # the boundaries are cached: no more samples are loaded
+    loaded = w._ds.loaded
+    assert [w._find_final_index(i) for i in range(len(expected))] == expected
+    assert w._ds.loaded == loaded
+
+
+if __name__ == '__main__':
+    test_samples_per_cls()
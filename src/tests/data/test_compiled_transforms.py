@@ -0,0 +1,48 @@
+"""
+This script tests the compiled (fused) transform pipeline and runs its micro-benchmark
+"""
+
+import torch
+import numpy as np
+import torchvision.transforms as tr
+
+from PIL import Image
+
+from mypt.data.datasets.compiled_transforms import CompiledTransform, FusedToTensor, benchmark_transforms
+
+
+def _images(n: int, mode: str = 'RGB'):
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, size=(60 + i, 80, 3), dtype=np.uint8)).convert(mode) for i in range(n)]
+
+
+def test_compiled_transforms():
+    pipelines = [
+        [tr.ToTensor()],
+        [tr.Resize((32, 48)), tr.ToTensor(), tr.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])],
+        [tr.RandomHorizontalFlip(p=1), tr.Resize(40), tr.ToTensor()],
+        [tr.ToTensor(), tr.Normalize(mean=[0.5] * 3, std=[0.2] * 3), tr.Resize((16, 16), antialias=True)],
+    ]
+
+    for transforms in pipelines:
+        compiled = CompiledTransform(transforms)
+        assert any(isinstance(op, FusedToTensor) for op in compiled.ops)
+
+        for im in _images(4):
+            assert torch.equal(compiled(im), tr.Compose(transforms)(im))
+
+    # grayscale images are fused as well, the other modes fall back to the original transformations
+    for mode in ['L', 'RGBA']:
+        transforms = [tr.Resize((20, 20)), tr.ToTensor()]
+        for im in _images(2, mode=mode):
+            assert torch.equal(CompiledTransform(transforms)(im), tr.Compose(transforms)(im))
+
+
+def benchmark():
+    transforms = [tr.Resize((224, 224)), tr.ToTensor(), tr.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]
+    print(benchmark_transforms(transforms, _images(64)))
+
+
+if __name__ == '__main__':
+    test_compiled_transforms()
+    benchmark()
@@ -0,0 +1,59 @@
+"""
+This script tests the decoded-image cache of the folder datasets
+"""
+
+import os, pickle, shutil, torch
+import numpy as np
+import torchvision.transforms as tr
+
+from PIL import Image
+
+from mypt.data.datasets.genericFolderDs import GenericFolderDS
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def _create_images(folder: str, num_images: int) -> None:
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(num_images):
+        Image.fromarray(rng.integers(0, 256, size=(40 + i, 50, 3), dtype=np.uint8)).save(os.path.join(folder, f"{i}.png"))
+
+
+def test_image_cache():
+    data_dir, spill_dir = os.path.join(SCRIPT_DIR, 'cache_images'), os.path.join(SCRIPT_DIR, 'cache_spill')
+    _create_images(data_dir, 20)
+
+    ds = GenericFolderDS(root=data_dir, transforms=[tr.ToTensor()])
+
+    # memory only: the images are not resized and the budget fits only a few of them
+    cached_ds = GenericFolderDS(root=data_dir, transforms=[tr.ToTensor()], image_cache_bytes=5 * 60 * 50 * 3)
+    for _ in range(2):
+        for i in range(len(ds)):
+            assert torch.equal(ds[i], cached_ds[i])
+
+    stats = cached_ds.image_cache.stats()
+    assert stats["misses"] == 2 * len(ds) and stats["memory_bytes_used"] <= 5 * 60 * 50 * 3
+
+    for i in [0, 0, 0]:
+        cached_ds[i]
+    assert cached_ds.image_cache.stats()["hits"] == 2
+
+    # the spill file: pre-resized images shared between processes
+    spill_ds = GenericFolderDS(root=data_dir, transforms=[tr.ToTensor()], image_cache_size=(32, 32), image_cache_dir=spill_dir)
+    for i in range(len(ds)):
+        expected = tr.ToTensor()(GenericFolderDS.load_sample(ds.idx2path[i]).resize((32, 32), Image.BILINEAR))
+        assert torch.equal(spill_ds[i], expected)
+
+    # a copy of the dataset (what a DataLoader worker receives) reads the images decoded by the other process from the disk
+    worker_ds = pickle.loads(pickle.dumps(spill_ds))
+    for i in range(len(ds)):
+        assert torch.equal(worker_ds[i], spill_ds[i])
+    assert worker_ds.image_cache.stats()["disk_hits"] == len(ds) and worker_ds.image_cache.stats()["misses"] == 0
+
+    shutil.rmtree(data_dir)
+    shutil.rmtree(spill_dir)
+
+
+if __name__ == '__main__':
+    test_image_cache()
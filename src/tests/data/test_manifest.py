@@ -0,0 +1,60 @@
+"""
+This script tests the cached manifest of the image directories
+"""
+
+import os, shutil, time
+import numpy as np
+
+from PIL import Image
+
+from mypt.data.datasets.manifest import load_or_build_manifest
+from mypt.data.datasets.genericFolderDs import GenericFolderDS
+from mypt.code_utilities import directories_and_files as dirf
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def _save_image(path: str) -> None:
+    Image.fromarray(np.zeros((4, 4, 3), dtype=np.uint8)).save(path)
+
+
+def test_manifest():
+    data_dir, manifest_path = os.path.join(SCRIPT_DIR, 'manifest_images'), os.path.join(SCRIPT_DIR, 'manifest_cache', 'manifest.npz')
+
+    for sub_dir in ['a', os.path.join('b', 'c')]:
+        os.makedirs(os.path.join(data_dir, sub_dir))
+        for i in range(3):
+            _save_image(os.path.join(data_dir, sub_dir, f"{i}.png"))
+
+    manifest, loaded = load_or_build_manifest(data_dir, dirf.IMAGE_EXTENSIONS, manifest_path=manifest_path)
+    assert not loaded and manifest.paths == sorted(manifest.paths) and len(manifest) == 6
+
+    # the second call reuses the manifest
+    manifest, loaded = load_or_build_manifest(data_dir, dirf.IMAGE_EXTENSIONS, manifest_path=manifest_path)
+    assert loaded and len(manifest) == 6
+
+    ds = GenericFolderDS(root=data_dir, transforms=[], manifest_path=manifest_path)
+    assert [ds.idx2path[i] for i in range(len(ds))] == manifest.absolute_paths()
+
+    # adding a file to a nested directory invalidates the manifest (make sure the modification time changes)
+    time.sleep(0.01)
+    _save_image(os.path.join(data_dir, 'b', 'c', "new.png"))
+    manifest, loaded = load_or_build_manifest(data_dir, dirf.IMAGE_EXTENSIONS, manifest_path=manifest_path)
+    assert not loaded and len(manifest) == 7
+
+    # the directory must contain only images
+    with open(os.path.join(data_dir, 'a', 'notes.txt'), 'w') as f:
+        f.write("not an image")
+
+    try:
+        load_or_build_manifest(data_dir, dirf.IMAGE_EXTENSIONS, manifest_path=manifest_path)
+        assert False, "a non-image file should raise an error"
+    except ValueError:
+        pass
+
+    shutil.rmtree(data_dir)
+    shutil.rmtree(os.path.dirname(manifest_path))
+
+
+if __name__ == '__main__':
+    test_manifest()
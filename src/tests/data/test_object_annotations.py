@@ -0,0 +1,116 @@
+"""
+This script tests the annotation ingestion of the object detection datasets: parallel reading, the annotation table and its on-disk cache
+"""
+
+import os, tempfile
+import numpy as np
+
+from PIL import Image
+
+from mypt.code_utilities import bbox_utilities as au
+from mypt.data.datasets.obj_detect_loc.abstract_ds import ObjectDataset, _image_shape
+from mypt.data.datasets.obj_detect_loc.annotation_table import AnnotationTable
+
+
+class _ObjectDs(ObjectDataset):
+    def __getitem__(self, index):
+        return self.annotations[index]
+
+
+def _image2annotation(path: str):
+    # the image shape is not returned: read from the header of the image
+    i = int(os.path.splitext(os.path.basename(path))[0])
+    return ['cat' if i % 2 == 0 else 'dog', 'background'], [[i, i, i + 10, i + 20], [0, 0, 5, 5]]
+
+
+# the paths read by '_counted_image2annotation' (not part of its hash: a global is not a captured value)
+_READ_PATHS = []
+
+
+def _counted_image2annotation(path: str):
+    _READ_PATHS.append(path)
+    return _image2annotation(path)
+
+
+def _shifted_image2annotation(path: str):
+    cls, boxes = _image2annotation(path)
+    return cls, [[b + 1 for b in box] for box in boxes]
+
+
+def _build(root: str, image2annotation, **kwargs) -> _ObjectDs:
+    return _ObjectDs(root_dir=root,
+                     image2annotation=image2annotation,
+                     target_format=au.YOLO,
+                     current_format=au.PASCAL_VOC,
+                     background_label='background',
+                     **kwargs)
+
+
+def test_annotations_ingestion():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'images')
+        os.makedirs(root)
+        for i in range(20):
+            Image.fromarray(np.zeros((40 + i, 60, 3), dtype=np.uint8)).save(os.path.join(root, f'{i}.png'))
+
+        assert _image_shape(os.path.join(root, '3.png')) == (43, 60)
+
+        serial = _build(root, _image2annotation)
+        parallel = _build(root, _image2annotation, num_workers=2)
+        for attr in ['offsets', 'boxes', 'class_ids']:
+            assert np.array_equal(getattr(serial.annotations, attr), getattr(parallel.annotations, attr))
+
+        # the boxes are converted with the shape of their image
+        index = [i for i, p in serial.idx2sample_path.items() if p == os.path.join(root, '3.png')][0]
+        cls, boxes = serial[index]
+        assert cls == ['dog', 'background'] and boxes.dtype == np.float32
+        assert np.allclose(boxes[0], au.convert_bbox_annotation([3, 3, 13, 23], au.PASCAL_VOC, au.YOLO, img_shape=(43, 60)), atol=1e-4)
+
+        # the rows of the table are views on the flat arrays
+        assert np.shares_memory(serial.annotations.boxes_of(index), serial.annotations.boxes)
+        assert serial.class_id_2_cls_index[serial.annotations.class_ids_of(index)].tolist() == [serial.cls_2_cls_index['dog'], serial.cls_2_cls_index['background']]
+
+        cache = os.path.join(tmp, 'annotations.npz')
+        first = _build(root, _counted_image2annotation, annotations_cache=cache)
+        assert os.path.exists(cache) and len(_READ_PATHS) > 20
+
+        # the second construction only reads the annotation of a single image (the verification of the mapping)
+        _READ_PATHS.clear()
+        second = _build(root, _counted_image2annotation, annotations_cache=cache)
+        assert len(_READ_PATHS) == 1
+        for attr in ['offsets', 'boxes', 'class_ids', 'classes']:
+            assert np.array_equal(getattr(second.annotations, attr), getattr(first.annotations, attr))
+
+        assert second.cls_2_cls_index == first.cls_2_cls_index
+
+        # other annotations (another callable, or a dictionary) do not load the cache
+        shifted = _build(root, _shifted_image2annotation, annotations_cache=cache)
+        assert not np.array_equal(shifted.annotations.boxes, first.annotations.boxes)
+
+        mapping = {p: _image2annotation(p) for p in first.idx2sample_path.values()}
+        from_dict = _build(root, mapping, annotations_cache=cache)
+        assert np.allclose(from_dict.annotations.boxes, first.annotations.boxes)
+
+        mapping[first.idx2sample_path[0]] = _shifted_image2annotation(first.idx2sample_path[0])
+        modified = _build(root, mapping, annotations_cache=cache)
+        assert not np.array_equal(modified.annotations.boxes, from_dict.annotations.boxes)
+
+
+def test_numpy_labels_cache():
+    boxes = [[[0, 0, 1, 1], [0, 0, 2, 2]], [[1, 1, 3, 3]]]
+
+    # labels read from arrays are numpy scalars: converted to python ints and strings (the label types saved in the cache)
+    for labels, expected in [([np.asarray([3, 1]), np.asarray([1])], [1, 3]), ([np.asarray(['dog', 'cat']), np.asarray(['cat'])], ['cat', 'dog'])]:
+        table = AnnotationTable.from_lists(labels, boxes)
+        assert table.classes == expected and all(type(c) is type(expected[0]) for c in table.classes)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'annotations.npz')
+            table.save(path, key='k')
+            loaded = AnnotationTable.load(path, key='k')
+            assert loaded is not None and loaded.classes == table.classes and loaded[0][0] == table[0][0]
+
+
+if __name__ == '__main__':
+    test_annotations_ingestion()
+    test_numpy_labels_cache()
@@ -0,0 +1,59 @@
+"""
+This script tests the packed shard format of the image directories
+"""
+
+import os, shutil, torch
+import numpy as np
+import torchvision.transforms as tr
+
+from PIL import Image
+from torchvision.datasets import ImageFolder
+
+from mypt.data.datasets.packed_shards import pack_directory, PackedShardDataset, ShardAwareSampler
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_packed_shards():
+    src_dir, packed_dir = os.path.join(SCRIPT_DIR, 'pack_src'), os.path.join(SCRIPT_DIR, 'pack_out')
+
+    rng = np.random.default_rng(0)
+    for cls, n in [('cat', 9), ('dog', 12), ('bird', 5)]:
+        os.makedirs(os.path.join(src_dir, cls))
+        for i in range(n):
+            Image.fromarray(rng.integers(0, 256, size=(16, 20, 3), dtype=np.uint8)).save(os.path.join(src_dir, cls, f"{i}.png"))
+
+    # the concept labels directories are not classes
+    os.makedirs(os.path.join(src_dir, 'cat_concept_label'))
+
+    assert pack_directory(src_dir, packed_dir, images_per_shard=7, layout='class_folders', ignore_dirs_ending='concept_label') == 26
+
+    shutil.rmtree(os.path.join(src_dir, 'cat_concept_label'))
+    ref_ds = ImageFolder(src_dir, transform=tr.ToTensor())
+    ds = PackedShardDataset(packed_dir, transforms=[tr.ToTensor()])
+
+    assert ds.classes == ref_ds.classes and ds.num_shards == 4 and len(ds) == len(ref_ds)
+
+    for i in range(len(ds)):
+        (x, y), (ref_x, ref_y) = ds[i], ref_ds[i]
+        assert torch.equal(x, ref_x) and y == ref_y
+
+    # each epoch is a permutation where the samples of a shard are consecutive
+    sampler = ShardAwareSampler(ds, shuffle=True, seed=0)
+    orders = []
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        order = list(sampler)
+        assert sorted(order) == list(range(len(ds)))
+        shards = ds.shard_ids[order]
+        assert (np.diff(shards) != 0).sum() == ds.num_shards - 1
+        orders.append(order)
+
+    assert orders[0] != orders[1]
+
+    shutil.rmtree(src_dir)
+    shutil.rmtree(packed_dir)
+
+
+if __name__ == '__main__':
+    test_packed_shards()
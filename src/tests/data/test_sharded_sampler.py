@@ -0,0 +1,90 @@
+"""
+This script tests the sharded sampler with several processes on a single machine (gloo backend)
+"""
+
+import os, tempfile
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from torch.utils.data import Dataset
+
+from mypt.data.dataloaders.standard_dataloaders import initialize_train_dataloader
+
+WORLD_SIZE = 3
+DS_SIZE = 47
+
+
+class _IntegerDataset(Dataset):
+    def __len__(self):
+        return DS_SIZE
+
+    def __getitem__(self, index) -> int:
+        return index
+
+
+def _worker(rank: int, init_file: str, weights, queue) -> None:
+    dist.init_process_group(backend='gloo', init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+
+    dl = initialize_train_dataloader(_IntegerDataset(),
+                                     seed=0,
+                                     batch_size=4,
+                                     num_workers=0,
+                                     drop_last=False,
+                                     warning=False,
+                                     weights=weights,
+                                     distributed=True)
+
+    epochs = []
+    for epoch in range(2):
+        dl.sampler.set_epoch(epoch)
+        epochs.append([i.item() for batch in dl for i in batch])
+
+    # all the ranks receive the partitions of all the other ranks
+    gathered = [None] * WORLD_SIZE
+    dist.all_gather_object(gathered, epochs)
+    if rank == 0:
+        queue.put(gathered)
+
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def _run(weights):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mp.start_processes(_worker, args=(os.path.join(tmp, 'init'), weights, queue), nprocs=WORLD_SIZE, start_method='spawn')
+        # ranks x epochs x indices
+        return queue.get()
+
+
+def test_sharded_sampler():
+    gathered = _run(weights=None)
+
+    for epoch in range(2):
+        shards = [gathered[r][epoch] for r in range(WORLD_SIZE)]
+        # the same number of samples per rank, covering the whole dataset (with a padding of at most 'WORLD_SIZE - 1' samples)
+        assert len({len(s) for s in shards}) == 1
+        assert set().union(*shards) == set(range(DS_SIZE)) and sum(len(s) for s in shards) < DS_SIZE + WORLD_SIZE
+
+    # the partitions are reshuffled at each epoch
+    assert gathered[0][0] != gathered[0][1]
+
+    # reproducible across runs
+    assert _run(weights=None) == gathered
+
+    # weighted: the samples with a zero weight are never drawn and each rank draws only from its own partition
+    weights = np.ones(DS_SIZE)
+    weights[::2] = 0
+    gathered = _run(weights=weights.tolist())
+
+    for epoch in range(2):
+        shards = [set(gathered[r][epoch]) for r in range(WORLD_SIZE)]
+        assert all(i % 2 == 1 for s in shards for i in s)
+        assert all(len(shards[r1] & shards[r2]) == 0 for r1 in range(WORLD_SIZE) for r2 in range(r1 + 1, WORLD_SIZE))
+
+
+if __name__ == '__main__':
+    test_sharded_sampler()
@@ -0,0 +1,102 @@
+"""
+This script tests the index backends of the KNN classes
+"""
+
+import torch
+
+from mypt.subroutines.neighbors.ann_index import ExactIndex, IVFIndex, QuantizedIndex, recall_latency_report, quantization_report
+from mypt.shortcuts import str2distance
+
+
+def test_exact_index():
+    torch.manual_seed(0)
+    refs, queries = torch.randn(1000, 32), torch.randn(50, 32)
+
+    for m, largest in [('cosine_sim', True), ('euclidean', False)]:
+        index = ExactIndex(measure=m, device='cpu', batch_size=128).build(refs)
+        values, indices = index.search(queries, k=5)
+
+        msr = str2distance[m]
+        msr = msr() if isinstance(msr, type) else msr
+        true_values, true_indices = torch.topk(msr(queries, refs), k=5, dim=1, largest=largest)
+
+        assert torch.allclose(values, true_values, atol=10 ** -4)
+        assert torch.equal(indices, true_indices)
+
+
+def test_ivf_index():
+    torch.manual_seed(0)
+    refs, queries = torch.randn(2000, 32), torch.randn(100, 32)
+
+    for m in ['cosine_sim', 'euclidean']:
+        exact_indices = ExactIndex(measure=m, device='cpu').build(refs).search(queries, k=10)[1]
+
+        # probing all the lists is equivalent to the exact search
+        flat = IVFIndex(num_lists=16, nprobe=16, measure=m, device='cpu').build(refs)
+        assert torch.equal(torch.sort(flat.search(queries, k=10)[1], dim=1).values, torch.sort(exact_indices, dim=1).values)
+
+        pq = IVFIndex(num_lists=16, nprobe=4, measure=m, pq_subspaces=8, pq_bits=6, device='cpu').build(refs)
+        report = recall_latency_report(pq, embeddings=refs, queries=queries, k=10, nprobes=[1, 4, 16])
+
+        assert len(report) == 4 and report[0]["nprobe"] is None
+        recalls = [r["recall@10"] for r in report[1:]]
+        assert all(0 <= r <= 1 for r in recalls)
+
+
+def test_index_add_remove():
+    torch.manual_seed(0)
+    refs, new_refs, queries = torch.randn(1000, 32), torch.randn(200, 32), torch.randn(50, 32)
+    all_refs = torch.cat([refs, new_refs], dim=0)
+
+    removed = torch.randperm(len(all_refs))[:300]
+    keep = torch.ones(len(all_refs), dtype=torch.bool)
+    keep[removed] = False
+
+    for m in ['cosine_sim', 'euclidean']:
+        # the search on the kept samples only: the ground truth (with the indices mapped back to the full reference set)
+        kept_ids = torch.nonzero(keep).squeeze(1)
+        true_indices = kept_ids[ExactIndex(measure=m, device='cpu').build(all_refs[keep]).search(queries, k=10)[1]]
+
+        for index in [ExactIndex(measure=m, device='cpu', batch_size=128), IVFIndex(num_lists=8, nprobe=8, measure=m, device='cpu')]:
+            index.build(refs)
+            index.add(new_refs)
+            index.remove(removed)
+
+            # tombstones: the removed samples are never returned
+            indices = index.search(queries, k=10)[1]
+            assert torch.equal(torch.sort(indices, dim=1).values, torch.sort(true_indices, dim=1).values)
+
+            # compaction: the kept samples are re-indexed consecutively
+            index.compact(keep)
+            assert index.num_samples == len(kept_ids)
+            indices = index.search(queries, k=10)[1]
+            assert torch.equal(torch.sort(kept_ids[indices], dim=1).values, torch.sort(true_indices, dim=1).values)
+
+
+def test_quantized_index():
+    torch.manual_seed(0)
+    refs, queries = torch.randn(2000, 64), torch.randn(100, 64)
+
+    for m in ['cosine_sim', 'euclidean']:
+        report = quantization_report(refs, queries, k=10, measure=m, dtypes=['float16', 'int8'], rerank_factors=[None, 4], device='cpu')
+        rows = {(r["dtype"], r["rerank_factor"]): r for r in report}
+
+        assert rows[('float16', None)]["memory_ratio"] == 2
+        assert rows[('int8', None)]["memory_ratio"] > 3.5
+
+        for dtype in ['float16', 'int8']:
+            assert rows[(dtype, None)]["recall@10"] > 0.9
+            # the re-ranking with the float32 embeddings recovers the exact neighbors
+            assert rows[(dtype, 4)]["recall@10"] >= rows[(dtype, None)]["recall@10"] and rows[(dtype, 4)]["recall@10"] > 0.99
+
+        # the re-ranked values are the exact (float32) values of the measure
+        exact_values = ExactIndex(measure=m, device='cpu').build(refs).search(queries, k=10)[0]
+        values = QuantizedIndex(dtype='int8', measure=m, rerank_factor=4, device='cpu').build(refs).search(queries, k=10)[0]
+        assert torch.allclose(values, exact_values, atol=10 ** -3)
+
+
+if __name__ == '__main__':
+    test_exact_index()
+    test_ivf_index()
+    test_index_add_remove()
+    test_quantized_index()
@@ -0,0 +1,179 @@
+"""
+This script tests the persistent embeddings store used by the KNN classes
+"""
+
+import os, torch, shutil, warnings
+import numpy as np
+
+from functools import partial
+
+from torch.utils.data import Dataset
+
+from mypt.code_utilities.fingerprints import hash_callable, dataset_fingerprint
+from mypt.subroutines.neighbors.ann_index import QuantizedIndex
+from mypt.subroutines.neighbors.embeddings_store import EmbeddingStore
+from mypt.subroutines.neighbors.knn import KNN
+
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class _ListingDs(Dataset):
+    def __init__(self, n: int) -> None:
+        self.idx2path = {i: f"sample_{i}.png" for i in range(n)}
+        self.data = torch.randn(n, 16)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __len__(self):
+        return len(self.idx2path)
+
+
+def test_store_round_trip():
+    cache_dir = os.path.join(SCRIPT_DIR, 'temp_store')
+
+    for dtype in ['float32', 'float16', 'int8']:
+        store = EmbeddingStore(cache_dir, dtype=dtype)
+
+        ds = _ListingDs(100)
+        model = torch.nn.Linear(16, 8)
+        process_model_output = lambda m, x: m(x)
+
+        key = store.key(dataset=ds, model=model, model_ckpnt=None, process_model_output=process_model_output)
+        assert store.load(key) is None, "an empty store should not return any entry"
+
+        embs = model(ds.data).detach()
+        labels = np.arange(100) % 10
+
+        stored_embs, stored_labels = store.save(key, embeddings=embs, labels=labels)
+        atol = 5 * 10 ** -2 if dtype == 'int8' else 10 ** -2
+        assert torch.allclose(stored_embs.to(torch.float32), embs, atol=atol), "the stored embeddings should match the original ones"
+        assert np.array_equal(stored_labels, labels)
+
+        loaded_embs, loaded_labels = store.load(store.key(dataset=ds, model=model, model_ckpnt=None, process_model_output=process_model_output))
+        assert torch.equal(loaded_embs, stored_embs) and np.array_equal(loaded_labels, labels)
+
+        # changing the model weights invalidates the entry
+        with torch.no_grad():
+            model.weight.add_(1)
+        assert store.load(store.key(dataset=ds, model=model, model_ckpnt=None, process_model_output=process_model_output)) is None
+
+        # changing the dataset listing invalidates the entry
+        ds.idx2path[0] = "another_sample.png"
+        assert store.load(store.key(dataset=ds, model=model, model_ckpnt=None, process_model_output=process_model_output)) is None
+
+        store.clear()
+
+    shutil.rmtree(cache_dir)
+
+
+class _NoListingDs(Dataset):
+    def __getitem__(self, index):
+        return torch.zeros(16)
+
+    def __len__(self):
+        return 10
+
+
+class _Scaler:
+    def __init__(self, factor: float) -> None:
+        self.factor = factor
+
+    def scale(self, m, x):
+        return m(x) * self.factor
+
+
+def _scale(m, x, factor: float = 1.0):
+    return m(x) * factor
+
+
+def test_callable_hash():
+    def closure(factor: float):
+        return lambda m, x: m(x) * factor
+
+    # the same code with different captured values: closures, default arguments, partial arguments and bound instances
+    assert hash_callable(closure(1.0)) != hash_callable(closure(2.0))
+    assert hash_callable(closure(1.0)) == hash_callable(closure(1.0))
+    assert hash_callable(partial(_scale, factor=1.0)) != hash_callable(partial(_scale, factor=2.0))
+    assert hash_callable(_Scaler(1.0).scale) != hash_callable(_Scaler(2.0).scale)
+
+    def with_default(m, x, factor=3.0):
+        return m(x) * factor
+
+    def with_other_default(m, x, factor=4.0):
+        return m(x) * factor
+
+    assert hash_callable(with_default) != hash_callable(with_other_default)
+
+
+def test_transforms_fingerprint():
+    ds = _ListingDs(10)
+    fp = dataset_fingerprint(ds)
+
+    # the same listing with other transforms: the embeddings differ
+    ds.transform = partial(_scale, None, factor=2.0)
+    with_transform = dataset_fingerprint(ds)
+    assert with_transform != fp
+
+    ds.transform = partial(_scale, None, factor=3.0)
+    assert dataset_fingerprint(ds) not in [fp, with_transform]
+
+    ds.transform = partial(_scale, None, factor=2.0)
+    assert dataset_fingerprint(ds) == with_transform
+
+    # the wrappers of the reference set include the transforms of the wrapped datasets
+    other = _ListingDs(10)
+    other.idx2path = ds.idx2path
+    assert dataset_fingerprint(torch.utils.data.ConcatDataset([ds, other])) != dataset_fingerprint(torch.utils.data.ConcatDataset([other, other]))
+    assert dataset_fingerprint(torch.utils.data.Subset(ds, [0, 1])) != dataset_fingerprint(torch.utils.data.Subset(other, [0, 1]))
+
+
+def test_no_fingerprint_no_cache():
+    store = EmbeddingStore(os.path.join(SCRIPT_DIR, 'temp_store'))
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert store.key(dataset=_NoListingDs(), model=torch.nn.Linear(16, 8)) is None
+        assert len(w) == 1
+
+    shutil.rmtree(os.path.join(SCRIPT_DIR, 'temp_store'))
+
+
+def test_index_releases_embeddings():
+    cache_dir = os.path.join(SCRIPT_DIR, 'temp_store')
+    ds, queries = _ListingDs(200), _ListingDs(20)
+
+    for embeddings_cache_dir in [None, cache_dir]:
+        knn = KNN(train_ds=ds, 
+                  model=torch.nn.Identity(), 
+                  train_ds_inference_batch_size=64, 
+                  inference_device='cpu', 
+                  embeddings_cache_dir=embeddings_cache_dir, 
+                  index=QuantizedIndex(dtype='int8', measure='euclidean', rerank_factor=4, device='cpu'))
+
+        predict = lambda: knn.predict(val_ds=queries, inference_batch_size=10, num_neighbors=5, measure='euclidean', measure_as_similarity=False, num_workers=0)
+        values, _ = predict()
+
+        if embeddings_cache_dir is None:
+            # the index holds the only copy of the reference set
+            assert knn.train_embeddings is None
+        else:
+            # the re-ranking reads the embeddings memory-mapped from the store
+            assert knn._embeddings_mapped and knn.index.originals is knn.train_embeddings
+
+        # the embeddings are not recomputed: only the added samples are embedded
+        knn.add(_ListingDs(10))
+        assert knn.index.num_samples == 210
+        assert knn.train_embeddings is None or knn.index.originals is knn.train_embeddings
+        assert np.all(predict()[0] <= values + 10 ** -4)
+
+    shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    test_store_round_trip()
+    test_callable_hash()
+    test_transforms_fingerprint()
+    test_no_fingerprint_no_cache()
+    test_index_releases_embeddings()
@@ -6,9 +6,12 @@ import torch, os, shutil
 import torchvision.transforms as tr
 import numpy as np
 
+from collections import Counter
+
 from torchvision.datasets import FashionMNIST
 
 from mypt.subroutines.neighbors.knn import KNN, KnnClassifier
+from mypt.subroutines.neighbors.ann_index import ExactIndex
 from mypt.code_utilities import directories_and_files as dirf
 
 
@@ -108,6 +111,156 @@ def knn_test_2():
     shutil.rmtree(data_dir)
 
 
+def knn_test_embed_once():
+    data_dir = os.path.join(SCRIPT_DIR, 'data')
+    dirf.process_path(data_dir, file_ok=False)
+
+    img_transform = tr.Compose([tr.Resize((32, 32)), tr.ToTensor()])
+
+    val_ds = FashionMNIST(root=data_dir, train=False, transform=img_transform, download=True)
+
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(in_features=32 * 32, out_features=128))
+
+    knn = KNN(train_ds=val_ds,
+              model=model, 
+              train_ds_inference_batch_size=1000, 
+              process_item_ds=lambda x:x[0], 
+              process_model_output=None,
+              model_ckpnt=None)
+
+    for m in ['cosine_sim', 'euclidean']:
+        res = [knn.predict(val_ds=val_ds, 
+                           inference_batch_size=1000, 
+                           num_neighbors=11, 
+                           process_item_ds=lambda x: x[0],
+                           measure=m,
+                           measure_as_similarity=(m == 'cosine_sim'),
+                           embed_once=embed_once
+                           )
+                for embed_once in [False, True]]
+
+        (values_1, indices_1), (values_2, indices_2) = res
+
+        atol=10 ** -4 if m == 'euclidean' else 10 ** -6
+        assert np.allclose(values_1, values_2, atol=atol), "embedding the datasets once should lead to the same distances"
+        # the indices might differ in case of ties: compare the distances of the selected neighbors instead 
+        assert values_2.shape == indices_2.shape == indices_1.shape, "both approaches should return arrays of the same shape"
+
+    # the train embeddings are computed only once
+    assert knn.train_embeddings is not None and len(knn.train_embeddings) == len(val_ds)
+
+    shutil.rmtree(data_dir)
+
+
+def _naive_vote(sample_distances, sample_classes, measure_as_similarity: bool):
+    # the per-sample implementation the vectorized voting replaced
+    counter = Counter(sample_classes)
+    max_freq = max(counter.values())
+    modes = [k for k, v in counter.items() if v == max_freq]
+    mean_msr = {c: np.mean([d for d, sc in zip(sample_distances, sample_classes) if sc == c]) for c in modes}
+    return (max if measure_as_similarity else min)(mean_msr, key=mean_msr.get)
+
+
+def knn_voting_test():
+    rng = np.random.default_rng(0)
+
+    for _ in range(100):
+        num_queries, k, num_classes = 64, int(rng.integers(1, 12)), int(rng.integers(2, 6))
+
+        values = rng.random((num_queries, k)).astype(np.float32)
+        labels = rng.integers(0, num_classes, size=(num_queries, k))
+
+        for sim in [True, False]:
+            preds = KnnClassifier._vote(values=torch.from_numpy(values), 
+                                        neighbor_labels=torch.from_numpy(labels), 
+                                        valid=torch.ones(num_queries, k, dtype=torch.bool),
+                                        num_classes=num_classes, 
+                                        measure_as_similarity=sim, 
+                                        weighted=False)
+
+            naive_preds = [_naive_vote(values[i].tolist(), labels[i].tolist(), sim) for i in range(num_queries)]
+            assert preds.tolist() == naive_preds, "The vectorized voting should match the per-sample implementation"
+
+    # a row without any valid neighbor is not assigned a class
+    valid = torch.ones(3, 4, dtype=torch.bool)
+    valid[1] = False
+    preds = KnnClassifier._vote(values=torch.rand(3, 4), 
+                                neighbor_labels=torch.zeros(3, 4, dtype=torch.int64), 
+                                valid=valid, 
+                                num_classes=2, 
+                                measure_as_similarity=True, 
+                                weighted=False)
+    assert preds.tolist() == [0, -1, 0]
+
+
+class _TargetsDs(torch.utils.data.Dataset):
+    def __init__(self, target_transform=None) -> None:
+        self.data = torch.randn(10, 4)
+        self.targets = list(range(10))
+        self.target_transform = target_transform
+
+    def __getitem__(self, index):
+        y = self.targets[index]
+        return self.data[index], (self.target_transform(y) if self.target_transform is not None else y)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def knn_label_extraction_test():
+    for target_transform in [None, lambda y: y % 3]:
+        ds = _TargetsDs(target_transform)
+        knn = KnnClassifier(train_ds=ds, train_ds_inference_batch_size=5, model=torch.nn.Identity(), process_item_ds=lambda x: x[0], inference_device='cpu')
+        # the labels extracted from the metadata must match the ones returned by the dataset
+        assert knn._extract_labels(ds).tolist() == [ds[i][1] for i in range(len(ds))]
+
+
+def knn_failed_remove_test():
+    ds = _TargetsDs()
+    knn = KNN(train_ds=ds, train_ds_inference_batch_size=5, model=torch.nn.Identity(), process_item_ds=lambda x: x[0], inference_device='cpu')
+    knn.remove([0, 1])
+
+    try:
+        knn.remove(list(range(len(ds))))
+        assert False, "removing all the samples should raise an error"
+    except ValueError:
+        pass
+
+    # the failed call does not leave any tombstone behind
+    assert knn.removed.tolist() == [True, True] + [False] * (len(ds) - 2)
+
+
+def knn_model_change_test():
+    torch.manual_seed(0)
+    ds = _TargetsDs()
+
+    for index in [None, ExactIndex(measure='euclidean', device='cpu')]:
+        model = torch.nn.Linear(4, 4)
+        knn = KNN(train_ds=ds, train_ds_inference_batch_size=5, model=model, process_item_ds=lambda x: x[0], inference_device='cpu', index=index)
+
+        for step in range(2):
+            values, indices = knn.predict(val_ds=ds, 
+                                          inference_batch_size=5, 
+                                          num_neighbors=1, 
+                                          measure='euclidean', 
+                                          measure_as_similarity=False, 
+                                          num_workers=0, 
+                                          embed_once=True)
+
+            # each sample is its own nearest neighbor: the train embeddings were computed with the current weights
+            assert indices[:, 0].tolist() == list(range(len(ds))) and np.allclose(values[:, 0], 0, atol=10 ** -4)
+
+            # modify the weights in place between the two predictions
+            with torch.no_grad():
+                model.weight.mul_(3)
+                model.bias.add_(1)
+
+
 if __name__ == '__main__':
     knn_test_1()
     knn_test_2()
+    knn_test_embed_once()
+    knn_voting_test()
+    knn_label_extraction_test()
+    knn_failed_remove_test()
+    knn_model_change_test()
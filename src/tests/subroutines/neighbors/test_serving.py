@@ -0,0 +1,112 @@
+"""
+This script tests the micro-batching serving object of the KnnClassifier
+"""
+
+import torch, asyncio
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import TensorDataset
+
+from mypt.subroutines.neighbors.knn import KnnClassifier
+from mypt.subroutines.neighbors.serving import KnnServer
+
+
+def test_knn_server():
+    torch.manual_seed(0)
+    train_ds = TensorDataset(torch.randn(1000, 3, 8, 8), torch.randint(0, 5, (1000,)))
+    queries = torch.randn(200, 3, 8, 8)
+
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(in_features=3 * 8 * 8, out_features=32))
+
+    classifier = KnnClassifier(train_ds=train_ds,
+                               train_ds_inference_batch_size=256,
+                               model=model,
+                               process_item_ds=lambda b: b[0],
+                               process_item_ds_class=lambda ds, i: int(ds[i][1]),
+                               inference_device='cpu')
+
+    with KnnServer(classifier, num_neighbors=5, measure='cosine_sim', measure_as_similarity=True, max_batch_size=32, max_latency_ms=2) as server:
+        expected = server.predict_batch(queries)
+
+        # concurrent single-sample requests are grouped into micro-batches: the predictions do not depend on the grouping
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = list(executor.map(server.submit, queries))
+        assert np.array_equal(np.asarray([f.result() for f in futures]), expected)
+
+        # a list of samples returns an array of labels
+        assert np.array_equal(server.submit(list(queries[:10])).result(), expected[:10])
+
+        async def _gather():
+            return await asyncio.gather(*[server.asubmit(q) for q in queries[:50]])
+
+        assert np.array_equal(np.asarray(asyncio.run(_gather())), expected[:50])
+
+
+def test_knn_server_batch_cap():
+    torch.manual_seed(0)
+    train_ds = TensorDataset(torch.randn(500, 16), torch.randint(0, 5, (500,)))
+    queries = torch.randn(60, 16)
+
+    classifier = KnnClassifier(train_ds=train_ds,
+                               train_ds_inference_batch_size=128,
+                               model=torch.nn.Identity(),
+                               process_item_ds=lambda b: b[0],
+                               process_item_ds_class=lambda ds, i: int(ds[i][1]),
+                               inference_device='cpu',
+                               num_shards=2,
+                               shard_backend='thread')
+
+    with KnnServer(classifier, num_neighbors=5, max_batch_size=8, max_latency_ms=20) as server:
+        expected = server.predict_batch(queries)
+        searcher = classifier._searcher
+
+        batch_sizes = []
+        predict_batch = server.predict_batch
+        server.predict_batch = lambda samples: batch_sizes.append(len(samples)) or predict_batch(samples)
+
+        # requests of 5 samples: two of them never share a micro-batch of at most 8 samples
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = list(executor.map(server.submit, [list(queries[i: i + 5]) for i in range(0, 40, 5)]))
+        assert np.array_equal(np.concatenate([f.result() for f in futures]), expected[:40])
+
+        # a single request larger than the cap is processed in chunks
+        assert np.array_equal(server.submit(list(queries[40:])).result(), expected[40:])
+
+        assert max(batch_sizes) <= 8
+        # the shards (and their workers) are kept for the lifetime of the server
+        assert classifier._searcher is searcher
+
+    assert classifier._searcher is None
+
+
+def test_knn_server_failing_request():
+    torch.manual_seed(0)
+    train_ds = TensorDataset(torch.randn(500, 16), torch.randint(0, 5, (500,)))
+    queries = torch.randn(20, 16)
+
+    classifier = KnnClassifier(train_ds=train_ds,
+                               train_ds_inference_batch_size=128,
+                               model=torch.nn.Identity(),
+                               process_item_ds=lambda b: b[0],
+                               process_item_ds_class=lambda ds, i: int(ds[i][1]),
+                               inference_device='cpu')
+
+    # a long latency: the requests below are grouped into the same micro-batch
+    with KnnServer(classifier, num_neighbors=5, max_batch_size=64, max_latency_ms=200) as server:
+        expected = server.predict_batch(queries)
+
+        futures = [server.submit(q) for q in queries[:10]] + [server.submit(torch.randn(17))] + [server.submit(list(queries[10:]))]
+
+        # the sample of the wrong shape fails only its own request
+        assert futures[10].exception() is not None
+        assert all(f.exception() is None for f in futures[:10] + futures[11:])
+
+        assert np.array_equal(np.asarray([f.result() for f in futures[:10]]), expected[:10])
+        assert np.array_equal(futures[11].result(), expected[10:])
+
+
+if __name__ == '__main__':
+    test_knn_server()
+    test_knn_server_batch_cap()
+    test_knn_server_failing_request()
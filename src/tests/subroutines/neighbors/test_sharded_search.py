@@ -0,0 +1,55 @@
+"""
+This script tests the sharded similarity search of the KNN classes against the single-process search
+"""
+
+import torch
+import numpy as np
+
+from mypt.subroutines.neighbors.sharded_search import ShardedSearcher, sharded_search, shard_bounds
+from mypt.shortcuts import str2distance
+
+
+def test_sharded_search():
+    torch.manual_seed(0)
+    refs, queries = torch.randn(3000, 32), torch.randn(100, 32)
+    # duplicated references lead to ties: the sharded search must break them exactly as the sequential one
+    refs[1500:1600] = refs[:100]
+
+    removed = torch.zeros(len(refs), dtype=torch.bool)
+    removed[torch.randperm(len(refs))[:200]] = True
+
+    assert shard_bounds(3000, num_shards=4, block_size=256) == [(0, 768), (768, 1536), (1536, 2304), (2304, 3000)]
+
+    for m, largest in [('cosine_sim', True), ('euclidean', False)]:
+        msr = str2distance[m]
+        msr = msr() if isinstance(msr, type) else msr
+
+        kwargs = {"query_embs": queries, "ref_embs": refs, "k": 10, "msr": msr, "measure_as_similarity": largest,
+                  "query_batch_size": 32, "ref_batch_size": 256, "removed": removed}
+
+        values, indices = sharded_search(num_shards=1, **kwargs)
+        assert not np.isin(indices, torch.nonzero(removed).squeeze(1).numpy()).any()
+
+        for backend in ['thread', 'process']:
+            shard_values, shard_indices = sharded_search(num_shards=4, backend=backend, **kwargs)
+            assert np.array_equal(values, shard_values) and np.array_equal(indices, shard_indices)
+
+    # a persistent searcher: the workers are started once and reused across searches
+    msr = str2distance['euclidean']
+    with ShardedSearcher(refs, num_shards=4, ref_batch_size=256, backend='process') as searcher:
+        kwargs = {"k": 10, "msr": msr, "measure_as_similarity": False, "query_batch_size": 32}
+        first = searcher.search(queries, removed=removed, **kwargs)
+        pool = searcher._pool
+
+        second = searcher.search(queries[:10], **kwargs)
+        assert searcher._pool is pool
+
+        expected = sharded_search(query_embs=queries[:10], ref_embs=refs, ref_batch_size=256, num_shards=1, **kwargs)
+        assert np.array_equal(second[0], expected[0]) and np.array_equal(second[1], expected[1])
+        assert first[0].shape == (len(queries), 10)
+
+    assert searcher._pool is None
+
+
+if __name__ == '__main__':
+    test_sharded_search()
@@ -15,6 +15,7 @@ from torchvision.datasets import FashionMNIST
 
 from mypt.code_utilities import directories_and_files as dirf
 from mypt.subroutines.neighbors import model_embs as me
+from mypt.shortcuts import str2distance
 from mypt.models.simClr.simClrModel import ResnetSimClr
 from mypt.data.datasets.parallel_augmentation.parallel_aug_dir import ParallelAugDs
 
@@ -107,5 +108,34 @@ def test_with_clr_ds():
     shutil.rmtree(res_dir)
 
 
+def test_knn_graph():
+    torch.manual_seed(0)
+    embeddings = torch.randn(500, 16)
+
+    for m, largest in [('cosine_sim', True), ('euclidean', False)]:
+        msr = str2distance[m]
+        msr = msr() if isinstance(msr, type) else msr
+
+        # the brute force: the full (N, N) matrix with the diagonal excluded
+        full = msr(embeddings, embeddings).float()
+        full.fill_diagonal_(-float('inf') if largest else float('inf'))
+        true_values = torch.topk(full, k=5, dim=1, largest=largest).values
+
+        for symmetric in [True, False]:
+            values, indices = me._knn_graph(embeddings, 
+                                            k_neighbors=5, 
+                                            measure=msr, 
+                                            measure_as_similarity=largest, 
+                                            batch_size=64, 
+                                            device='cpu', 
+                                            symmetric_measure=symmetric)
+
+            assert values.shape == (500, 5) and indices.shape == (500, 5)
+            assert not torch.any(indices == torch.arange(500).unsqueeze(1))
+            assert torch.allclose(values, true_values, atol=10 ** -4)
+            assert torch.allclose(torch.gather(full, 1, indices), values, atol=10 ** -4)
+
+
 if __name__ == '__main__':  
+    test_knn_graph()
     test_with_clr_ds()
@@ -0,0 +1,67 @@
+"""
+This script tests the running top-k buffer of the KNN search against a brute-force top-k over the full distance matrix
+"""
+
+import torch
+
+from torch.utils.data import Dataset
+
+from mypt.subroutines.neighbors.knn import KNN
+
+
+class _EmbeddingsDs(Dataset):
+    def __init__(self, data: torch.Tensor) -> None:
+        self.data = data
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _l1(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return torch.cdist(x, y, p=1)
+
+
+def _brute_force(queries: torch.Tensor, refs: torch.Tensor, k: int, measure_as_similarity: bool):
+    full = _l1(queries, refs) * (-1 if measure_as_similarity else 1)
+    k = min(k, len(refs))
+
+    values = torch.topk(full, k=k, dim=1, largest=measure_as_similarity).values
+    # the ties are broken by the smallest index: a stable sort over the full matrix
+    indices = torch.sort(full, dim=1, descending=measure_as_similarity, stable=True).indices[:, :k]
+    return values, indices
+
+
+def test_running_topk():
+    g = torch.Generator().manual_seed(0)
+    # small integer embeddings: many ties in the distances
+    refs = torch.randint(0, 3, (53, 4), generator=g).float()
+    queries = torch.randint(0, 3, (17, 4), generator=g).float()
+
+    # the train batch size (7) is smaller than most values of k and does not divide the number of references
+    knn = KNN(train_ds=_EmbeddingsDs(refs), train_ds_inference_batch_size=7, model=torch.nn.Identity(), inference_device='cpu')
+    knn._load_model()
+
+    for measure_as_similarity in [False, True]:
+        msr = (lambda x, y: -_l1(x, y)) if measure_as_similarity else _l1
+
+        for k in [1, 5, 10, 53, 60]:
+            values, indices = knn._find_neighbors(val_ds=_EmbeddingsDs(queries),
+                                                  num_neighbors=k,
+                                                  msr=msr,
+                                                  measure_as_similarity=measure_as_similarity,
+                                                  val_process_item_ds=lambda x: x,
+                                                  val_batch_size=5,
+                                                  num_workers=0)
+
+            expected_values, expected_indices = _brute_force(queries, refs, k, measure_as_similarity)
+
+            assert values.shape == indices.shape == tuple(expected_values.shape), f"k: {k}"
+            assert torch.equal(torch.from_numpy(values), expected_values), f"k: {k}"
+            assert torch.equal(torch.from_numpy(indices), expected_indices), f"k: {k}"
+
+
+if __name__ == '__main__':
+    test_running_topk()
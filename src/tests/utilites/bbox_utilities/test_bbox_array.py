@@ -0,0 +1,71 @@
+"""
+This script tests the vectorized (array) bounding box conversions against the single-box ones.
+"""
+import time, torch
+import numpy as np
+
+from mypt.code_utilities import bbox_utilities as au
+
+
+def _random_pascal_voc_boxes(n: int, rng: np.random.Generator):
+    shapes = rng.integers(50, 500, size=(n, 2))
+    x_min = rng.integers(0, shapes[:, 1] - 10)
+    y_min = rng.integers(0, shapes[:, 0] - 10)
+    x_max = rng.integers(x_min + 1, shapes[:, 1] + 1)
+    y_max = rng.integers(y_min + 1, shapes[:, 0] + 1)
+    return np.stack([x_min, y_min, x_max, y_max], axis=1), shapes
+
+
+def test_convert_bbox_array():
+    rng = np.random.default_rng(0)
+    pascal, shapes = _random_pascal_voc_boxes(200, rng)
+
+    # the same boxes in every format (computed with the single-box functions)
+    by_format = {au.PASCAL_VOC: pascal.tolist()}
+    for f in [au.COCO, au.YOLO, au.ALBUMENTATIONS]:
+        by_format[f] = [au.convert_bbox_annotation(b.tolist(), au.PASCAL_VOC, f, img_shape=s.tolist()) for b, s in zip(pascal, shapes)]
+
+    for current in au.OBJ_DETECT_ANN_FORMATS:
+        boxes = np.asarray(by_format[current])
+        for target in au.OBJ_DETECT_ANN_FORMATS:
+            if current == target:
+                continue
+
+            expected = np.asarray([au.convert_bbox_annotation(b, current, target, img_shape=s.tolist()) for b, s in zip(by_format[current], shapes)])
+
+            res = au.convert_bbox_array(boxes, current, target, img_shapes=shapes)
+            assert np.allclose(res, expected, atol=1e-4), f"{current} -> {target}"
+
+            # torch tensors are supported as well
+            res_t = au.convert_bbox_array(torch.from_numpy(boxes), current, target, img_shapes=shapes)
+            assert isinstance(res_t, torch.Tensor) and np.allclose(res_t.numpy(), expected, atol=1e-4), f"{current} -> {target}"
+
+
+def test_bbox_array_validity():
+    boxes = np.asarray([[0, 0, 10, 10], [5, 5, 4, 10], [0, 0, 20, 10]])
+    valid = au.bbox_array_validity(boxes, au.PASCAL_VOC, img_shapes=(15, 15))
+    assert valid.tolist() == [True, False, False]
+
+    try:
+        au.convert_bbox_array(boxes, au.PASCAL_VOC, au.PASCAL_VOC, img_shapes=(15, 15))
+        assert False, "invalid boxes should raise an error"
+    except ValueError:
+        pass
+
+    yolo = np.asarray([[0.5, 0.5, 1.0, 1.0], [0.1, 0.5, 0.4, 0.2]])
+    assert au.bbox_array_validity(yolo, au.YOLO, img_shapes=(10, 10)).tolist() == [True, False]
+
+    assert au.verify_object_detection_bboxes([[[0, 0], [1, 1]], [[2, 2], [3, 3]]]).tolist() == [[0, 0, 1, 1], [2, 2, 3, 3]]
+
+
+def benchmark(n: int = 10 ** 6):
+    pascal, shapes = _random_pascal_voc_boxes(n, np.random.default_rng(0))
+    start = time.perf_counter()
+    au.convert_bbox_array(pascal, au.PASCAL_VOC, au.YOLO, img_shapes=shapes, verify=True)
+    print(f"{n} boxes converted in {time.perf_counter() - start:.3f} seconds")
+
+
+if __name__ == '__main__':
+    test_convert_bbox_array()
+    test_bbox_array_validity()
+    benchmark()
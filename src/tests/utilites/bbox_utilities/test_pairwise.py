@@ -0,0 +1,74 @@
+"""
+This script tests the pairwise (N, M) box kernels against the single-pair functions and benchmarks them.
+"""
+import time, torch
+import numpy as np
+
+from mypt.code_utilities import bbox_utilities as au
+
+IMG_SHAPE = (500, 500)
+
+
+def _random_boxes(n: int, rng: np.random.Generator) -> np.ndarray:
+    x_min, y_min = rng.integers(0, 400, size=n), rng.integers(0, 400, size=n)
+    x_max, y_max = rng.integers(x_min + 1, 500), rng.integers(y_min + 1, 500)
+    return np.stack([x_min, y_min, x_max, y_max], axis=1)
+
+
+def test_pairwise_kernels():
+    rng = np.random.default_rng(0)
+    b1, b2 = _random_boxes(40, rng), _random_boxes(30, rng)
+
+    inter = au.pairwise_intersection_area(b1, b2)
+    iou = au.pairwise_iou(b1, b2)
+    giou = au.pairwise_giou(b1, b2)
+    inside = au.pairwise_containment(b1, b2)
+    either = inside | au.pairwise_containment(b2, b1).T
+
+    assert inter.shape == iou.shape == giou.shape == inside.shape == (40, 30)
+    assert torch.all(giou <= iou) and torch.all(giou >= -1)
+
+    for i in range(len(b1)):
+        for j in range(len(b2)):
+            p1, p2 = b1[i].tolist(), b2[j].tolist()
+
+            intersection = au.bounding_boxes_intersect(p1, p2, img_shape=IMG_SHAPE, bbox1_format=au.PASCAL_VOC, bbox2_format=au.PASCAL_VOC)
+            assert (intersection is not None) == bool(inter[i, j] > 0)
+
+            if intersection is not None:
+                area = lambda b: (b[2] - b[0]) * (b[3] - b[1])
+                assert inter[i, j].item() == area(intersection)
+                assert abs(iou[i, j].item() - area(intersection) / (area(p1) + area(p2) - area(intersection))) < 1e-6
+
+            assert bool(either[i, j]) == au.box_within_box(p1, p2, au.PASCAL_VOC, au.PASCAL_VOC, img_shape=IMG_SHAPE)
+
+    # the chunked mode returns the same values
+    assert torch.equal(au.pairwise_iou(b1, b2, chunk_size=7), iou)
+    assert torch.equal(au.pairwise_containment(b1, b2, chunk_size=7), inside)
+
+    # any supported format
+    coco = au.convert_bbox_array(b1, au.PASCAL_VOC, au.COCO, img_shapes=IMG_SHAPE)
+    assert torch.allclose(au.pairwise_iou(coco, b2, format1=au.COCO, format2=au.PASCAL_VOC, img_shape=IMG_SHAPE), iou)
+
+
+def benchmark(n: int = 300, m: int = 300):
+    rng = np.random.default_rng(0)
+    b1, b2 = _random_boxes(n, rng), _random_boxes(m, rng)
+    l1, l2 = b1.tolist(), b2.tolist()
+
+    start = time.perf_counter()
+    for p1 in l1:
+        for p2 in l2:
+            au.bounding_boxes_intersect(p1, p2, img_shape=IMG_SHAPE, bbox1_format=au.PASCAL_VOC, bbox2_format=au.PASCAL_VOC)
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    au.pairwise_intersection_area(b1, b2)
+    pairwise_time = time.perf_counter() - start
+
+    print(f"{n} x {m} intersections: scalar: {scalar_time:.3f} seconds, pairwise: {pairwise_time:.4f} seconds")
+
+
+if __name__ == '__main__':
+    test_pairwise_kernels()
+    benchmark()
@@ -0,0 +1,98 @@
+"""
+This script tests the batched post-processing of the object localization outputs against a naive greedy nms and benchmarks it.
+"""
+import time, torch
+import numpy as np
+
+from mypt.code_utilities import bbox_utilities as au
+from mypt.visualization.object_detection_postprocessing import batched_nms, postprocess_localization_output
+
+
+def _naive_nms(boxes: np.ndarray, scores: np.ndarray, groups: np.ndarray, iou_threshold: float) -> list:
+    keep = []
+    for i in np.argsort(-scores, kind='stable'):
+        if all(groups[j] != groups[i] or au.pairwise_iou(boxes[[j]], boxes[[i]]).item() <= iou_threshold for j in keep):
+            keep.append(i)
+    return keep
+
+
+def _naive_nms_per_group(boxes: np.ndarray, scores: np.ndarray, groups: np.ndarray, iou_threshold: float) -> list:
+    # the same greedy nms with the overlaps of each box computed against all the kept boxes of its group at once
+    keep, kept_per_group = [], {}
+    for i in np.argsort(-scores, kind='stable'):
+        kept = kept_per_group.setdefault(groups[i], [])
+        if len(kept) == 0 or bool((au.pairwise_iou(boxes[kept], boxes[[i]]) <= iou_threshold).all()):
+            kept.append(i)
+            keep.append(i)
+    return keep
+
+
+def _random_boxes(n: int, rng: np.random.Generator) -> np.ndarray:
+    x_min, y_min = rng.integers(0, 80, size=n), rng.integers(0, 80, size=n)
+    return np.stack([x_min, y_min, rng.integers(x_min + 1, 100), rng.integers(y_min + 1, 100)], axis=1)
+
+
+def test_batched_nms():
+    rng = np.random.default_rng(0)
+    boxes, scores, groups = _random_boxes(300, rng), rng.random(300), rng.integers(0, 6, size=300)
+
+    for t in [0.1, 0.3, 0.5, 0.9]:
+        keep = batched_nms(torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(groups), iou_threshold=t)
+        assert keep.tolist() == _naive_nms(boxes, scores, groups, t), f"threshold: {t}"
+
+
+def test_batched_nms_unequal_groups():
+    rng = np.random.default_rng(1)
+    # a single large group and many small ones: padding every group to the largest one would need 2000 * 3000 ** 2 overlaps
+    sizes = [3000] + rng.integers(1, 4, size=2000).tolist()
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    rng.shuffle(groups)
+    boxes, scores = _random_boxes(len(groups), rng), rng.random(len(groups))
+
+    for t in [0.3, 0.7]:
+        keep = batched_nms(torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(groups), iou_threshold=t)
+        assert keep.tolist() == _naive_nms_per_group(boxes, scores, groups, t), f"threshold: {t}"
+
+
+def test_postprocess_localization_output():
+    num_classes, img_shape = 3, (100, 200)
+    # yolo boxes: the first two predictions of image 0 overlap, the third one belongs to another class
+    yolo = torch.tensor([[[0.5, 0.5, 0.4, 0.4], [0.51, 0.5, 0.4, 0.4], [0.5, 0.5, 0.4, 0.4]],
+                         [[0.2, 0.2, 0.2, 0.2], [0.7, 0.7, 0.2, 0.2], [0.5, 0.5, 0.1, 0.1]]])
+    obj = torch.tensor([[[4.0], [3.0], [2.0]], [[-4.0], [3.0], [2.0]]])
+    cls = torch.nn.functional.one_hot(torch.tensor([[0, 0, 1], [2, 2, 2]]), num_classes).float() * 10
+    logits = torch.cat([obj, yolo, cls], dim=-1)
+
+    boxes, scores, labels, image_indices = postprocess_localization_output(logits, box_format=au.YOLO, img_shapes=img_shape)
+
+    assert image_indices.tolist() == [0, 0, 1, 1]
+    assert labels.tolist() == [0, 1, 2, 2]
+    assert torch.all(scores[:-1][image_indices[:-1] == image_indices[1:]] >= scores[1:][image_indices[:-1] == image_indices[1:]])
+    expected = au.convert_bbox_array(yolo.reshape(-1, 4)[[0, 2, 4, 5]], au.YOLO, au.PASCAL_VOC, img_shapes=img_shape)
+    assert torch.equal(boxes, expected)
+
+    # class agnostic: the box of class 1 is suppressed as well
+    _, _, labels, _ = postprocess_localization_output(logits, box_format=au.YOLO, img_shapes=img_shape, class_aware=False)
+    assert labels.tolist() == [0, 2, 2]
+
+    # a single prediction per image (the output of AlexnetObjectLocalization) and boxes returned in another format
+    boxes, _, _, image_indices = postprocess_localization_output(logits[:, 0], box_format=au.YOLO, img_shapes=[img_shape, img_shape], target_format=au.COCO)
+    assert image_indices.tolist() == [0] and boxes.tolist() == [[60, 30, 80, 40]]
+
+
+def benchmark(batch_size: int = 4096, num_classes: int = 20):
+    logits = torch.randn(batch_size, num_classes + 5)
+    logits[:, 1:5] = torch.rand(batch_size, 4) * 0.5 + 0.25
+
+    postprocess_localization_output(logits, box_format=au.YOLO, img_shapes=(224, 224))
+    start = time.perf_counter()
+    for _ in range(10):
+        postprocess_localization_output(logits, box_format=au.YOLO, img_shapes=(224, 224))
+    print(f"{batch_size * 10 / (time.perf_counter() - start):.0f} images per second")
+
+
+if __name__ == '__main__':
+    test_batched_nms()
+    test_batched_nms_unequal_groups()
+    test_postprocess_localization_output()
+    benchmark()